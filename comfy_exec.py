@@ -0,0 +1,451 @@
+# comfy_exec.py
+"""
+Виконання workflow напряму в ComfyUI з відстеженням через /ws.
+
+comfyui-api тримає один HTTP-запит до кінця генерації (до 7200 с) і нічого не
+показує: завислий семплер не відрізнити від повільного. Тут:
+  - prompt ставиться в чергу ComfyUI (/prompt з нашим client_id) і запит одразу повертається;
+  - події /ws (execution_start / executing / progress / executed / execution_*)
+    дають поточний вузол, крок семплера і ETA — їх отримує on_progress;
+  - таймаут — на "тишу" поточного вузла (COMFY_STALL_SEC, окремо для class_type),
+    а не один глобальний; при зависанні знімаємо саме наш prompt (cancel_prompt);
+  - шляхи результатів беремо з подій executed (+ /history для кешованих вузлів),
+    а не скануванням тек.
+
+WebSocket-клієнт мінімальний (RFC 6455, лише те, що шле ComfyUI) — без залежностей.
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import socket
+import struct
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+import http_client
+
+_SERVER = "127.0.0.1:8188"
+_OUTPUT_DIR = "/opt/ComfyUI/output"
+_STALL_SEC = 600.0
+_NODE_STALL_SEC: Dict[str, float] = {}
+_LOG = print
+
+WS_RECONNECTS = 5
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTPUT_KEYS = ("images", "gifs", "videos", "video", "audio", "files")
+
+
+def init_comfy_exec(server: str, output_dir: str, stall_sec: float, node_stall_sec: Optional[dict], log_fn):
+    """server — сам ComfyUI (host:port), не comfyui-api; node_stall_sec: {class_type: сек}."""
+    global _SERVER, _OUTPUT_DIR, _STALL_SEC, _NODE_STALL_SEC, _LOG
+    _SERVER = server
+    _OUTPUT_DIR = output_dir
+    _STALL_SEC = float(stall_sec)
+    _NODE_STALL_SEC = {k: float(v) for k, v in (node_stall_sec or {}).items()}
+    _LOG = log_fn
+
+
+class ComfyExecutionError(RuntimeError):
+    pass
+
+
+class ComfyStallError(ComfyExecutionError):
+    pass
+
+
+# ------------------ WebSocket ------------------
+
+class _WebSocket:
+    def __init__(self, host: str, port: int, path: str, timeout: float = 10.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall(
+            f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key.decode()}\r\n"
+            f"Sec-WebSocket-Version: 13\r\n\r\n".encode()
+        )
+        resp = b""
+        while b"\r\n\r\n" not in resp:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("ws: зʼєднання закрите під час handshake")
+            resp += chunk
+        head, self.buf = resp.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+        if " 101 " not in lines[0] + " ":
+            raise ConnectionError(f"ws: handshake відхилено: {lines[0]}")
+        accept = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest()).decode()
+        headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in lines[1:])}
+        if headers.get("sec-websocket-accept") != accept:
+            raise ConnectionError("ws: невірний Sec-WebSocket-Accept")
+        self._parts = []
+
+    def _send(self, opcode: int, payload: bytes = b""):
+        mask = os.urandom(4)
+        n = len(payload)
+        if n < 126:
+            hdr = struct.pack(">BB", 0x80 | opcode, 0x80 | n)
+        elif n < 65536:
+            hdr = struct.pack(">BBH", 0x80 | opcode, 0x80 | 126, n)
+        else:
+            hdr = struct.pack(">BBQ", 0x80 | opcode, 0x80 | 127, n)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(hdr + mask + masked)
+
+    def _frame(self):
+        """(fin, opcode, payload) з буфера або None, якщо кадр ще не весь."""
+        b = self.buf
+        if len(b) < 2:
+            return None
+        fin, opcode = b[0] & 0x80, b[0] & 0x0F
+        masked, n = b[1] & 0x80, b[1] & 0x7F
+        off = 2
+        if n == 126:
+            if len(b) < 4:
+                return None
+            n = struct.unpack_from(">H", b, 2)[0]
+            off = 4
+        elif n == 127:
+            if len(b) < 10:
+                return None
+            n = struct.unpack_from(">Q", b, 2)[0]
+            off = 10
+        mask = b""
+        if masked:
+            mask = b[off:off + 4]
+            off += 4
+        if len(b) < off + n:
+            return None
+        payload = b[off:off + n]
+        if masked:
+            payload = bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
+        self.buf = b[off + n:]
+        return fin, opcode, payload
+
+    def recv(self, timeout: float):
+        """Наступне повідомлення (opcode, bytes) або None за timeout секунд."""
+        deadline = time.time() + max(0.0, timeout)
+        while True:
+            fr = self._frame()
+            if fr is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+                try:
+                    chunk = self.sock.recv(256 * 1024)
+                except socket.timeout:
+                    return None
+                if not chunk:
+                    raise ConnectionError("ws: зʼєднання закрите")
+                self.buf += chunk
+                continue
+            fin, opcode, payload = fr
+            if opcode == 0x9:
+                self._send(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            if opcode == 0x8:
+                raise ConnectionError("ws: сервер закрив зʼєднання")
+            if opcode != 0x0:
+                self._parts = [opcode]
+            self._parts.append(payload)
+            if fin:
+                op, data = self._parts[0], b"".join(self._parts[1:])
+                self._parts = []
+                return op, data
+
+    def close(self):
+        try:
+            self._send(0x8)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# ------------------ стан виконання ------------------
+
+class _Execution:
+    def __init__(self, prompt_id: str, workflow: dict):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.started_at = None
+        self.node = None
+        self.node_started = None
+        self.last_event = time.time()
+        self.step = None
+        self.cached = set()
+        self.executed = []
+        self.timings: Dict[str, float] = {}
+        self.outputs: Dict[str, dict] = {}
+        self.finished = False
+        self.error = None
+
+    def node_type(self, node) -> Optional[str]:
+        return (self.workflow.get(str(node)) or {}).get("class_type") if node is not None else None
+
+    def stall_limit(self) -> float:
+        return _NODE_STALL_SEC.get(self.node_type(self.node), _STALL_SEC)
+
+    def _close_node(self, now: float):
+        if self.node is not None and self.node_started is not None:
+            self.timings[str(self.node)] = round(now - self.node_started, 2)
+
+    def handle(self, msg: dict) -> bool:
+        """Оновлює стан; True — якщо подія стосується нашого prompt (для on_progress)."""
+        typ = msg.get("type")
+        data = msg.get("data") or {}
+        if data.get("prompt_id") not in (None, self.prompt_id):
+            return False
+        now = time.time()
+        if typ == "execution_start":
+            self.started_at = now
+        elif typ == "execution_cached":
+            self.cached.update(str(n) for n in data.get("nodes") or [])
+        elif typ == "executing":
+            self._close_node(now)
+            node = data.get("node")
+            if node is None:
+                self.finished = True
+            else:
+                if self.started_at is None:
+                    self.started_at = now
+                self.executed.append(str(node))
+            self.node, self.node_started, self.step = node, now, None
+        elif typ == "progress":
+            self.step = (data.get("value") or 0, data.get("max") or 0)
+        elif typ == "executed":
+            node = str(data.get("node"))
+            out = data.get("output") or {}
+            prev = self.outputs.setdefault(node, {})
+            for k, v in out.items():
+                if isinstance(v, list):
+                    prev.setdefault(k, []).extend(v)
+                else:
+                    prev[k] = v
+        elif typ == "execution_success":
+            self._close_node(now)
+            self.finished = True
+        elif typ == "execution_error":
+            self.error = ComfyExecutionError(
+                f"ComfyUI: вузол {data.get('node_id')} ({data.get('node_type')}) впав: "
+                f"{data.get('exception_message')}"
+            )
+        elif typ == "execution_interrupted":
+            self.error = ComfyExecutionError(f"ComfyUI: виконання перервано на вузлі {data.get('node_id')}")
+        else:
+            return False
+        self.last_event = now
+        return True
+
+    def progress(self) -> dict:
+        """Знімок для on_progress: поточний вузол, крок, ETA вузла і загальний відсоток."""
+        now = time.time()
+        total = max(1, len(self.workflow) - len(self.cached))
+        done = len(self.executed) if self.finished else max(0, len(self.executed) - 1)
+        out = {
+            "node": self.node,
+            "node_type": self.node_type(self.node),
+            "nodes_done": done,
+            "nodes_total": total,
+            "elapsed_sec": round(now - self.started_at, 1) if self.started_at else 0.0,
+        }
+        frac = 0.0
+        if self.step and self.step[1]:
+            value, maximum = self.step
+            out["step"], out["steps"] = value, maximum
+            frac = value / maximum
+            if value and self.node_started:
+                per_step = (now - self.node_started) / value
+                out["node_eta_sec"] = round(per_step * (maximum - value), 1)
+        pct = min(1.0, (done + frac) / total)
+        out["percent"] = round(pct * 100, 1)
+        if self.started_at and pct > 0:
+            out["eta_sec"] = round((now - self.started_at) * (1 - pct) / pct, 1)
+        return out
+
+
+class ProgressReporter:
+    """on_progress -> update_task("running"), не частіше за раз на min_interval секунд."""
+
+    def __init__(self, task_id, update_task, min_interval: float = 10.0):
+        self.task_id = task_id
+        self.update_task = update_task
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, progress: dict, force: bool = False):
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last < self.min_interval:
+                return
+            self._last = now
+        try:
+            self.update_task(self.task_id, "running", payload_update={"stage": "comfy_running", "progress": progress})
+        except Exception as e:
+            _LOG(f"[comfy] не вдалось відправити прогрес #{self.task_id}: {e}")
+
+
+# ------------------ виконання ------------------
+
+def _connect(server: str, client_id: str) -> _WebSocket:
+    host, _, port = server.partition(":")
+    return _WebSocket(host, int(port or 80), f"/ws?clientId={client_id}")
+
+
+def _history(server: str, prompt_id: str) -> Optional[dict]:
+    r = http_client.get(f"http://{server}/history/{prompt_id}", endpoint="comfy.history", timeout=(5, 30))
+    if r.status_code != 200:
+        return None
+    return (r.json() or {}).get(prompt_id)
+
+
+def cancel_prompt(prompt_id: str, server: Optional[str] = None) -> bool:
+    """
+    Знімає наш prompt: з черги, якщо він ще чекає, або /interrupt, якщо саме він
+    виконується (чужий prompt у черзі не чіпаємо). True — prompt був у Comfy.
+    """
+    server = server or _SERVER
+    try:
+        q = http_client.get(f"http://{server}/queue", endpoint="comfy.queue", timeout=(5, 15)).json() or {}
+        running = any(len(item) > 1 and item[1] == prompt_id for item in q.get("queue_running") or [])
+        pending = any(len(item) > 1 and item[1] == prompt_id for item in q.get("queue_pending") or [])
+        if pending:
+            http_client.post(f"http://{server}/queue", endpoint="comfy.queue", json={"delete": [prompt_id]}, timeout=(5, 15))
+        if running:
+            http_client.post(
+                f"http://{server}/interrupt", endpoint="comfy.interrupt", json={"prompt_id": prompt_id}, timeout=(5, 15),
+            )
+    except Exception as e:
+        _LOG(f"[comfy] не вдалося зняти prompt {prompt_id}: {e}")
+        return False
+    if running or pending:
+        _LOG(f"[comfy] prompt {prompt_id} знято ({'виконувався' if running else 'в черзі'})")
+    return running or pending
+
+
+def output_files(outputs: Dict[str, dict]) -> List[dict]:
+    """[{"node", "index", "path", "kind"}] з outputs вузлів (лише type=output)."""
+    files = []
+    for node, out in outputs.items():
+        index = 0
+        for kind in OUTPUT_KEYS:
+            for item in out.get(kind) or []:
+                if not isinstance(item, dict) or item.get("type", "output") != "output":
+                    continue
+                path = item.get("fullpath") or os.path.join(_OUTPUT_DIR, item.get("subfolder") or "", item["filename"])
+                files.append({"node": node, "index": index, "path": path, "kind": kind})
+                index += 1
+    return files
+
+
+def execute(
+    workflow: dict,
+    *,
+    timeout_sec: float = 7200,
+    prompt_id: Optional[str] = None,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    server: Optional[str] = None,
+    queue_timeout_sec: Optional[float] = None,
+) -> dict:
+    """
+    Ставить workflow у чергу ComfyUI і чекає завершення за подіями /ws.
+    Повертає {"id", "outputs": {node: output}, "files": [...], "stats": {...}}.
+    ComfyStallError — якщо поточний вузол мовчить довше за свій ліміт;
+    ComfyExecutionError — помилка/переривання в ComfyUI; TimeoutError — таймаут.
+    timeout_sec рахується від execution_start (саме виконання); очікування в черзі
+    ComfyUI (напр. за prompt іншої задачі з COMFY_PRIME) обмежує queue_timeout_sec
+    (None — теж timeout_sec). При таймауті/зависанні знімається лише наш prompt.
+    server — інший ComfyUI (пул бекендів), за замовчуванням з init_comfy_exec.
+    """
+    server = server or _SERVER
+    client_id = str(uuid.uuid4())
+    ws = _connect(server, client_id)
+    try:
+        body = {"prompt": workflow, "client_id": client_id}
+        if prompt_id:
+            body["prompt_id"] = prompt_id
+        r = http_client.post(f"http://{server}/prompt", endpoint="comfy.queue", json=body, timeout=(5, 60))
+        if r.status_code >= 400:
+            raise ComfyExecutionError(f"ComfyUI відхилив prompt {r.status_code}: {r.text[:2000]}")
+        pid = r.json().get("prompt_id")
+        if not pid:
+            raise ComfyExecutionError(f"ComfyUI не повернув prompt_id: {r.text[:500]}")
+
+        st = _Execution(pid, workflow)
+        t0 = time.time()
+        queue_limit = timeout_sec if queue_timeout_sec is None else queue_timeout_sec
+        reconnects = 0
+        while not st.finished:
+            now = time.time()
+            if st.started_at:
+                deadline = st.started_at + timeout_sec
+            else:
+                deadline = t0 + queue_limit
+            if now >= deadline:
+                cancel_prompt(pid, server)
+                if st.started_at:
+                    raise TimeoutError(f"ComfyUI: prompt {pid} не завершився за {timeout_sec}s")
+                raise TimeoutError(f"ComfyUI: prompt {pid} простояв у черзі {queue_limit}s і не стартував")
+            # до execution_start prompt просто стоїть у черзі — там діє лише таймаут черги
+            stall_at = st.last_event + st.stall_limit() if st.started_at else deadline
+            if now >= stall_at:
+                cancel_prompt(pid, server)
+                raise ComfyStallError(
+                    f"ComfyUI: вузол {st.node} ({st.node_type(st.node)}) без подій {now - st.last_event:.1f}s"
+                )
+            try:
+                msg = ws.recv(min(stall_at, deadline) - now)
+            except (ConnectionError, OSError) as e:
+                reconnects += 1
+                if reconnects > WS_RECONNECTS:
+                    raise
+                _LOG(f"[comfy] ws обірвався ({e}), перепідключаємось")
+                time.sleep(min(5, reconnects))
+                ws.close()
+                ws = _connect(server, client_id)
+                hist = _history(server, pid)
+                if hist and (hist.get("status") or {}).get("completed") is not None:
+                    st.finished = True
+                continue
+            if msg is None or msg[0] != 0x1:
+                continue  # таймаут recv або бінарні превʼю
+            try:
+                event = json.loads(msg[1])
+            except ValueError:
+                continue
+            if st.handle(event):
+                if st.error:
+                    raise st.error
+                if on_progress and event.get("type") in ("progress", "executing", "executed"):
+                    on_progress(st.progress())
+    finally:
+        ws.close()
+
+    # кешовані вузли не шлють executed — їхні outputs лише в /history
+    hist = _history(server, pid) or {}
+    status = hist.get("status") or {}
+    if status.get("status_str") == "error":
+        raise ComfyExecutionError(f"ComfyUI: prompt {pid} завершився з помилкою: {status.get('messages')}")
+    for node, out in (hist.get("outputs") or {}).items():
+        st.outputs.setdefault(str(node), out)
+
+    elapsed = round(time.time() - t0, 2)
+    if on_progress:
+        on_progress(dict(st.progress(), percent=100.0, eta_sec=0.0))
+    return {
+        "id": pid,
+        "outputs": st.outputs,
+        "files": output_files(st.outputs),
+        "stats": {
+            "elapsed_sec": elapsed,
+            "queue_sec": round((st.started_at or t0) - t0, 2),
+            "node_sec": st.timings,
+            "cached_nodes": sorted(st.cached),
+        },
+    }
@@ -0,0 +1,242 @@
+# comfy_pool.py
+"""
+Пул бекендів Comfy на одній машині (наприклад, по одному ComfyUI + comfyui-api на GPU).
+
+Замість контейнера на кожну GPU воркер сам розподіляє задачі:
+  - кожен бекенд має slots (скільки задач одночасно) і периодичний health-check;
+  - задача йде на вільний бекенд, де вже "гарячі" її моделі (як model_affinity,
+    але окремо для кожного бекенда), при рівності — менш завантажений;
+  - помилки зʼєднання/зависання рахуються бекенду: після max_failures поспіль він
+    виводиться з ротації до успішного health-check; інші бекенди це не блокує.
+
+Поточний бекенд привʼязується до контексту задачі (bind, contextvars), тож
+run_comfy_workflow та інші виклики Comfy беруть адресу через current() без зміни
+сигнатур runner-ів; потоки, що стартують через copy_context(), його успадковують.
+Вихідна тека (COMFY_OUTPUT_DIR) у бекендів спільна: {comfy_id}_video унікальні.
+
+Слот зайнятий, поки prompt задачі в Comfy: comfy_done() звільняє його ще до
+збереження/аплоаду. slots=2 тримає чергу ComfyUI на один prompt попереду —
+наступна задача вже стоїть у черзі, коли поточна закінчує генерацію.
+"""
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+
+import requests
+
+import http_client
+
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("comfy_lease", default=None)
+
+
+class Backend:
+    __slots__ = ("name", "http", "comfy", "slots", "in_flight", "healthy", "failures", "recent", "done", "next_check")
+
+    def __init__(self, name: str, http: str, comfy: Optional[str] = None, slots: int = 1, resident_runs: int = 1):
+        self.name = name
+        self.http = http.rstrip("/") if "://" in http else f"http://{http}"
+        self.comfy = comfy
+        self.slots = max(1, int(slots))
+        self.in_flight = 0
+        self.healthy = True  # до першого health-check вважаємо живим
+        self.failures = 0
+        self.recent = deque(maxlen=max(1, resident_runs))
+        self.done = 0
+        self.next_check = 0.0
+
+    @property
+    def resident_models(self) -> frozenset:
+        out = set()
+        for models in self.recent:
+            out |= models
+        return frozenset(out)
+
+    @property
+    def free(self) -> bool:
+        return self.healthy and self.in_flight < self.slots
+
+
+class _Lease:
+    """Слот бекенда, зайнятий задачею; held=False — Comfy вже відпрацював, іде постобробка."""
+    __slots__ = ("pool", "backend", "held", "fault")
+
+    def __init__(self, pool, backend: Backend):
+        self.pool = pool
+        self.backend = backend
+        self.held = True
+        self.fault = False
+
+
+def parse_backends(spec: str, default_comfy: Optional[str] = None, default_slots: int = 1) -> List[Backend]:
+    """
+    "127.0.0.1:3000,127.0.0.1:3001" або JSON:
+    [{"name": "gpu0", "http": "127.0.0.1:3000", "comfy": "127.0.0.1:8188", "slots": 1}, ...]
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return []
+    if spec.startswith("["):
+        items = json.loads(spec)
+    else:
+        items = [{"http": s.strip()} for s in spec.split(",") if s.strip()]
+    out = []
+    for i, item in enumerate(items):
+        out.append(Backend(
+            name=item.get("name") or f"comfy{i}",
+            http=item["http"],
+            comfy=item.get("comfy") or (default_comfy if len(items) == 1 else None),
+            slots=item.get("slots", default_slots),
+        ))
+    return out
+
+
+def is_backend_fault(exc: Optional[BaseException]) -> bool:
+    """Чи винен у помилці бекенд (а не сама задача/workflow)."""
+    if exc is None:
+        return False
+    from comfy_exec import ComfyStallError
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError, ComfyStallError))
+
+
+def current() -> Optional[Backend]:
+    """Бекенд, привʼязаний до поточної задачі (None — пул вимкнений)."""
+    lease = _CURRENT.get()
+    return lease.backend if lease else None
+
+
+def comfy_done():
+    """
+    Comfy відпрацював prompt поточної задачі: слот звільняється для наступної,
+    поки ця ще зберігає/аплоадить результат. No-op без пулу і при повторному виклику.
+    """
+    lease = _CURRENT.get()
+    if lease is not None:
+        lease.pool._free(lease)
+
+
+class BackendPool:
+    def __init__(
+        self,
+        backends: Iterable[Backend],
+        *,
+        health_path: str = "/docs",
+        health_interval: float = 15.0,
+        max_failures: int = 3,
+        log=print,
+    ):
+        self.backends = list(backends)
+        if not self.backends:
+            raise ValueError("BackendPool: порожній список бекендів")
+        self._health_path = health_path
+        self._health_interval = health_interval
+        self._max_failures = max_failures
+        self._log = log
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._health_loop, name="comfy-health", daemon=True)
+        self._thread.start()
+
+    @property
+    def capacity(self) -> int:
+        return sum(b.slots for b in self.backends)
+
+    # ---------- health ----------
+
+    def _check(self, b: Backend) -> bool:
+        try:
+            r = http_client.get(b.http + self._health_path, endpoint="comfy.health", timeout=(2, 5))
+            return r.status_code < 500
+        except Exception:
+            return False
+
+    def _health_loop(self):
+        while not self._stop.is_set():
+            now = time.time()
+            for b in self.backends:
+                if now < b.next_check:
+                    continue
+                ok = self._check(b)
+                with self._cond:
+                    if ok and not b.healthy:
+                        self._log(f"[comfy-pool] {b.name} знову доступний")
+                        b.failures = 0
+                    elif not ok and b.healthy:
+                        self._log(f"[comfy-pool] {b.name} не відповідає на health-check, виводимо з ротації")
+                    b.healthy = ok
+                    # здорові перевіряємо рідше, мертві — частіше, щоб швидко повернути
+                    b.next_check = now + (self._health_interval if ok else min(5.0, self._health_interval))
+                    self._cond.notify_all()
+            self._stop.wait(1.0)
+
+    # ---------- розподіл ----------
+
+    def wait_free(self, timeout: Optional[float] = None) -> bool:
+        """Чекає, поки хоч один бекенд матиме вільний слот."""
+        with self._cond:
+            return self._cond.wait_for(lambda: any(b.free for b in self.backends), timeout)
+
+    def acquire(self, models: Iterable[str] = (), timeout: Optional[float] = None) -> Optional[Backend]:
+        """Займає слот на найкращому вільному бекенді для цих моделей (None — таймаут)."""
+        models = frozenset(models)
+        with self._cond:
+            if not self._cond.wait_for(lambda: any(b.free for b in self.backends), timeout):
+                return None
+            b = min(
+                (b for b in self.backends if b.free),
+                key=lambda b: (len(models - b.resident_models), b.in_flight / b.slots, b.done),
+            )
+            b.in_flight += 1
+            if models:
+                b.recent.append(models)
+            return b
+
+    def _free(self, lease: _Lease):
+        with self._cond:
+            if lease.held:
+                lease.held = False
+                lease.backend.in_flight -= 1
+                self._cond.notify_all()
+
+    def _finish(self, lease: _Lease):
+        self._free(lease)
+        b = lease.backend
+        with self._cond:
+            b.done += 1
+            if lease.fault:
+                b.failures += 1
+                if b.healthy and b.failures >= self._max_failures:
+                    b.healthy = False
+                    b.next_check = time.time() + min(5.0, self._health_interval)
+                    self._log(f"[comfy-pool] {b.name}: {b.failures} збої поспіль, виводимо з ротації")
+            else:
+                b.failures = 0
+            self._cond.notify_all()
+
+    @contextmanager
+    def bind(self, b: Backend):
+        """
+        Привʼязує зайнятий через acquire() слот до задачі. Слот звільняється на comfy_done()
+        або на виході; lease.fault=True на виході — збій рахується бекенду.
+        """
+        lease = _Lease(self, b)
+        token = _CURRENT.set(lease)
+        try:
+            yield lease
+        finally:
+            _CURRENT.reset(token)
+            self._finish(lease)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                b.name: {"healthy": b.healthy, "in_flight": b.in_flight, "done": b.done, "failures": b.failures}
+                for b in self.backends
+            }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
@@ -0,0 +1,333 @@
+# comfy_stream.py
+"""
+Потоковий розбір відповіді comfyui-api /prompt.
+
+Відповідь виглядає як {"id": ..., "images": ["<base64>", ...] | [{"image": "<base64>", "filename": ...}],
+"filenames": ["..."], "stats": ...}
+і з batch-виходами або великими Qwen edit легко має сотні MB. Замість r.json()
+читаємо тіло блоками, JSON розбираємо інкрементально, а кожен base64-рядок
+декодуємо одразу у свій файл — у памʼяті тримається не більше одного блоку.
+Решта полів (id, stats, filenames, ...) маленькі і розбираються як звичайний JSON.
+"""
+import os
+import json
+import uuid
+import binascii
+from typing import Callable, Iterator, Optional
+
+import http_client
+
+BLOCK_SIZE = 1024 * 1024
+IMAGE_KEYS = ("image", "data")
+
+_ESCAPES = {
+    ord('"'): b'"', ord("\\"): b"\\", ord("/"): b"/", ord("b"): b"\b",
+    ord("f"): b"\f", ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t",
+}
+_WS = b" \t\r\n"
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF8", ".gif"),
+    (b"\x1aE\xdf\xa3", ".webm"),
+)
+
+
+class _Stream:
+    """Байтовий потік поверх iter_content з мінімальним набором операцій JSON-токенайзера."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self.buf = b""
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        while self.pos >= len(self.buf):
+            nxt = next(self._chunks, None)
+            if nxt is None:
+                return False
+            self.buf, self.pos = nxt, 0
+        return True
+
+    def _need(self):
+        if not self._fill():
+            raise ValueError("comfyui-api: обірвана JSON-відповідь")
+
+    def peek(self) -> int:
+        """Наступний не-пробільний байт (не споживає його)."""
+        while True:
+            self._need()
+            b, p, n = self.buf, self.pos, len(self.buf)
+            while p < n and b[p] in _WS:
+                p += 1
+            self.pos = p
+            if p < n:
+                return b[p]
+
+    def take(self) -> int:
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, ch: bytes):
+        c = self.take()
+        if c != ch[0]:
+            raise ValueError(f"comfyui-api: очікували {ch!r}, маємо {bytes([c])!r}")
+
+    def _byte(self) -> int:
+        self._need()
+        c = self.buf[self.pos]
+        self.pos += 1
+        return c
+
+    def string_chunks(self) -> Iterator[bytes]:
+        """Шматки рядка (вже без escape) від поточної позиції після '"' до закриваючої '"'."""
+        while True:
+            self._need()
+            b, p = self.buf, self.pos
+            q = b.find(b'"', p)
+            bs = b.find(b"\\", p, q if q != -1 else len(b))
+            if bs != -1:
+                if bs > p:
+                    yield b[p:bs]
+                self.pos = bs + 1
+                esc = self._byte()
+                if esc == ord("u"):
+                    code = bytes(self._byte() for _ in range(4))
+                    yield chr(int(code, 16)).encode("utf-8", "surrogatepass")
+                else:
+                    yield _ESCAPES.get(esc, bytes([esc]))
+                continue
+            if q == -1:
+                if p < len(b):
+                    yield b[p:]
+                self.pos = len(b)
+                continue
+            if q > p:
+                yield b[p:q]
+            self.pos = q + 1
+            return
+
+    def string(self) -> str:
+        return b"".join(self.string_chunks()).decode("utf-8", "surrogatepass")
+
+    def value(self):
+        """Довільне (невелике) JSON-значення."""
+        c = self.peek()
+        if c == ord('"'):
+            self.pos += 1
+            return self.string()
+        if c == ord("{"):
+            self.pos += 1
+            out = {}
+            for key in self.members():
+                out[key] = self.value()
+            return out
+        if c == ord("["):
+            self.pos += 1
+            return list(self.items(self.value))
+        # число / true / false / null — до найближчого роздільника
+        raw = bytearray()
+        while True:
+            self._need()
+            b, p, n = self.buf, self.pos, len(self.buf)
+            while p < n and b[p] not in b",]} \t\r\n":
+                p += 1
+            raw += b[self.pos:p]
+            self.pos = p
+            if p < n:
+                return json.loads(bytes(raw))
+
+    def members(self) -> Iterator[str]:
+        """Ключі обʼєкта (після '{'); значення споживає викликач."""
+        if self.peek() == ord("}"):
+            self.pos += 1
+            return
+        while True:
+            self.expect(b'"')
+            key = self.string()
+            self.expect(b":")
+            yield key
+            c = self.take()
+            if c == ord("}"):
+                return
+            if c != ord(","):
+                raise ValueError("comfyui-api: зламаний JSON-обʼєкт")
+
+    def items(self, read_item: Callable):
+        """Елементи масиву (після '['); read_item споживає кожен елемент."""
+        if self.peek() == ord("]"):
+            self.pos += 1
+            return
+        while True:
+            yield read_item()
+            c = self.take()
+            if c == ord("]"):
+                return
+            if c != ord(","):
+                raise ValueError("comfyui-api: зламаний JSON-масив")
+
+
+class _Base64Sink:
+    """Декодує base64 шматками кратними 4 символам; path=None — лише рахує розмір."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.size = 0
+        self.head = b""
+        self._rest = b""
+        self._started = False
+        self._f = open(path, "wb") if path else None
+
+    def write(self, chunk: bytes):
+        data = self._rest + chunk
+        if not self._started:
+            # data-URL: "data:image/png;base64,...."
+            if len(data) < 5 and b"data:".startswith(data):
+                self._rest = data
+                return
+            if data.startswith(b"data:"):
+                comma = data.find(b",")
+                if comma == -1:
+                    self._rest = data
+                    return
+                data = data[comma + 1:]
+            self._started = True
+        cut = len(data) - len(data) % 4
+        self._rest = data[cut:]
+        if cut:
+            self._emit(binascii.a2b_base64(data[:cut]))
+
+    def _emit(self, raw: bytes):
+        if len(self.head) < 16:
+            self.head += raw[:16 - len(self.head)]
+        self.size += len(raw)
+        if self._f:
+            self._f.write(raw)
+
+    def close(self):
+        try:
+            if self._rest.strip(b"="):
+                self._emit(binascii.a2b_base64(self._rest + b"=" * (-len(self._rest) % 4)))
+        finally:
+            if self._f:
+                self._f.close()
+
+    def discard(self):
+        if self._f:
+            self._f.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def _sniff_ext(head: bytes) -> Optional[str]:
+    for magic, ext in _MAGIC:
+        if head.startswith(magic):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head[4:8] == b"ftyp":
+        return ".mp4"
+    return None
+
+
+def _read_images(s: _Stream, out_dir: Optional[str], tag: str, sinks: list) -> list:
+    def read_one():
+        index = len(sinks)
+        part = os.path.join(out_dir, f".{tag}_{index}.part") if out_dir else None
+        meta = {"index": index}
+        c = s.peek()
+        if c == ord('"'):
+            s.pos += 1
+            sink = _Base64Sink(part)
+            sinks.append(sink)
+            for chunk in s.string_chunks():
+                sink.write(chunk)
+            sink.close()
+        elif c == ord("{"):
+            s.pos += 1
+            sink = None
+            for key in s.members():
+                if key in IMAGE_KEYS and sink is None and s.peek() == ord('"'):
+                    s.pos += 1
+                    sink = _Base64Sink(part)
+                    sinks.append(sink)
+                    for chunk in s.string_chunks():
+                        sink.write(chunk)
+                    sink.close()
+                else:
+                    meta[key] = s.value()
+            if sink is None:
+                sinks.append(None)
+        else:
+            sinks.append(None)
+            meta["value"] = s.value()
+        return meta
+
+    return list(s.items(read_one))
+
+
+def parse_prompt_response(chunks: Iterator[bytes], out_dir: Optional[str] = None, name_prefix: str = "comfy") -> dict:
+    """
+    Розбирає JSON-відповідь /prompt з ітератора байтових блоків.
+    Кожне зображення з "images" декодується в out_dir/{name_prefix}_{id8}[_{i}]{ext}
+    (out_dir=None — зображення пропускаються, рахується лише розмір).
+    "images" у результаті — список метаданих: {"index", "path", "size", "format", ...поля з відповіді}.
+    """
+    s = _Stream(iter(chunks))
+    tag = uuid.uuid4().hex[:8]
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    result = {}
+    metas, sinks = None, []
+    try:
+        s.expect(b"{")
+        for key in s.members():
+            if key == "images" and s.peek() == ord("["):
+                s.pos += 1
+                metas = _read_images(s, out_dir, tag, sinks)
+            else:
+                result[key] = s.value()
+    except BaseException:
+        for sink in sinks:
+            if sink is not None:
+                sink.discard()
+        raise
+
+    if metas is None:
+        return result
+
+    # comfyui-api віддає images голими base64-рядками, а імена файлів — окремим
+    # списком filenames у тому ж порядку; без них не розкласти пачку (image_batch)
+    filenames = result.get("filenames")
+    if isinstance(filenames, list):
+        for meta, name in zip(metas, filenames):
+            if isinstance(name, str):
+                meta.setdefault("filename", name)
+
+    safe_id = str(result.get("id") or tag)[:8]
+    for meta, sink in zip(metas, sinks):
+        if sink is None:
+            continue
+        ext = os.path.splitext(str(meta.get("filename") or ""))[1] or _sniff_ext(sink.head) or ".png"
+        meta["size"] = sink.size
+        meta["format"] = ext.lstrip(".")
+        if sink.path:
+            suffix = "" if meta["index"] == 0 else f"_{meta['index']}"
+            path = os.path.join(out_dir, f"{name_prefix}_{safe_id}{suffix}{ext}")
+            os.replace(sink.path, path)
+            meta["path"] = path
+    result["images"] = metas
+    return result
+
+
+def post_prompt(url: str, body: dict, *, out_dir: Optional[str], timeout, name_prefix: str = "comfy") -> dict:
+    """POST /prompt з потоковим розбором відповіді (див. parse_prompt_response)."""
+    with http_client.post(url, endpoint="comfy.prompt", json=body, timeout=timeout, stream=True) as r:
+        if r.status_code >= 400:
+            raise RuntimeError(f"comfyui-api помилка {r.status_code}: {r.text}")
+        return parse_prompt_response(r.iter_content(chunk_size=BLOCK_SIZE), out_dir, name_prefix)
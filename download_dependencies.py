@@ -1,15 +1,24 @@
 import os
+import json
 import time
 import random
+import hashlib
 import threading
 from pathlib import Path
 from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
 
 import requests
 
+import http_client
+from model_store import get_store, sha256_of
+from download_lock import single_flight
+from ranged_download import fetch_to_part, stream_to_part as _stream_to_part
+
 # ---- ComfyUI dirs (статичні) ----
 COMFYUI_DIR = "/opt/ComfyUI"
+COMFYUI_MODELS_DIR = os.path.join(COMFYUI_DIR, "models")
 COMFYUI_LORA_DIR = os.path.join(COMFYUI_DIR, "models", "loras")
 COMFYUI_CHECKPOINTS_DIR = os.path.join(COMFYUI_DIR, "models", "checkpoints")
 COMFYUI_VAE_DIR = os.path.join(COMFYUI_DIR, "models", "vae")
@@ -21,18 +30,27 @@ COMFYUI_INPUT_DIR = os.path.join(COMFYUI_DIR, "input")
 # ---- runtime config (ініціалізується з main) ----
 _API_TOKEN = None
 _DOWNLOAD_FILE_URL = None
+_FILE_MANIFEST_URL = None
 _TRAIN_DATA_DIR = None
 _LOG = None
+_CONNECTIONS = 1
 
-def init_downloader(api_token: str, download_file_url: str, train_data_dir: str, log_fn):
+def init_downloader(
+    api_token: str, download_file_url: str, train_data_dir: str, log_fn, connections: int = 1,
+    file_manifest_url: str = None,
+):
     """
     Викликати один раз при старті воркера (в main.py).
+    connections > 1 — великі файли з підтримкою Range качаються паралельно (ranged_download).
+    file_manifest_url — worker/getFileManifest для інкрементального kg7-file синку.
     """
-    global _API_TOKEN, _DOWNLOAD_FILE_URL, _TRAIN_DATA_DIR, _LOG
+    global _API_TOKEN, _DOWNLOAD_FILE_URL, _FILE_MANIFEST_URL, _TRAIN_DATA_DIR, _LOG, _CONNECTIONS
     _API_TOKEN = api_token
     _DOWNLOAD_FILE_URL = download_file_url
+    _FILE_MANIFEST_URL = file_manifest_url
     _TRAIN_DATA_DIR = train_data_dir
     _LOG = log_fn
+    _CONNECTIONS = max(1, int(connections))
 
     os.makedirs(COMFYUI_LORA_DIR, exist_ok=True)
     os.makedirs(COMFYUI_CHECKPOINTS_DIR, exist_ok=True)
@@ -74,131 +92,402 @@ def safe_basename(name: str) -> str:
         raise ValueError(f"Некоректне ім'я файлу: {name!r}")
     return base
 
-def download_simple(url: str, target_dir: str, file_name: str, *, min_size: int = 1_024) -> str:
-    Path(target_dir).mkdir(parents=True, exist_ok=True)
-    out_path = Path(target_dir) / file_name
+def _path_inside(base_dir: str, rel: str) -> Optional[str]:
+    """Абсолютний шлях rel у base_dir; None, якщо rel виходить за base_dir ("../", абсолютний шлях)."""
+    base = os.path.abspath(base_dir)
+    path = os.path.abspath(os.path.join(base, rel.replace("\\", "/")))
+    return path if path.startswith(base + os.sep) else None
+
+def _is_model_path(path) -> bool:
+    # у сховище йдуть лише моделі; input-файли задач туди не потрапляють
+    return os.path.abspath(str(path)).startswith(os.path.abspath(COMFYUI_MODELS_DIR) + os.sep)
+
+
+def _is_downloaded(out_path, min_size: int, expected_sha256=None, expected_size=None) -> bool:
+    store = get_store()
+    if store is not None and _is_model_path(out_path):
+        if store.is_present(str(out_path), sha256=expected_sha256, size=expected_size):
+            return True
+        if not out_path.exists():
+            return False
+        # старий файл поза сховищем: беремо на облік, якщо він схожий на цілий
+        try:
+            size = out_path.stat().st_size
+        except OSError:
+            return False
+        if size < min_size or (expected_size is not None and int(expected_size) != size):
+            return False
+        _LOG(f"[model-store] беремо на облік існуючий файл {out_path} ({size} байт), рахуємо sha256...")
+        sha = store.adopt(str(out_path))
+        return not expected_sha256 or expected_sha256.lower() == sha
 
     # ✅ skip if already downloaded
     if out_path.exists():
         try:
             if out_path.stat().st_size >= min_size:
-                return str(out_path)
+                return True
         except OSError:
             pass  # якщо не можемо прочитати — спробуємо перекачати
+    return False
 
-    tmp_path = out_path.with_suffix(out_path.suffix + ".part")
 
-    with requests.get(url, stream=True, timeout=60) as r:
-        r.raise_for_status()
-        with open(tmp_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+def _finish_download(tmp_path, out_path, sha: str, workflow=None, expected_sha256=None):
+    if expected_sha256 and expected_sha256.lower() != sha:
+        os.remove(tmp_path)
+        raise IOError(f"sha256 не збігся для {out_path}: {sha} != {expected_sha256}")
 
     # атомарно замінюємо
     os.replace(tmp_path, out_path)
+
+    store = get_store()
+    if store is not None and _is_model_path(out_path):
+        store.adopt(str(out_path), sha256=sha, workflow=workflow)
+
+
+def _download_url(
+    url: str, target_dir: str, file_name: str, *, endpoint: str, headers=None, min_size: int = 1_024,
+    budget=None, workflow=None, expected_sha256=None, expected_size=None,
+) -> str:
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    out_path = Path(target_dir) / file_name
+
+    if _is_downloaded(out_path, min_size, expected_sha256, expected_size):
+        return str(out_path)
+
+    # один .part — один писач: сусідній потік/контейнер чекає і бере готовий файл
+    with single_flight(out_path, log=_LOG):
+        if _is_downloaded(out_path, min_size, expected_sha256, expected_size):
+            return str(out_path)
+
+        tmp_path = out_path.with_suffix(out_path.suffix + ".part")
+        sha = fetch_to_part(
+            url, str(tmp_path), headers=headers, budget=budget, endpoint=endpoint,
+            connections=_CONNECTIONS, log=_LOG,
+        )
+        _finish_download(tmp_path, out_path, sha, workflow, expected_sha256)
     return str(out_path)
 
 
-def download_civitai(url: str, target_dir: str, file_name: str, *, min_size: int = 1_024) -> str:
+def download_simple(
+    url: str, target_dir: str, file_name: str, *, min_size: int = 1_024, budget=None,
+    workflow=None, expected_sha256=None, expected_size=None,
+) -> str:
+    return _download_url(
+        url, target_dir, file_name, endpoint="download.simple", min_size=min_size, budget=budget,
+        workflow=workflow, expected_sha256=expected_sha256, expected_size=expected_size,
+    )
+
+
+def download_civitai(
+    url: str, target_dir: str, file_name: str, *, min_size: int = 1_024, budget=None,
+    workflow=None, expected_sha256=None, expected_size=None,
+) -> str:
     api_key = os.environ.get("CIVITAI_API_KEY")
     if not api_key:
         raise RuntimeError("CIVITAI_API_KEY is not set")
 
-    Path(target_dir).mkdir(parents=True, exist_ok=True)
-    out_path = Path(target_dir) / file_name
+    headers = {"Authorization": f"Bearer {api_key}"}
 
-    # ✅ skip if already downloaded
-    if out_path.exists():
-        try:
-            if out_path.stat().st_size >= min_size:
-                return str(out_path)
-        except OSError:
-            pass
+    # Authorization requests сам знімає при редіректі на CDN іншого хоста
+    return _download_url(
+        url, target_dir, file_name, endpoint="download.civitai", headers=headers, min_size=min_size,
+        budget=budget, workflow=workflow, expected_sha256=expected_sha256, expected_size=expected_size,
+    )
 
-    tmp_path = out_path.with_suffix(out_path.suffix + ".part")
 
-    headers = {"Authorization": f"Bearer {api_key}"}
+# ------------------ KG7 бекенд downloads (через ваш API /getFile) ------------------
 
-    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
-        r.raise_for_status()
-        with open(tmp_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+class _AdaptiveConcurrency:
+    """
+    AIMD-ліміт паралельних запитів до /getFile: +1 слот після grow_after успіхів
+    поспіль, удвічі менше (і пауза на Retry-After) на 429/503.
+    """
 
-    os.replace(tmp_path, out_path)
-    return str(out_path)
+    def __init__(self, start: int, maximum: int, minimum: int = 1, grow_after: int = 4):
+        self.limit = max(minimum, min(start, maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.grow_after = grow_after
+        self.throttled = 0
+        self._active = 0
+        self._successes = 0
+        self._pause_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._pause_until - time.time()
+                if wait <= 0 and self._active < self.limit:
+                    self._active += 1
+                    return
+                self._cond.wait(max(wait, 0.05) if wait > 0 else None)
+
+    def release(self, throttled: bool = False, retry_after: float = 0.0):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(self.minimum, self.limit // 2)
+                self._successes = 0
+                self._pause_until = max(self._pause_until, time.time() + retry_after)
+            else:
+                self._successes += 1
+                if self._successes >= self.grow_after and self.limit < self.maximum:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+def _retry_after(response) -> float:
+    try:
+        return min(60.0, float(response.headers.get("Retry-After", "")))
+    except (AttributeError, TypeError, ValueError):
+        return 1.0 + random.random()
 
 
-# ------------------ KG7 бекенд downloads (через ваш API /getFile) ------------------
-def _download_one(session: requests.Session, name: str, dep_type: str) -> str:
+def _download_one(name: str, local_path: str, budget=None, expected_size=None, expected_sha256=None) -> str:
     _require_init()
 
     params = {"token": _API_TOKEN, "name": name}
-    local_path = os.path.join(dep_type, name)
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+    tmp_path = local_path + ".part"
 
-    with session.post(_DOWNLOAD_FILE_URL, params=params, timeout=600, stream=True) as r:
-        r.raise_for_status()
-        with open(local_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+    # повтори робить _fetch_kg7_files, тому тут retries=0
+    try:
+        with http_client.post(_DOWNLOAD_FILE_URL, endpoint="download.kg7File", retries=0, params=params, timeout=600, stream=True) as r:
+            r.raise_for_status()
+            sha = _stream_to_part(r, tmp_path, budget)
+        size = os.path.getsize(tmp_path)
+        if expected_size is not None and int(expected_size) != size:
+            raise IOError(f"розмір {name} не збігся: {size} != {expected_size}")
+        if expected_sha256 and expected_sha256.lower() != sha:
+            raise IOError(f"sha256 не збігся для {name}: {sha} != {expected_sha256}")
+    except BaseException:
+        # обірваний файл не лишаємо — наступна спроба почне з нуля
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
+    os.replace(tmp_path, local_path)
     return local_path
 
 
-def download_files(file_prefix, names, dep_type, max_workers=16, retries=5):
+def _fetch_kg7_files(jobs, max_workers: int, retries: int, budget=None):
     """
-    Паралельне скачування. Повертає (ok_paths, failed_names).
+    jobs: list[(full_name, local_path, expected_size, expected_sha256)].
+    Паралельність підлаштовується під 429/503 бекенда. Повертає (ok_paths, failed_names).
     """
-    _require_init()
-
-    to_download = [file_prefix + n for n in names]
+    limiter = _AdaptiveConcurrency(start=min(4, max_workers), maximum=max_workers)
     ok_paths, failed = [], []
 
-    tls = threading.local()
-
-    def worker(full_name: str) -> str:
-        if not hasattr(tls, "session"):
-            tls.session = requests.Session()
-
+    def worker(job) -> str:
+        full_name, local_path, expected_size, expected_sha256 = job
         last_err = None
         for attempt in range(retries):
+            limiter.acquire()
             try:
-                return _download_one(tls.session, full_name, dep_type)
+                path = _download_one(full_name, local_path, budget, expected_size, expected_sha256)
             except requests.HTTPError as e:
                 status = getattr(e.response, "status_code", None)
-                if status in (429, 500, 502, 503, 504):
-                    sleep_s = min(60, (2 ** attempt) + random.random())
-                    time.sleep(sleep_s)
+                if status in (429, 503):
+                    limiter.release(throttled=True, retry_after=_retry_after(e.response))
+                    last_err = e
+                    continue
+                limiter.release()
+                if status in (500, 502, 504):
+                    time.sleep(min(60, (2 ** attempt) + random.random()))
                     last_err = e
                     continue
                 raise
-            except (requests.ConnectionError, requests.Timeout) as e:
-                sleep_s = min(60, (2 ** attempt) + random.random())
-                time.sleep(sleep_s)
+            except (requests.ConnectionError, requests.Timeout, IOError) as e:
+                limiter.release()
+                time.sleep(min(60, (2 ** attempt) + random.random()))
                 last_err = e
                 continue
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.release()
+            return path
 
         raise RuntimeError(f"Failed after {retries} retries: {full_name}. Last error: {last_err}")
 
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(worker, n): n for n in to_download}
+        futures = {ex.submit(worker, job): job[0] for job in jobs}
         for fut in as_completed(futures):
             n = futures[fut]
             try:
-                p = fut.result()
-                ok_paths.append(p)
+                ok_paths.append(fut.result())
             except Exception as e:
                 failed.append(n)
                 _LOG(f"FAIL: {n}: {e}")
 
+    if limiter.throttled:
+        _LOG(f"[kg7-file] бекенд обмежував швидкість {limiter.throttled} раз(и), кінцева паралельність {limiter.limit}")
     return ok_paths, failed
 
 
-def download_lora_file(lora_name: str) -> str:
+def download_files(file_prefix, names, dep_type, max_workers=16, retries=5, budget=None):
+    """
+    Паралельне скачування. Повертає (ok_paths, failed_names).
+    max_workers — стеля; фактична паралельність адаптується до 429/503.
+    """
+    _require_init()
+
+    target_dir = _get_target_dir(dep_type)
+    jobs, failed = [], []
+    for n in names:
+        local_path = _path_inside(target_dir, file_prefix + n)
+        if local_path is None:
+            _LOG(f"[kg7-file] пропускаємо файл поза {target_dir}: {file_prefix + n!r}")
+            failed.append(n)
+            continue
+        jobs.append((file_prefix + n, local_path, None, None))
+    ok_paths, fetch_failed = _fetch_kg7_files(jobs, max_workers, retries, budget)
+    return ok_paths, failed + fetch_failed
+
+
+# ------------------ KG7 інкрементальна синхронізація датасетів ------------------
+
+def fetch_file_manifest(file_prefix: str, names=None):
+    """
+    Маніфест файлів під file_prefix: list[{"name", "size", "sha256"}] (name — без префікса).
+    None, якщо бекенд не знає getFileManifest.
+    """
+    _require_init()
+    if not _FILE_MANIFEST_URL:
+        return None
+    data = {"token": _API_TOKEN, "prefix": file_prefix}
+    if names:
+        data["names"] = json.dumps(list(names), ensure_ascii=False)
+    r = http_client.post(_FILE_MANIFEST_URL, endpoint="download.kg7Manifest", data=data, timeout=60)
+    if r.status_code in (404, 405, 501):
+        return None
+    r.raise_for_status()
+    j = r.json()
+    if not j.get("success"):
+        return None
+    return j.get("files") or []
+
+
+def _sync_state_path(file_prefix: str, target_dir: str) -> str:
+    key = hashlib.sha1(f"{os.path.abspath(target_dir)}|{file_prefix}".encode("utf-8")).hexdigest()
+    return os.path.join(_TRAIN_DATA_DIR, ".kg7-sync", key + ".json")
+
+
+def _load_sync_state(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("files") or {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sync_state(path: str, files: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _local_matches(local_path: str, known: dict, size: int, sha256) -> bool:
+    """Чи лежить на диску саме ця версія файлу. sha256 перераховується лише якщо файл змінився після синку."""
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    if not sha256:
+        return True
+    if known and known.get("mtime_ns") == st.st_mtime_ns and known.get("size") == st.st_size:
+        return known.get("sha256") == sha256.lower()
+    return sha256_of(local_path) == sha256.lower()
+
+
+def sync_files(file_prefix, names, dep_type, max_workers=16, retries=5, budget=None):
+    """
+    Інкрементальна синхронізація kg7-file набору за маніфестом бекенда:
+    качаються лише відсутні/змінені файли, файли з попереднього синку, яких
+    немає в маніфесті, видаляються. Якщо names порожній — набір задає маніфест.
+    Файли лежать у теці типу залежності (_get_target_dir), у стані — абсолютні шляхи;
+    імена з маніфесту, що виходять за цю теку, пропускаються.
+    Повертає (ok_paths, failed_names, stats) або None, якщо маніфест недоступний.
+    """
+    _require_init()
+
+    manifest = fetch_file_manifest(file_prefix, names)
+    if manifest is None:
+        return None
+
+    target_dir = os.path.abspath(_get_target_dir(dep_type))
+    wanted = {}
+    for item in manifest:
+        local_path = _path_inside(target_dir, file_prefix + str(item.get("name") or ""))
+        if local_path is None or not item.get("name"):
+            _LOG(f"[kg7-file] пропускаємо запис маніфесту поза {target_dir}: {item.get('name')!r}")
+            continue
+        wanted[local_path] = item
+
+    state_path = _sync_state_path(file_prefix, target_dir)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with single_flight(state_path, log=_LOG):
+        state = _load_sync_state(state_path)
+        new_state = {}
+        jobs, ok_paths = [], []
+        stats = {"files": len(wanted), "downloaded": 0, "bytes_downloaded": 0,
+                 "reused": 0, "bytes_saved": 0, "removed": 0, "skipped": len(manifest) - len(wanted)}
+
+        for local_path, item in wanted.items():
+            full_name = file_prefix + item["name"]
+            size = int(item["size"])
+            sha = (item.get("sha256") or "").lower() or None
+            if _local_matches(local_path, state.get(local_path), size, sha):
+                ok_paths.append(local_path)
+                stats["reused"] += 1
+                stats["bytes_saved"] += size
+                st = os.stat(local_path)
+                new_state[local_path] = {"size": size, "mtime_ns": st.st_mtime_ns, "sha256": sha}
+            else:
+                jobs.append((full_name, local_path, size, sha))
+
+        downloaded, failed = _fetch_kg7_files(jobs, max_workers, retries, budget)
+        expected = {j[1]: j for j in jobs}
+        for path in downloaded:
+            st = os.stat(path)
+            new_state[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": expected[path][3]}
+            stats["downloaded"] += 1
+            stats["bytes_downloaded"] += st.st_size
+        ok_paths.extend(downloaded)
+
+        # прибираємо лише те, що колись клали самі і що після нас ніхто не чіпав
+        for path, known in state.items():
+            if path in wanted or not os.path.isabs(path) or _path_inside(target_dir, path) != path:
+                # старий стан з відносними/чужими шляхами не видаляємо
+                continue
+            try:
+                st = os.stat(path)
+                if st.st_mtime_ns == known.get("mtime_ns") and st.st_size == known.get("size"):
+                    os.remove(path)
+                    stats["removed"] += 1
+            except OSError:
+                pass
+
+        # невдалі файли в стан не пишемо — наступний синк докачає їх
+        _save_sync_state(state_path, new_state)
+
+    _LOG(
+        f"[kg7-file] {file_prefix}: {stats['files']} файлів, завантажено {stats['downloaded']} "
+        f"({stats['bytes_downloaded'] / 1024 ** 2:.1f} MB), вже були {stats['reused']} "
+        f"(заощаджено {stats['bytes_saved'] / 1024 ** 2:.1f} MB), видалено застарілих {stats['removed']}"
+    )
+    return ok_paths, failed, stats
+
+
+def download_lora_file(lora_name: str, budget=None, workflow=None) -> str:
     """
     KG7-LoRA download через /getFile, зберігаємо в ComfyUI/models/loras
     """
@@ -207,22 +496,25 @@ def download_lora_file(lora_name: str) -> str:
     filename = safe_basename(lora_name)
     local_path = os.path.join(COMFYUI_LORA_DIR, filename)
 
-    if os.path.isfile(local_path):
+    if _is_downloaded(Path(local_path), 1):
         _LOG(f"LoRA {lora_name} вже існує: {local_path}")
         return local_path
 
     params = {"token": _API_TOKEN, "name": lora_name}
+    tmp_path = local_path + ".part"
 
-    try:
-        r = requests.post(_DOWNLOAD_FILE_URL, params=params, timeout=600, stream=True)
-        r.raise_for_status()
-    except Exception as e:
-        raise RuntimeError(f"Не вдалося завантажити LoRA {lora_name}: {e}")
+    with single_flight(local_path, log=_LOG):
+        if _is_downloaded(Path(local_path), 1):
+            _LOG(f"LoRA {lora_name} вже завантажив інший процес: {local_path}")
+            return local_path
+        try:
+            with http_client.post(_DOWNLOAD_FILE_URL, endpoint="download.kg7Lora", params=params, timeout=600, stream=True) as r:
+                r.raise_for_status()
+                sha = _stream_to_part(r, tmp_path, budget, chunk_size=1024 * 1024)
+        except Exception as e:
+            raise RuntimeError(f"Не вдалося завантажити LoRA {lora_name}: {e}")
 
-    with open(local_path, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+        _finish_download(tmp_path, local_path, sha, workflow)
 
     _LOG(f"LoRA {lora_name} збережено в {local_path}")
     return local_path
@@ -238,12 +530,16 @@ def download_lora_files(loras) -> str:
 
 # ------------------ main dependency router ------------------
 
-def download_dependencies(dependency: list):
+def download_dependencies(dependency: list, budget=None, task_id=None, workflow=None):
     """
-    dependency: list[dict] з url/url_type/type/files
+    dependency: list[dict] з url/url_type/type/files (+ опційно sha256/size для перевірки)
+    budget: опційний обмежувач (prefetch.TransferBudget) — викликається на кожен chunk
+    task_id: якщо увімкнене сховище моделей — файли закріплюються за задачею до release_task_models
+    workflow: workflow_key, записується в manifest сховища
     """
     _require_init()
 
+    model_paths = []
     dependency = dependency or []
     for dep in dependency:
         if not isinstance(dep, dict):
@@ -254,6 +550,7 @@ def download_dependencies(dependency: list):
         dep_type = dep.get("type")  # loras / checkpoints
         files = dep.get("files") or []
         file_name = dep.get("file_name")
+        expected = {"expected_sha256": dep.get("sha256"), "expected_size": dep.get("size")}
 
         if not url or not dep_type:
             continue
@@ -262,17 +559,47 @@ def download_dependencies(dependency: list):
 
         target_dir = _get_target_dir(dep_type)
 
+        path = None
         if url_type == "simple":
-            download_simple(url, target_dir, file_name)
+            path = download_simple(url, target_dir, file_name, budget=budget, workflow=workflow, **expected)
 
         elif url_type == "civitai":
-            download_civitai(url, target_dir, file_name)
+            path = download_civitai(url, target_dir, file_name, budget=budget, workflow=workflow, **expected)
 
         elif url_type == "kg7-lora":
-            download_lora_file(url)
+            path = download_lora_file(url, budget=budget, workflow=workflow)
 
         elif url_type == "kg7-file":
-            download_files(url, files, dep_type)
+            synced = sync_files(url, files, dep_type, budget=budget)
+            if synced is None:
+                # старий бекенд без маніфесту — качаємо весь список, як раніше
+                _, failed = download_files(url, files, dep_type, budget=budget)
+            else:
+                _, failed, _ = synced
+            if failed and budget is not None:
+                # у фоновому режимі неповний набір файлів не можна вважати готовим
+                raise RuntimeError(f"kg7-file: не завантажено {len(failed)} файлів з {url}")
 
         else:
-            raise ValueError(f"Unknown url_type: {url_type}")
\ No newline at end of file
+            raise ValueError(f"Unknown url_type: {url_type}")
+
+        if path and _is_model_path(path):
+            model_paths.append(path)
+            store = get_store()
+            if store is not None:
+                # закріплюємо одразу, щоб витіснення наступного файлу не зачепило попередній
+                store.touch([path], workflow)
+                if task_id is not None:
+                    store.pin(task_id, [path])
+
+    store = get_store()
+    if store is not None and model_paths:
+        store.enforce_budget()
+    return model_paths
+
+
+def release_task_models(task_id):
+    """Знімає закріплення файлів задачі — після цього їх можна витісняти."""
+    store = get_store()
+    if store is not None:
+        store.unpin(task_id)
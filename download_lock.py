@@ -0,0 +1,186 @@
+# download_lock.py
+"""
+Single-flight для завантажень: один файл качає лише один процес/потік.
+
+Кілька контейнерів на спільному /workspace/ComfyUI/models (або дві залежності
+з однаковим file_name в одній задачі) інакше пишуть той самий .part одночасно.
+
+Блокування — файл <out>.lock, створений через O_CREAT|O_EXCL (працює і на
+мережевих томах, де flock ненадійний). Власник раз на HEARTBEAT_SEC оновлює
+mtime lock-файлу; решта чекає і після звільнення перевіряє, чи файл уже є.
+Lock вважається "мертвим", якщо heartbeat старший за stale_sec або процес-власник
+на цьому ж хості вже не існує — тоді його забирає наступний.
+Всередині процесу потоки спершу серіалізуються на звичайному threading.Lock.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from contextlib import contextmanager
+
+STALE_SEC = 120
+HEARTBEAT_SEC = 15
+POLL_SEC = 1.0
+
+_HOST = socket.gethostname()
+_LOCAL = {}
+_LOCAL_GUARD = threading.Lock()
+
+
+class DownloadLockTimeout(TimeoutError):
+    pass
+
+
+def _local_lock(path: str):
+    with _LOCAL_GUARD:
+        entry = _LOCAL.get(path)
+        if entry is None:
+            entry = _LOCAL[path] = [threading.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _local_release(path: str):
+    with _LOCAL_GUARD:
+        entry = _LOCAL.get(path)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                _LOCAL.pop(path, None)
+
+
+def _read_owner(lock_path: str):
+    try:
+        with open(lock_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError, TypeError):
+        return True
+    return True
+
+
+def _is_stale(lock_path: str, owner, stale_sec: float) -> bool:
+    try:
+        age = time.time() - os.stat(lock_path).st_mtime
+    except FileNotFoundError:
+        return False
+    if owner and owner.get("host") == _HOST and not _pid_alive(owner.get("pid")):
+        return True
+    # owner=None: lock-файл ще дописується або битий — судимо лише за віком
+    return age > stale_sec
+
+
+def _try_create(lock_path: str, token: str) -> bool:
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"host": _HOST, "pid": os.getpid(), "token": token, "since": time.time()}, f)
+    return True
+
+
+def _take_over(lock_path: str, stale_owner) -> bool:
+    """
+    Прибирає мертвий lock. Перейменування атомарне; якщо між перевіркою і rename
+    lock встиг забрати хтось інший — повертаємо його на місце.
+    """
+    aside = f"{lock_path}.stale-{uuid.uuid4().hex[:8]}"
+    try:
+        os.rename(lock_path, aside)
+    except FileNotFoundError:
+        return False
+    moved = _read_owner(aside)
+    expected = (stale_owner or {}).get("token")
+    if moved is not None and moved.get("token") != expected:
+        try:
+            os.link(aside, lock_path)
+        except OSError:
+            pass
+    try:
+        os.remove(aside)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+class _Heartbeat(threading.Thread):
+    def __init__(self, lock_path: str, token: str, log):
+        super().__init__(name="download-lock-heartbeat", daemon=True)
+        self._lock_path = lock_path
+        self._token = token
+        self._log = log
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(HEARTBEAT_SEC):
+            owner = _read_owner(self._lock_path)
+            if not owner or owner.get("token") != self._token:
+                self._log(f"[download-lock] {self._lock_path} забрав інший процес")
+                return
+            try:
+                os.utime(self._lock_path)
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+
+
+@contextmanager
+def single_flight(out_path, *, stale_sec: float = STALE_SEC, timeout: float = 0, log=print):
+    """
+    with single_flight(out_path):
+        if вже_є(out_path): return
+        ...качаємо...
+
+    Після входу треба ще раз перевірити наявність файлу: поки ми чекали,
+    його міг завантажити інший процес. timeout=0 — чекати без обмеження.
+    """
+    out_path = os.path.abspath(str(out_path))
+    lock_path = out_path + ".lock"
+    token = uuid.uuid4().hex
+    local = _local_lock(out_path)
+    deadline = time.time() + timeout if timeout else None
+
+    local.acquire()
+    heartbeat = None
+    try:
+        waited = False
+        while not _try_create(lock_path, token):
+            owner = _read_owner(lock_path)
+            if _is_stale(lock_path, owner, stale_sec):
+                log(f"[download-lock] забираємо завислий lock {lock_path} (власник: {owner})")
+                _take_over(lock_path, owner)
+                continue
+            if not waited:
+                log(f"[download-lock] {os.path.basename(out_path)} вже качає {owner}, чекаємо")
+                waited = True
+            if deadline and time.time() > deadline:
+                raise DownloadLockTimeout(f"не дочекались lock {lock_path}")
+            time.sleep(POLL_SEC)
+
+        heartbeat = _Heartbeat(lock_path, token, log)
+        heartbeat.start()
+        yield
+    finally:
+        if heartbeat is not None:
+            heartbeat.stop()
+            owner = _read_owner(lock_path)
+            if owner and owner.get("token") == token:
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+        local.release()
+        _local_release(out_path)
@@ -0,0 +1,101 @@
+# handoff.py
+"""
+Передача готових результатів Comfy з COMFY_OUTPUT_DIR у TMP_DIR без копіювання.
+
+Порядок спроб:
+  1. hardlink  — той самий файл під другим імʼям (одна ФС), 0 байт запису;
+  2. reflink   — FICLONE (btrfs/xfs/overlay на них): copy-on-write, миттєво;
+  3. rename    — лише якщо джерело наше (consume=True), напр. наш merged.mp4;
+  4. copy      — останній варіант, sha256 рахується по дорозі (hash_cache).
+
+Для 1–3 відомий хеш джерела переноситься в кеш для нового шляху, тож
+upload_chunked не перечитує файл.
+
+Після підтвердженого аплоаду release_comfy_output() прибирає {comfy_id}_video
+згідно з COMFY_OUTPUT_RETENTION.
+"""
+import os
+import errno
+import shutil
+import fcntl
+from typing import Tuple
+
+from hash_cache import copy_with_sha256, lookup, remember
+
+COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR") or "/opt/ComfyUI/output"
+TMP_DIR = os.environ.get("TMP_DIR") or "/tmp/comfy_worker"
+# delete — прибрати {comfy_id}_video після підтвердженого аплоаду; keep — не чіпати
+COMFY_OUTPUT_RETENTION = os.environ.get("COMFY_OUTPUT_RETENTION", "delete")
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+
+# помилки, після яких має сенс пробувати наступний спосіб
+_FALLBACK_ERRNOS = {
+    errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    errno.EMLINK, errno.ENOSYS, errno.EACCES,
+}
+
+
+def _reflink(src: str, dst: str):
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dfd, FICLONE, sfd)
+        except OSError:
+            os.close(dfd)
+            os.remove(dst)
+            raise
+        os.close(dfd)
+        shutil.copystat(src, dst)
+    finally:
+        os.close(sfd)
+
+
+def hand_off(src: str, dst: str, *, consume: bool = False) -> Tuple[str, str]:
+    """
+    Робить dst з вмістом src найдешевшим доступним способом.
+    Повертає (dst, method), method in {"hardlink", "reflink", "rename", "copy"}.
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    sha = lookup(src)
+
+    attempts = [("hardlink", os.link), ("reflink", _reflink)]
+    if consume:
+        attempts.append(("rename", os.rename))
+    for method, fn in attempts:
+        try:
+            fn(src, dst)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            continue
+        if sha:
+            remember(dst, sha)
+        return dst, method
+
+    copy_with_sha256(src, dst)
+    if consume:
+        os.remove(src)
+    return dst, "copy"
+
+
+def release_comfy_output(comfy_id: str, log=print) -> bool:
+    """Прибирає COMFY_OUTPUT_DIR/{comfy_id}_video (викликати лише після підтвердженого аплоаду)."""
+    if not comfy_id or COMFY_OUTPUT_RETENTION == "keep":
+        return False
+    out_dir = os.path.join(COMFY_OUTPUT_DIR, f"{comfy_id}_video")
+    # захист від "../" у comfy_id
+    if os.path.dirname(os.path.abspath(out_dir)) != os.path.abspath(COMFY_OUTPUT_DIR):
+        return False
+    if not os.path.isdir(out_dir):
+        return False
+    try:
+        shutil.rmtree(out_dir)
+    except OSError as e:
+        log(f"[handoff] не вдалось прибрати {out_dir}: {e}")
+        return False
+    log(f"[handoff] прибрано {out_dir}")
+    return True
@@ -0,0 +1,219 @@
+# hash_cache.py
+"""
+sha256 файлів без повторного читання.
+
+Кеш ключується (path, size, mtime_ns, inode): будь-яка зміна файлу дає новий
+ключ, тож застарілий хеш не повернеться. Окрім памʼяті, записи лежать по
+одному файлу в CACHE_DIR — після рестарту воркера (докачування upload_chunked)
+великий файл не читається вдруге. Памʼять — LRU на MEM_ENTRIES ключів; файли кешу
+(хеш + ключ) prune() видаляє, коли джерело зникло/змінилося або запис старший
+за MAX_AGE_DAYS: при старті воркера і у фоні кожні PRUNE_EVERY нових записів.
+
+copy_with_sha256 — для кроків, де ми самі пишемо файл (копія результату Comfy
+в TMP_DIR): хеш рахується з тих самих буферів, що йдуть у запис.
+
+prehash — для файлів, які пише ffmpeg (склеєне відео): MP4 з moov у кінці не
+можна хешувати з pipe, бо ffmpeg наприкінці повертається на початок файлу і
+дописує розмір mdat. Тому хеш стартує у фоні одразу після виходу ffmpeg, поки
+файл ще в page cache, паралельно з рештою постобробки; sha256_file того ж файлу
+(upload_chunked) чекає цей підрахунок, а не читає файл вдруге.
+"""
+import os
+import mmap
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+TMP_DIR = os.environ.get("TMP_DIR") or "/tmp/comfy_worker"
+CACHE_DIR = os.path.join(TMP_DIR, ".sha256")
+BUF_SIZE = 8 * 1024 * 1024
+MEM_ENTRIES = 512
+MAX_AGE_DAYS = float(os.environ.get("HASH_CACHE_MAX_AGE_DAYS", "7"))
+PRUNE_EVERY = 500
+
+_MEM = OrderedDict()  # key -> sha, LRU
+_PENDING = {}  # key -> Future з хешем, що рахується у фоні (prehash)
+_LOCK = threading.Lock()
+_WRITES = 0
+
+
+def _key(path: str, st: os.stat_result) -> str:
+    return f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{st.st_ino}"
+
+
+def _disk_name(key: str) -> str:
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def _mem_put(key: str, sha: str):
+    # викликати під _LOCK
+    _MEM[key] = sha
+    _MEM.move_to_end(key)
+    while len(_MEM) > MEM_ENTRIES:
+        _MEM.popitem(last=False)
+
+
+def _read_entry(name: str):
+    """(sha, key) з файлу кешу; key None — запис старого формату (лише хеш)."""
+    with open(name, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    sha = lines[0].strip() if lines else ""
+    return sha, (lines[1] if len(lines) > 1 else None)
+
+
+def lookup(path: str) -> Optional[str]:
+    try:
+        key = _key(path, os.stat(path))
+    except OSError:
+        return None
+    with _LOCK:
+        sha = _MEM.get(key)
+        if sha:
+            _MEM.move_to_end(key)
+            return sha
+    try:
+        sha, _ = _read_entry(_disk_name(key))
+    except (OSError, ValueError):
+        return None
+    if len(sha) != 64:
+        return None
+    with _LOCK:
+        _mem_put(key, sha)
+    return sha
+
+
+def remember(path: str, sha: str):
+    """Записує хеш для поточного стану файлу (викликати після закриття файлу)."""
+    global _WRITES
+    key = _key(path, os.stat(path))
+    with _LOCK:
+        _mem_put(key, sha)
+        _WRITES += 1
+        prune_now = _WRITES % PRUNE_EVERY == 0
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = _disk_name(key) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(f"{sha}\n{key}")
+        os.replace(tmp, _disk_name(key))
+    except OSError:
+        pass  # диск кешу — лише оптимізація
+    if prune_now:
+        threading.Thread(target=prune, name="hash-cache-prune", daemon=True).start()
+
+
+def _entry_live(key: str) -> bool:
+    path = key.rsplit("|", 3)[0]
+    try:
+        return _key(path, os.stat(path)) == key
+    except OSError:
+        return False
+
+
+def prune(max_age_days: Optional[float] = None) -> int:
+    """
+    Видаляє файли кешу, чиє джерело зникло чи змінилося або старші за max_age_days
+    (None — MAX_AGE_DAYS). Повертає кількість видалених.
+    """
+    max_age = (MAX_AGE_DAYS if max_age_days is None else max_age_days) * 86400
+    now = time.time()
+    removed = 0
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return 0
+    for name in names:
+        full = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.stat(full).st_mtime > max_age:
+                stale = True
+            else:
+                _, key = _read_entry(full)
+                # старий формат без ключа живе до max_age
+                stale = key is not None and not _entry_live(key)
+            if stale:
+                os.remove(full)
+                removed += 1
+        except (OSError, ValueError):
+            continue
+    return removed
+
+
+def sha256_file(path: str) -> str:
+    sha = lookup(path)
+    if sha:
+        return sha
+    try:
+        key = _key(path, os.stat(path))
+    except OSError:
+        key = None
+    with _LOCK:
+        pending = _PENDING.get(key)
+    if pending is not None:
+        return pending.result()
+    return _sha256_read(path)
+
+
+def _sha256_read(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                try:
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                except (AttributeError, OSError):
+                    pass
+                view = memoryview(mm)
+                try:
+                    for off in range(0, len(mm), BUF_SIZE):
+                        h.update(view[off:off + BUF_SIZE])
+                finally:
+                    view.release()
+    sha = h.hexdigest()
+    remember(path, sha)
+    return sha
+
+
+def prehash(path: str, log=None) -> Future:
+    """Рахує sha256 файлу у фоновому потоці; результат потрапляє в кеш."""
+    key = _key(path, os.stat(path))
+    with _LOCK:
+        fut = _PENDING.get(key)
+        if fut is not None:
+            return fut
+        fut = _PENDING[key] = Future()
+
+    def run():
+        try:
+            fut.set_result(lookup(path) or _sha256_read(path))
+        except BaseException as e:
+            if log:
+                log(f"[hash] prehash {path}: {e}")
+            fut.set_exception(e)
+        finally:
+            with _LOCK:
+                _PENDING.pop(key, None)
+
+    threading.Thread(target=run, name="prehash", daemon=True).start()
+    return fut
+
+
+def copy_with_sha256(src: str, dst: str) -> str:
+    """Копіює src -> dst, рахуючи sha256 по дорозі; обидва файли потрапляють у кеш."""
+    h = hashlib.sha256()
+    buf = bytearray(BUF_SIZE)
+    view = memoryview(buf)
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while True:
+            n = fin.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            fout.write(view[:n])
+    sha = h.hexdigest()
+    remember(dst, sha)
+    remember(src, sha)
+    return sha
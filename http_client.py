@@ -0,0 +1,221 @@
+# http_client.py
+"""
+Спільний HTTP-клієнт воркера.
+
+Замість голих requests.post/get (новий TCP+TLS handshake на кожен виклик)
+тримаємо по одній keep-alive сесії з пулом зʼєднань на кожен хост
+(API_BASE, comfyui-api, Civitai/HF, ...). Таймаути і retry/backoff задаються
+політикою ендпоінта; для кожного ендпоінта збираємо метрики латентності,
+а для пулів — скільки запитів пішло повторно використаним зʼєднанням.
+"""
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_MAXSIZE = 32        # паралельні зʼєднання на хост (download_files качає в 16 потоків)
+
+
+class Policy:
+    __slots__ = ("timeout", "retries", "retry_statuses", "backoff_base", "backoff_max")
+
+    def __init__(self, timeout, retries=0, retry_statuses=(), backoff_base=1.0, backoff_max=30.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_statuses = tuple(retry_statuses)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+
+# політика обирається за префіксом імені ендпоінта до першої крапки: "api.getTask" -> "api"
+POLICIES = {
+    # task API: короткі таймаути; повтор на помилках зʼєднання і 502-504 (getTask/updateTask ідемпотентні або з lease)
+    "api": Policy(timeout=(5, 15), retries=2, retry_statuses=(502, 503, 504)),
+    # comfyui-api тримає запит до кінця генерації — таймаут задає викликач, без повторів
+    "comfy": Policy(timeout=(5, 600), retries=0),
+    # аплоади мають власний retry з урахуванням offset
+    "upload": Policy(timeout=(10, 120), retries=0),
+    # моделі / файли: повтор на обриві зʼєднання і 429/5xx
+    "download": Policy(timeout=(10, 60), retries=3, retry_statuses=(429, 500, 502, 503, 504), backoff_base=2.0, backoff_max=60.0),
+    "default": Policy(timeout=(10, 60), retries=0),
+}
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+
+
+class _EndpointStats:
+    __slots__ = ("count", "errors", "retries", "total_sec", "max_sec")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+
+def _host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def session_for(url: str) -> requests.Session:
+    """Keep-alive сесія для хоста з url (одна на весь процес, потокобезпечна на рівні пулу)."""
+    key = _host_key(url)
+    s = _SESSIONS.get(key)
+    if s is not None:
+        return s
+    with _SESSIONS_LOCK:
+        s = _SESSIONS.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _SESSIONS[key] = s
+    return s
+
+
+def _policy(endpoint: str) -> Policy:
+    return POLICIES.get(endpoint.split(".", 1)[0]) or POLICIES["default"]
+
+
+def _record(endpoint: str, elapsed: float, error: bool = False, retry: bool = False):
+    with _METRICS_LOCK:
+        st = _METRICS.get(endpoint)
+        if st is None:
+            st = _METRICS[endpoint] = _EndpointStats()
+        if retry:
+            st.retries += 1
+            return
+        st.count += 1
+        st.total_sec += elapsed
+        if elapsed > st.max_sec:
+            st.max_sec = elapsed
+        if error:
+            st.errors += 1
+
+
+def _replayable(kwargs) -> bool:
+    # тіло з файлу/генератора вже вичитане — повторювати такий запит не можна
+    if kwargs.get("files"):
+        return False
+    data = kwargs.get("data")
+    return data is None or isinstance(data, (bytes, bytearray, memoryview, str, dict, list, tuple))
+
+
+def _sleep_backoff(policy: Policy, attempt: int):
+    time.sleep(min(policy.backoff_max, policy.backoff_base * (2 ** attempt)) + random.random())
+
+
+def request(method: str, url: str, *, endpoint: str = "default", retries=None, **kwargs) -> requests.Response:
+    """
+    requests.request через спільну сесію хоста.
+    timeout береться з політики ендпоінта, якщо викликач не передав свій.
+    Повтор — лише на помилках зʼєднання і на retry_statuses політики;
+    retries=N перекриває політику (напр. 0, якщо викликач має власний цикл повторів).
+    """
+    policy = _policy(endpoint)
+    kwargs.setdefault("timeout", policy.timeout)
+    session = session_for(url)
+    if retries is None:
+        retries = policy.retries
+    if not _replayable(kwargs):
+        retries = 0
+
+    attempt = 0
+    while True:
+        t0 = time.monotonic()
+        try:
+            r = session.request(method, url, **kwargs)
+        except requests.ConnectionError:
+            # ReadTimeout сюди не потрапляє: сервер міг уже виконати запит
+            _record(endpoint, time.monotonic() - t0, error=True)
+            if attempt >= retries:
+                raise
+            _record(endpoint, 0, retry=True)
+            _sleep_backoff(policy, attempt)
+            attempt += 1
+            continue
+        except Exception:
+            _record(endpoint, time.monotonic() - t0, error=True)
+            raise
+
+        elapsed = time.monotonic() - t0
+        if r.status_code in policy.retry_statuses and attempt < retries:
+            _record(endpoint, elapsed, error=True)
+            _record(endpoint, 0, retry=True)
+            r.close()
+            _sleep_backoff(policy, attempt)
+            attempt += 1
+            continue
+
+        _record(endpoint, elapsed, error=r.status_code >= 400)
+        return r
+
+
+def get(url: str, *, endpoint: str = "default", **kwargs) -> requests.Response:
+    return request("GET", url, endpoint=endpoint, **kwargs)
+
+
+def post(url: str, *, endpoint: str = "default", **kwargs) -> requests.Response:
+    return request("POST", url, endpoint=endpoint, **kwargs)
+
+
+# ------------------ метрики ------------------
+
+def _pool_stats():
+    out = {}
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.items())
+    for host, s in sessions:
+        created = 0
+        requests_sent = 0
+        for adapter in set(s.adapters.values()):
+            pm = getattr(adapter, "poolmanager", None)
+            if pm is None:
+                continue
+            for key in list(pm.pools.keys()):
+                pool = pm.pools.get(key)
+                if pool is None:
+                    continue
+                created += getattr(pool, "num_connections", 0)
+                requests_sent += getattr(pool, "num_requests", 0)
+        out[host] = {
+            "requests": requests_sent,
+            "new_connections": created,
+            "reused": max(0, requests_sent - created),
+        }
+    return out
+
+
+def metrics_snapshot() -> dict:
+    with _METRICS_LOCK:
+        endpoints = {
+            name: {
+                "count": st.count,
+                "errors": st.errors,
+                "retries": st.retries,
+                "avg_ms": round(st.total_sec / st.count * 1000, 1) if st.count else 0.0,
+                "max_ms": round(st.max_sec * 1000, 1),
+            }
+            for name, st in _METRICS.items()
+        }
+    return {"endpoints": endpoints, "pools": _pool_stats()}
+
+
+def log_metrics(log):
+    snap = metrics_snapshot()
+    for host, p in snap["pools"].items():
+        log(f"[http] {host}: {p['requests']} запитів, {p['new_connections']} нових зʼєднань, reused={p['reused']}")
+    for name, e in sorted(snap["endpoints"].items()):
+        log(
+            f"[http] {name}: n={e['count']} err={e['errors']} retry={e['retries']} "
+            f"avg={e['avg_ms']}ms max={e['max_ms']}ms"
+        )
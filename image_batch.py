@@ -0,0 +1,313 @@
+# image_batch.py
+"""
+Пакетний запуск сумісних image-задач (lora_image/lora_test) одним prompt.
+
+Задачі з одним workflow_key, тими ж моделями і тим самим набором LoRA
+відрізняються лише prompt/seed/розмірами. Замість окремого /prompt на кожну
+зводимо їхні графи в один:
+  - кожна задача — окрема гілка (id вузлів з префіксом b{i}_);
+  - однакові вузли (class_type + inputs після перейменування посилань) спільні:
+    loader-и, LoRA, однаковий negative prompt виконуються один раз;
+  - вихідні вузли ніколи не спільні: filename_prefix отримує мітку "{tag}-{i}-",
+    тож кожне зображення повертається до своєї задачі за node id (WS) або
+    за імʼям файлу (comfyui-api).
+
+ImageBatcher збирає пачку: перша задача + сумісні, що прийдуть протягом
+max_wait секунд (не більше max_batch); несумісні відкладаються і віддаються
+наступними через next_task().
+
+chain_workflows — те саме зведення для ланцюжка ітерацій frame_qwen: вхід
+"попереднє зображення" кроку k підключається прямо до виходу кроку k-1,
+тож увесь ланцюжок — один prompt без PNG туди-назад між кроками.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from model_affinity import models_in_workflow
+
+BATCH_TYPES = ("lora_image", "lora_test")
+
+
+def _is_link(v) -> bool:
+    return isinstance(v, list) and len(v) == 2 and isinstance(v[0], str) and isinstance(v[1], int)
+
+
+def batch_signature(workflow: dict) -> tuple:
+    """Що має збігатися, щоб задачі мали сенс виконувати разом: моделі + стек LoRA."""
+    loras = set()
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        for k, v in inputs.items():
+            if k.startswith("lora_name") and isinstance(v, str):
+                loras.add(f"{node.get('class_type')}:{v}:{inputs.get('strength_model')}:{inputs.get('strength_clip')}")
+    return tuple(sorted(models_in_workflow(workflow))), tuple(sorted(loras))
+
+
+def _branch_prefix(prefix, tag: str, index: int) -> str:
+    head, base = os.path.split(str(prefix or "ComfyUI"))
+    return os.path.join(head, f"{tag}-{index}-{base}") if head else f"{tag}-{index}-{base}"
+
+
+class MergedBatch:
+    """Зведений workflow + які вихідні вузли належать якій задачі."""
+
+    def __init__(self, workflow: dict, sinks: List[set], tag: str, shared: int):
+        self.workflow = workflow
+        self.sinks = sinks
+        self.tag = tag
+        self.shared = shared  # скільки вузлів не продубльовано
+
+    def _branch_of(self, image: dict) -> Optional[int]:
+        node = image.get("node")
+        if node is not None:
+            for i, ids in enumerate(self.sinks):
+                if str(node) in ids:
+                    return i
+            return None
+        name = os.path.basename(str(image.get("filename") or ""))
+        m = re.match(re.escape(self.tag) + r"-(\d+)-", name)
+        if m and int(m.group(1)) < len(self.sinks):
+            return int(m.group(1))
+        return None
+
+    def route(self, images: List[dict]) -> Optional[List[List[dict]]]:
+        """
+        Розкладає зображення результату по задачах (порядок як у merge_workflows).
+        None — хоч одне зображення не вдалося віднести (немає ні node, ні filename).
+        """
+        groups: List[List[dict]] = [[] for _ in self.sinks]
+        live = [i for i, ids in enumerate(self.sinks) if ids]
+        if len(live) == 1:
+            # вихід лише в однієї гілки — розкладати нічого
+            groups[live[0]] = list(images)
+            return groups
+        for image in images:
+            i = self._branch_of(image)
+            if i is None:
+                return None
+            groups[i].append(image)
+        return groups
+
+
+def merge_workflows(workflows: List[dict], tag: Optional[str] = None) -> MergedBatch:
+    tag = tag or uuid.uuid4().hex[:8]
+    merged: Dict[str, dict] = {}
+    canon: Dict[str, str] = {}
+    sinks: List[set] = []
+    shared = 0
+
+    for i, wf in enumerate(workflows):
+        referenced = {
+            v[0]
+            for node in wf.values() if isinstance(node, dict)
+            for v in (node.get("inputs") or {}).values() if _is_link(v)
+        }
+        ids: Dict[str, str] = {}
+
+        def place(nid: str, path=()) -> str:
+            nonlocal shared
+            if nid in ids:
+                return ids[nid]
+            if nid in path:
+                raise ValueError(f"Цикл у workflow на вузлі {nid}")
+            node = wf[nid]
+            inputs = {}
+            for k, v in (node.get("inputs") or {}).items():
+                if _is_link(v) and v[0] in wf:
+                    v = [place(v[0], path + (nid,)), v[1]]
+                inputs[k] = v
+            out = dict(node, inputs=inputs)
+
+            new_id = f"b{i}_{nid}"
+            if nid in referenced:
+                key = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+                if key in canon:
+                    new_id = canon[key]
+                    shared += 1
+                else:
+                    canon[key] = new_id
+                    merged[new_id] = out
+            else:
+                # вихідний вузол гілки: не спільний і з міткою задачі в імені файлу
+                if "filename_prefix" in inputs:
+                    inputs["filename_prefix"] = _branch_prefix(inputs["filename_prefix"], tag, i)
+                merged[new_id] = out
+            ids[nid] = new_id
+            return new_id
+
+        for nid, node in wf.items():
+            if isinstance(node, dict):
+                place(nid)
+        sinks.append({ids[n] for n in ids if n not in referenced})
+
+    return MergedBatch(merged, sinks, tag, shared)
+
+
+# ------------------ ланцюжок ітерацій ------------------
+
+PREV_IMAGE = "\u0000prev_image:"
+
+
+def prev_image_marker(step: int) -> str:
+    """Значення для входу "зображення попереднього кроку" у workflow кроку step."""
+    return f"{PREV_IMAGE}{step}"
+
+
+def chain_workflows(steps: List[dict], keep_outputs: bool = False, tag: Optional[str] = None) -> MergedBatch:
+    """
+    Зводить кроки в один граф: вузол, у вхід якого підставлено prev_image_marker(k)
+    (LoadImage з itr_first_image), прибирається, а його IMAGE-вихід замінюється
+    зображенням, що йде у вихідний вузол кроку k-1. keep_outputs=False — зберігається
+    лише вихід останнього кроку. ValueError — ланцюжок так не розгортається.
+    """
+    batch = merge_workflows(steps, tag)
+    wf = batch.workflow
+
+    sources = []
+    for ids in batch.sinks:
+        links = [wf[nid]["inputs"].get("images") for nid in sorted(ids)]
+        sources.append(next((l for l in links if _is_link(l)), None))
+
+    for k in range(1, len(steps)):
+        marker = prev_image_marker(k)
+        loaders = {
+            nid for nid, node in wf.items()
+            if any(isinstance(v, str) and marker in v for v in node["inputs"].values())
+        }
+        if not loaders:
+            continue
+        if sources[k - 1] is None:
+            raise ValueError(f"крок {k - 1} не має вихідного зображення для кроку {k}")
+        for nid in loaders:
+            del wf[nid]
+        for node in wf.values():
+            inputs = node["inputs"]
+            for key, v in inputs.items():
+                if _is_link(v) and v[0] in loaders:
+                    if v[1] != 0:
+                        raise ValueError(f"крок {k} використовує вихід {v[1]} завантажувача попереднього зображення")
+                    inputs[key] = list(sources[k - 1])
+
+    if not keep_outputs:
+        for ids in batch.sinks[:-1]:
+            for nid in ids:
+                wf.pop(nid, None)
+            ids.clear()
+    return batch
+
+
+class _Held:
+    __slots__ = ("task", "key")
+
+    def __init__(self, task, key):
+        self.task = task
+        self.key = key
+
+
+class ImageBatcher:
+    """
+    next_task() — спершу відкладені задачі, далі get_task().
+    collect(task) — пачка з task і сумісних з нею (той самий batch_key).
+    """
+
+    def __init__(
+        self,
+        *,
+        get_task,
+        batch_key,
+        max_batch: int = 4,
+        max_wait: float = 2.0,
+        poll_sec: float = 0.2,
+        lease_check=None,
+        log=print,
+    ):
+        self._get_task = get_task
+        # lease_check(tasks) -> задачі, які ще можна стартувати (task_api.filter_leased)
+        self._lease_check = lease_check
+        self._batch_key = batch_key
+        self._max_batch = max(1, max_batch)
+        self._max_wait = max(0.0, max_wait)
+        self._poll_sec = poll_sec
+        self._held = deque()
+        self._lock = threading.Lock()
+        self._log = log
+
+        self.batches = 0
+        self.batched_tasks = 0
+
+    def _key(self, task):
+        if task.get("type") not in BATCH_TYPES:
+            return None
+        try:
+            return self._batch_key(task)
+        except Exception as e:
+            self._log(f"[batch] #{task.get('id')}: не вдалося визначити ключ пачки: {e}")
+            return None
+
+    def _drop_expired(self):
+        # викликати під self._lock
+        if self._lease_check and self._held:
+            live = {id(t) for t in self._lease_check([h.task for h in self._held])}
+            self._held = deque(h for h in self._held if id(h.task) in live)
+
+    def next_task(self) -> Optional[dict]:
+        with self._lock:
+            self._drop_expired()
+            if self._held:
+                return self._held.popleft().task
+        return self._get_task()
+
+    def collect(self, first: dict) -> List[dict]:
+        key = self._key(first)
+        if key is None or self._max_batch <= 1:
+            return [first]
+
+        batch = [first]
+        with self._lock:
+            self._drop_expired()
+            for h in list(self._held):
+                if len(batch) >= self._max_batch:
+                    break
+                if h.key == key:
+                    batch.append(h.task)
+                    self._held.remove(h)
+
+        deadline = time.time() + self._max_wait
+        # відкладених не більше за саму пачку — не тримаємо чужі задачі в оренді без потреби
+        while len(batch) < self._max_batch and len(self._held) < self._max_batch:
+            task = self._get_task()
+            if task:
+                k = self._key(task)
+                if k == key:
+                    batch.append(task)
+                else:
+                    with self._lock:
+                        self._held.append(_Held(task, k))
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            if not task:
+                time.sleep(min(self._poll_sec, left))
+
+        if len(batch) > 1:
+            self.batches += 1
+            self.batched_tasks += len(batch)
+            ids = ", ".join(f"#{t.get('id')}" for t in batch)
+            self._log(f"[batch] пачка з {len(batch)} задач: {ids}")
+        return batch
+
+    def pending(self) -> List[dict]:
+        """Відкладені (ще не стартовані) задачі."""
+        with self._lock:
+            return [h.task for h in self._held]
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "batched_tasks": self.batched_tasks, "held": len(self._held)}
@@ -0,0 +1,173 @@
+# image_encode.py
+"""
+Перекодування PNG з Comfy у WebP/AVIF перед аплоадом.
+
+1328x1328 PNG після Qwen edit важить кілька MB, якісний WebP — у рази менше;
+на повільних аплінках Salad це прямо час задачі. Кодування — CPU-робота,
+тому йде в пулі процесів (spawn: воркер багатопотоковий), по файлу на процес.
+
+Pillow опційний: без нього, без підтримки формату, при помилці або якщо
+результат не менший за оригінал — аплоадиться оригінальний PNG.
+
+Метадані (metadata="keep"): текстові чанки PNG (prompt/workflow від ComfyUI)
+переносяться в EXIF так само, як це робить SaveAnimatedWEBP у ComfyUI:
+0x0110 "prompt:{...}", далі 0x010F, 0x010E, ... "{key}:{...}"; ICC-профіль теж.
+"""
+import os
+import time
+import threading
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+FORMATS = {"webp": ".webp", "avif": ".avif"}
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_WORKERS = 2
+_LOG = print
+_SUPPORT = {}
+
+
+def init_image_encoder(workers: int, log_fn):
+    global _WORKERS, _LOG
+    _WORKERS = max(1, int(workers))
+    _LOG = log_fn
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+
+def shutdown_image_encoder():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=True)
+            _POOL = None
+
+
+def _supported(fmt: str) -> bool:
+    """Чи вміє Pillow в цьому процесі писати fmt (перевіряється один раз)."""
+    if fmt not in _SUPPORT:
+        ok = importlib.util.find_spec("PIL") is not None
+        if ok:
+            from PIL import features
+            ok = bool(features.check(fmt)) or (fmt == "avif" and importlib.util.find_spec("pillow_avif") is not None)
+        if not ok:
+            _LOG(f"[encode] Pillow з підтримкою {fmt} недоступний — зображення йдуть без перекодування")
+        _SUPPORT[fmt] = ok
+    return _SUPPORT[fmt]
+
+
+def _exif_from_text(im):
+    exif = im.getexif()
+    tag = 0x010F
+    for key, value in (getattr(im, "text", None) or {}).items():
+        if key == "prompt":
+            exif[0x0110] = f"prompt:{value}"
+        else:
+            exif[tag] = f"{key}:{value}"
+            tag -= 1
+    return exif
+
+
+def encode_image(src: str, out_dir: str, fmt: str, quality: int = 90, keep_metadata: bool = False) -> dict:
+    """
+    Виконується в процесі пулу. Пише out_dir/{stem}.{fmt}; при невдачі path лишається src.
+    Повертає {"src", "path", "src_bytes", "bytes", "encode_sec", "error"?}.
+    """
+    t0 = time.perf_counter()
+    out = {"src": src, "path": src, "src_bytes": os.path.getsize(src)}
+    dst = os.path.join(out_dir, os.path.splitext(os.path.basename(src))[0] + FORMATS[fmt])
+    part = dst + ".part"
+    try:
+        from PIL import Image
+        if fmt == "avif" and importlib.util.find_spec("pillow_avif") is not None:
+            import pillow_avif  # noqa: F401 — реєструє AVIF у старих Pillow
+
+        with Image.open(src) as im:
+            params = {"quality": int(quality)}
+            if keep_metadata:
+                params["exif"] = _exif_from_text(im).tobytes()
+                if im.info.get("icc_profile"):
+                    params["icc_profile"] = im.info["icc_profile"]
+            im.save(part, format=fmt.upper(), **params)
+
+        size = os.path.getsize(part)
+        if size >= out["src_bytes"]:
+            os.remove(part)
+            out["error"] = f"{fmt} не менший за оригінал ({size} >= {out['src_bytes']})"
+        else:
+            os.replace(part, dst)
+            out.update(path=dst, bytes=size)
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+    out.setdefault("bytes", out["src_bytes"])
+    out["encode_sec"] = round(time.perf_counter() - t0, 3)
+    return out
+
+
+def reencode_images(paths: List[str], spec: dict, out_dir: str) -> Tuple[List[str], dict]:
+    """
+    spec: {"format": "webp"|"avif", "quality": 90, "metadata": "keep"|"strip"}.
+    Повертає (шляхи для аплоаду в тому ж порядку, звіт). Оригінали з out_dir
+    видаляються лише після успішного кодування; чужі (COMFY_OUTPUT_DIR) не чіпаються.
+    """
+    fmt = str(spec.get("format") or "webp").lower()
+    quality = int(spec.get("quality", 90))
+    report = {"format": fmt, "quality": quality, "files": len(paths)}
+    if fmt not in FORMATS:
+        report["error"] = f"невідомий формат {fmt}"
+        _LOG(f"[encode] {report['error']}, аплоадимо оригінали")
+        return paths, report
+    if not _supported(fmt):
+        report["error"] = f"{fmt} не підтримується"
+        return paths, report
+
+    t0 = time.perf_counter()
+    keep = spec.get("metadata", "strip") == "keep"
+    try:
+        futures = [_pool().submit(encode_image, p, out_dir, fmt, quality, keep) for p in paths]
+        results = [f.result() for f in futures]
+    except Exception as e:
+        # впав сам пул (напр. BrokenProcessPool) — аплоадимо як є
+        report["error"] = f"{type(e).__name__}: {e}"
+        _LOG(f"[encode] пул кодування недоступний ({report['error']}), аплоадимо оригінали")
+        return paths, report
+
+    out_dir_abs = os.path.abspath(out_dir)
+    for r in results:
+        if r["path"] != r["src"] and os.path.dirname(os.path.abspath(r["src"])) == out_dir_abs:
+            try:
+                os.remove(r["src"])
+            except OSError:
+                pass
+
+    src_bytes = sum(r["src_bytes"] for r in results)
+    new_bytes = sum(r["bytes"] for r in results)
+    errors = [r["error"] for r in results if r.get("error")]
+    report.update({
+        "src_bytes": src_bytes,
+        "bytes": new_bytes,
+        "ratio": round(new_bytes / src_bytes, 3) if src_bytes else 1.0,
+        "encode_sec": round(sum(r["encode_sec"] for r in results), 3),
+        "wall_sec": round(time.perf_counter() - t0, 3),
+        "failed": len(errors),
+    })
+    if errors:
+        report["error"] = errors[0]
+    _LOG(
+        f"[encode] {len(results)} -> {fmt} q{quality}: {src_bytes} -> {new_bytes} байт "
+        f"(x{report['ratio']}), {report['wall_sec']} с" + (f", не вдалось: {len(errors)} ({errors[0]})" if errors else "")
+    )
+    return [r["path"] for r in results], report
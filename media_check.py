@@ -0,0 +1,258 @@
+# media_check.py
+"""
+Швидкі in-process перевірки відеофайлів (без запуску ffprobe).
+"""
+import os
+import struct
+import subprocess
+from typing import Optional
+
+MP4_EXTS = (".mp4", ".mov", ".m4v")
+
+
+def _iter_top_boxes(f, size: int):
+    """(type, offset, box_size) для top-level боксів; box_size=None — бокс неповний/битий."""
+    off = 0
+    while off < size:
+        f.seek(off)
+        hdr = f.read(16)
+        if len(hdr) < 8:
+            yield None, off, None
+            return
+        box_size, typ = struct.unpack(">I4s", hdr[:8])
+        if box_size == 1:
+            if len(hdr) < 16:
+                yield typ, off, None
+                return
+            box_size = struct.unpack(">Q", hdr[8:16])[0]
+        elif box_size == 0:
+            # "до кінця файлу": так ffmpeg пише mdat, поки не допише moov і не виправить розмір
+            yield typ, off, None
+            return
+        if box_size < 8 or off + box_size > size:
+            yield typ, off, None
+            return
+        yield typ, off, box_size
+        off += box_size
+
+
+def mp4_structure_complete(path: str) -> bool:
+    """
+    True, якщо top-level бокси MP4/MOV щільно покривають файл і є ftyp, moov, mdat —
+    тобто muxer дописав moov і закрив mdat. Читає лише заголовки боксів.
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            seen = set()
+            for typ, _, box_size in _iter_top_boxes(f, size):
+                if box_size is None:
+                    return False
+                seen.add(typ)
+    except OSError:
+        return False
+    return {b"ftyp", b"moov", b"mdat"} <= seen
+
+
+# ------------------ метадані MP4/MOV ------------------
+
+MAX_MOOV = 64 * 1024 * 1024
+
+
+def _children(buf, start: int, end: int):
+    """(type, payload_start, payload_end) для боксів у buf[start:end]."""
+    off = start
+    while off + 8 <= end:
+        size, typ = struct.unpack_from(">I4s", buf, off)
+        hdr = 8
+        if size == 1:
+            if off + 16 > end:
+                return
+            size = struct.unpack_from(">Q", buf, off + 8)[0]
+            hdr = 16
+        elif size == 0:
+            size = end - off
+        if size < hdr or off + size > end:
+            return
+        yield typ, off + hdr, off + size
+        off += size
+
+
+def _find(buf, start: int, end: int, *path):
+    for typ, s, e in _children(buf, start, end):
+        if typ == path[0]:
+            if len(path) == 1:
+                return s, e
+            found = _find(buf, s, e, *path[1:])
+            if found:
+                return found
+    return None
+
+
+def _full_box_times(buf, s: int):
+    """mvhd/mdhd: (timescale, duration) з урахуванням version 0/1."""
+    version = buf[s]
+    if version == 1:
+        return struct.unpack_from(">IQ", buf, s + 4 + 16)
+    return struct.unpack_from(">II", buf, s + 4 + 8)
+
+
+def _pix_fmt(buf, entry_s: int, entry_e: int, codec: str) -> Optional[str]:
+    """Хрома-субдискретизація і бітність з avcC/hvcC (best effort)."""
+    children_start = entry_s + 78   # VisualSampleEntry: фіксовані поля до дочірніх боксів
+    chroma = depth = None
+    if codec in ("avc1", "avc3"):
+        cfg = _find(buf, children_start, entry_e, b"avcC")
+        if not cfg:
+            return None
+        s, e = cfg
+        profile = buf[s + 1]
+        p = s + 6
+        n_sps = buf[s + 5] & 0x1F
+        for _ in range(n_sps):
+            p += 2 + struct.unpack_from(">H", buf, p)[0]
+        n_pps = buf[p]
+        p += 1
+        for _ in range(n_pps):
+            p += 2 + struct.unpack_from(">H", buf, p)[0]
+        if profile in (100, 110, 122, 144) and p + 3 <= e:
+            chroma, depth = buf[p] & 0x03, 8 + (buf[p + 1] & 0x07)
+        elif profile not in (100, 110, 122, 144):
+            chroma, depth = 1, 8
+    elif codec in ("hvc1", "hev1"):
+        cfg = _find(buf, children_start, entry_e, b"hvcC")
+        if not cfg or cfg[1] - cfg[0] < 19:
+            return None
+        s = cfg[0]
+        chroma, depth = buf[s + 16] & 0x03, 8 + (buf[s + 17] & 0x07)
+    if chroma is None:
+        return None
+    base = {0: "gray", 1: "yuv420p", 2: "yuv422p", 3: "yuv444p"}[chroma]
+    return base if depth == 8 else f"{base}{depth}le"
+
+
+def _track_info(buf, s: int, e: int) -> Optional[dict]:
+    hdlr = _find(buf, s, e, b"mdia", b"hdlr")
+    mdhd = _find(buf, s, e, b"mdia", b"mdhd")
+    stbl = _find(buf, s, e, b"mdia", b"minf", b"stbl")
+    if not (hdlr and mdhd and stbl):
+        return None
+    kind = bytes(buf[hdlr[0] + 8:hdlr[0] + 12]).decode("latin-1")
+    timescale, duration = _full_box_times(buf, mdhd[0])
+    info = {"kind": kind, "timescale": timescale, "duration": duration / timescale if timescale else 0.0}
+
+    stsd = _find(buf, stbl[0], stbl[1], b"stsd")
+    if stsd and stsd[1] - stsd[0] >= 16:
+        entry = stsd[0] + 8
+        entry_size, fmt = struct.unpack_from(">I4s", buf, entry)
+        info["codec"] = fmt.decode("latin-1").strip()
+        if kind == "vide" and stsd[1] - entry >= 8 + 78:
+            info["width"], info["height"] = struct.unpack_from(">HH", buf, entry + 8 + 24)
+            info["pix_fmt"] = _pix_fmt(buf, entry + 8, min(stsd[1], entry + entry_size), info["codec"])
+
+    stts = _find(buf, stbl[0], stbl[1], b"stts")
+    if stts:
+        n = struct.unpack_from(">I", buf, stts[0] + 4)[0]
+        frames = ticks = 0
+        for i in range(n):
+            count, delta = struct.unpack_from(">II", buf, stts[0] + 8 + i * 8)
+            frames += count
+            ticks += count * delta
+        info["frames"] = frames
+        if ticks and timescale:
+            info["fps"] = round(frames * timescale / ticks, 3)
+    return info
+
+
+def probe_mp4(path: str) -> Optional[dict]:
+    """
+    Метадані фіналізованого MP4/MOV без ffprobe: читає лише заголовки top-level
+    боксів і сам moov. None, якщо файл не дописаний/битий.
+    Повертає {"duration", "codec", "width", "height", "fps", "frames", "pix_fmt",
+              "timebase", "has_audio", "size"}.
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            moov = None
+            seen = set()
+            for typ, off, box_size in _iter_top_boxes(f, size):
+                if box_size is None:
+                    return None
+                seen.add(typ)
+                if typ == b"moov":
+                    moov = (off, box_size)
+            if not {b"ftyp", b"mdat"} <= seen or moov is None or moov[1] > MAX_MOOV:
+                return None
+            f.seek(moov[0])
+            buf = f.read(moov[1])
+    except OSError:
+        return None
+
+    body = _children(buf, 0, len(buf))
+    typ, s, e = next(body, (None, 0, 0))
+    if typ != b"moov":
+        return None
+
+    out = {"size": size, "has_audio": False}
+    mvhd = _find(buf, s, e, b"mvhd")
+    if mvhd:
+        timescale, duration = _full_box_times(buf, mvhd[0])
+        out["duration"] = duration / timescale if timescale else 0.0
+
+    video = None
+    try:
+        for t, ts, te in _children(buf, s, e):
+            if t != b"trak":
+                continue
+            info = _track_info(buf, ts, te)
+            if not info:
+                continue
+            if info["kind"] == "soun":
+                out["has_audio"] = True
+            elif info["kind"] == "vide" and video is None:
+                video = info
+    except (struct.error, IndexError, KeyError):
+        return None
+
+    if video is None:
+        return None
+    out.update({
+        "codec": video.get("codec"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "fps": video.get("fps"),
+        "frames": video.get("frames"),
+        "pix_fmt": video.get("pix_fmt"),
+        "timebase": f"1/{video['timescale']}",
+    })
+    out.setdefault("duration", video["duration"])
+    return out
+
+
+def ffprobe_check(path: str) -> bool:
+    """Глибока перевірка: повний ffprobe процес (повільно, лише на вимогу)."""
+    try:
+        p = subprocess.run(
+            ["ffprobe", "-hide_banner", "-v", "error", "-show_format", "-show_streams", path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+    except FileNotFoundError:
+        return True  # ffprobe немає в образі — глибока перевірка недоступна
+    return p.returncode == 0
+
+
+def video_ok(path: str, deep: bool = False) -> bool:
+    """
+    MP4/MOV: дописаний контейнер з відеодоріжкою (мікросекунди, без процесу);
+    deep=True — додатково ffprobe. Інші формати перевіряє лише ffprobe (якщо deep).
+    """
+    if path.lower().endswith(MP4_EXTS):
+        info = probe_mp4(path)
+        if not info or not info.get("frames"):
+            return False
+    elif not os.path.isfile(path):
+        return False
+    return ffprobe_check(path) if deep else True
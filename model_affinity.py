@@ -0,0 +1,165 @@
+# model_affinity.py
+"""
+Вибір задачі з урахуванням того, які моделі вже завантажені в ComfyUI.
+
+Кожне перемикання frame_qwen <-> frame_wan <-> lora_image <-> upscale змушує
+Comfy вивантажувати і вантажити десятки GB ваг. Тримаємо невеликий локальний
+буфер узятих задач і беремо ту, чиї моделі вже "гарячі"; aging (max_skips)
+не дає іншим задачам голодувати.
+"""
+import threading
+import time
+from collections import deque
+from typing import Iterable, List, Optional
+
+# class_type -> inputs, які містять імʼя файлу моделі
+MODEL_LOADERS = {
+    "UNETLoader": ("unet_name",),
+    "CheckpointLoaderSimple": ("ckpt_name",),
+    "CLIPLoader": ("clip_name",),
+    "DualCLIPLoader": ("clip_name1", "clip_name2"),
+    "VAELoader": ("vae_name",),
+    "UpscaleModelLoader": ("model_name",),
+}
+
+
+def models_in_workflow(workflow: dict) -> frozenset:
+    """Повертає frozenset рядків виду 'UNETLoader:qwen_image_edit.safetensors'."""
+    found = set()
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        keys = MODEL_LOADERS.get(node.get("class_type"))
+        if not keys:
+            continue
+        inputs = node.get("inputs") or {}
+        for k in keys:
+            name = inputs.get(k)
+            # посилання на інший вузол (["12", 0]) — не імʼя файлу
+            if isinstance(name, str) and name:
+                found.add(f"{node['class_type']}:{name}")
+    return frozenset(found)
+
+
+class _Entry:
+    __slots__ = ("task", "models", "leased_at", "skips")
+
+    def __init__(self, task, models):
+        self.task = task
+        self.models = models
+        self.leased_at = time.time()
+        self.skips = 0
+
+
+class AffinityScheduler:
+    """
+    next_task() — дозаповнює буфер через get_task(loaded_models=...) і віддає найкращу задачу.
+    note_started(task) — викликати, коли задача реально пішла в Comfy (оновлює "резидентні" моделі).
+    """
+
+    def __init__(
+        self,
+        *,
+        get_task,
+        task_models,
+        buffer_size: int = 3,
+        max_skips: int = 4,
+        resident_runs: int = 1,
+        lease_check=None,
+        log=print,
+    ):
+        self._get_task = get_task
+        # lease_check(tasks) -> задачі, які ще можна стартувати (task_api.filter_leased)
+        self._lease_check = lease_check
+        self._task_models = task_models
+        self._buffer_size = max(1, buffer_size)
+        self._max_skips = max_skips
+        self._recent = deque(maxlen=max(1, resident_runs))
+        self._buffer: List[_Entry] = []
+        self._lock = threading.Lock()
+        self._log = log
+
+        self.model_loads = 0
+        self.avoided_loads = 0
+
+    @property
+    def resident_models(self) -> frozenset:
+        out = set()
+        for models in self._recent:
+            out |= models
+        return frozenset(out)
+
+    def _loads_needed(self, entry: _Entry, resident: frozenset) -> int:
+        return len(entry.models - resident)
+
+    def _fill(self):
+        resident = self.resident_models
+        while len(self._buffer) < self._buffer_size:
+            task = self._get_task(loaded_models=sorted(resident))
+            if not task:
+                break
+            self._buffer.append(_Entry(task, self._safe_models(task)))
+
+    def _drop_expired(self):
+        if self._lease_check and self._buffer:
+            live = {id(t) for t in self._lease_check([e.task for e in self._buffer])}
+            self._buffer = [e for e in self._buffer if id(e.task) in live]
+
+    def _safe_models(self, task) -> frozenset:
+        try:
+            return frozenset(self._task_models(task))
+        except Exception as e:
+            self._log(f"[affinity] #{task.get('id')}: не вдалося визначити моделі: {e}")
+            return frozenset()
+
+    def next_task(self) -> Optional[dict]:
+        with self._lock:
+            self._drop_expired()
+            self._fill()
+            if not self._buffer:
+                return None
+
+            resident = self.resident_models
+            fifo = self._buffer[0]
+
+            starving = [e for e in self._buffer if e.skips >= self._max_skips]
+            if starving:
+                chosen = starving[0]
+            else:
+                # менше довантажень — краще; при рівності — старіша задача
+                chosen = min(self._buffer, key=lambda e: self._loads_needed(e, resident))
+
+            for e in self._buffer:
+                if e is not chosen:
+                    e.skips += 1
+            self._buffer.remove(chosen)
+
+            fifo_loads = self._loads_needed(fifo, resident)
+            chosen_loads = self._loads_needed(chosen, resident)
+            if chosen is not fifo and fifo_loads > chosen_loads:
+                self.avoided_loads += fifo_loads - chosen_loads
+                self._log(
+                    f"[affinity] #{chosen.task.get('id')} замість #{fifo.task.get('id')}: "
+                    f"{chosen_loads} завантажень моделей замість {fifo_loads} "
+                    f"(всього уникнуто: {self.avoided_loads})"
+                )
+            return chosen.task
+
+    def note_started(self, task: dict, models: Optional[Iterable[str]] = None):
+        models = frozenset(models) if models is not None else self._safe_models(task)
+        with self._lock:
+            self.model_loads += len(models - self.resident_models)
+            self._recent.append(models)
+
+    def pending(self) -> List[dict]:
+        """Задачі, що лежать у буфері (ще не стартували)."""
+        with self._lock:
+            return [e.task for e in self._buffer]
+
+    def stats(self) -> dict:
+        return {
+            "model_loads": self.model_loads,
+            "avoided_loads": self.avoided_loads,
+            "buffered": len(self._buffer),
+            "resident_models": sorted(self.resident_models),
+        }
@@ -0,0 +1,274 @@
+# model_store.py
+"""
+Content-addressed сховище моделей з LRU-витісненням під бюджет диска.
+
+Кожен файл моделі лежить один раз як blob під своїм sha256:
+    {MODEL_DIR}/.store/blobs/<sha256>
+а в папках ComfyUI (loras/, checkpoints/, diffusion_models/, ...) під очікуваним
+імʼям стоїть hardlink на blob (або symlink, якщо hardlink неможливий).
+
+manifest.json памʼятає розмір, час останнього використання, workflow-и,
+які брали файл, і всі імена, під якими він виставлений. Файл вважається
+присутнім лише якщо імʼя досі вказує на blob потрібного розміру — обрізаний
+файл, який колись пройшов би перевірку ">= 1 KB", сюди не потрапить.
+
+Витіснення ніколи не чіпає blob-и, закріплені (pin) за поточною або
+prefetch-задачею, і ті, що використовувались менше ніж min_age_sec тому
+(їх може тримати сусідній контейнер на спільному /workspace).
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+MANIFEST_VERSION = 1
+
+
+def sha256_of(path: str, chunk: int = 8 * 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(chunk)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+class ModelStore:
+    def __init__(self, root: str, *, budget_bytes: int = 0, min_age_sec: int = 3600, log=print):
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.lock_path = os.path.join(root, "manifest.lock")
+        self.budget_bytes = budget_bytes
+        self.min_age_sec = min_age_sec
+        self._log = log
+        self._pins: Dict[object, set] = {}
+        self._pins_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+    # ------------------ manifest ------------------
+
+    @contextmanager
+    def _manifest(self, write: bool = True):
+        """Read-modify-write manifest під flock (кілька контейнерів на одному томі)."""
+        with self._thread_lock, open(self.lock_path, "a+") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                m = self._read_manifest()
+                yield m
+                if write:
+                    self._write_manifest(m)
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                m = json.load(f)
+            if m.get("version") == MANIFEST_VERSION:
+                return m
+        except (OSError, ValueError):
+            pass
+        return {"version": MANIFEST_VERSION, "blobs": {}, "paths": {}}
+
+    def _write_manifest(self, m: dict):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(m, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.blobs_dir, sha)
+
+    # ------------------ перевірка / облік ------------------
+
+    def _name_points_to_blob(self, path: str, sha: str, size: int) -> bool:
+        blob = self.blob_path(sha)
+        try:
+            if os.stat(blob).st_size != size:
+                return False
+            # hardlink — той самий inode; symlink — samefile дивиться на ціль
+            return os.path.samefile(blob, path)
+        except OSError:
+            return False
+
+    def is_present(self, path: str, *, sha256: Optional[str] = None, size: Optional[int] = None) -> bool:
+        """
+        True, якщо path — це виставлений blob (правильного розміру і, якщо задано, хешу).
+        """
+        path = os.path.abspath(path)
+        with self._manifest(write=False) as m:
+            sha = m["paths"].get(path)
+            entry = m["blobs"].get(sha) if sha else None
+            if not entry:
+                return False
+            if sha256 and sha256.lower() != sha:
+                return False
+            if size is not None and int(size) != entry["size"]:
+                return False
+            return self._name_points_to_blob(path, sha, entry["size"])
+
+    def adopt(self, path: str, *, sha256: Optional[str] = None, workflow: Optional[str] = None) -> str:
+        """
+        Забирає щойно завантажений (або старий, ще не облікований) файл у сховище:
+        blob/<sha> + hardlink під старим імʼям. Повертає sha256.
+        """
+        path = os.path.abspath(path)
+        sha = (sha256 or sha256_of(path)).lower()
+        size = os.path.getsize(path)
+        blob = self.blob_path(sha)
+
+        with self._manifest() as m:
+            if os.path.exists(blob) and os.path.getsize(blob) == size:
+                # такий вміст уже є — дублікат замінюємо посиланням на існуючий blob
+                if not os.path.samefile(blob, path):
+                    self._link_name(blob, path)
+            else:
+                try:
+                    os.link(path, blob)
+                except FileExistsError:
+                    os.remove(blob)
+                    os.link(path, blob)
+                except OSError:
+                    # інша ФС / без hardlink-ів: переносимо файл у store і ставимо symlink
+                    os.replace(path, blob)
+                    os.symlink(blob, path)
+
+            entry = m["blobs"].setdefault(sha, {"size": size, "last_used": 0, "workflows": [], "paths": []})
+            entry["size"] = size
+            entry["last_used"] = time.time()
+            if path not in entry["paths"]:
+                entry["paths"].append(path)
+            if workflow and workflow not in entry["workflows"]:
+                entry["workflows"].append(workflow)
+
+            old = m["paths"].get(path)
+            if old and old != sha and old in m["blobs"]:
+                # під цим імʼям раніше був інший вміст
+                m["blobs"][old]["paths"] = [p for p in m["blobs"][old]["paths"] if p != path]
+            m["paths"][path] = sha
+        return sha
+
+    def _link_name(self, blob: str, path: str):
+        tmp = path + ".link"
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            os.symlink(blob, tmp)
+        os.replace(tmp, path)
+
+    def touch(self, paths: Iterable[str], workflow: Optional[str] = None) -> list:
+        """Оновлює last_used (і workflows) для виставлених імен. Повертає їхні sha256."""
+        shas = []
+        now = time.time()
+        with self._manifest() as m:
+            for p in paths:
+                sha = m["paths"].get(os.path.abspath(p))
+                entry = m["blobs"].get(sha) if sha else None
+                if not entry:
+                    continue
+                entry["last_used"] = now
+                if workflow and workflow not in entry["workflows"]:
+                    entry["workflows"].append(workflow)
+                shas.append(sha)
+        return shas
+
+    # ------------------ pin / витіснення ------------------
+
+    def pin(self, key, paths: Iterable[str]):
+        """Закріплює файли за задачею (key = task id): їх не можна витісняти, поки не unpin."""
+        with self._manifest(write=False) as m:
+            shas = {m["paths"].get(os.path.abspath(p)) for p in paths}
+        shas.discard(None)
+        with self._pins_lock:
+            self._pins.setdefault(key, set()).update(shas)
+
+    def unpin(self, key):
+        with self._pins_lock:
+            self._pins.pop(key, None)
+
+    def _pinned(self) -> set:
+        with self._pins_lock:
+            out = set()
+            for s in self._pins.values():
+                out |= s
+            return out
+
+    def total_bytes(self) -> int:
+        with self._manifest(write=False) as m:
+            return sum(e["size"] for e in m["blobs"].values())
+
+    def enforce_budget(self) -> int:
+        """LRU-витіснення, поки сумарний розмір не влізе в budget_bytes. Повертає звільнені байти."""
+        if not self.budget_bytes:
+            return 0
+        pinned = self._pinned()
+        freed = 0
+        now = time.time()
+        with self._manifest() as m:
+            total = sum(e["size"] for e in m["blobs"].values())
+            if total <= self.budget_bytes:
+                return 0
+            candidates = sorted(
+                (
+                    (e["last_used"], sha)
+                    for sha, e in m["blobs"].items()
+                    if sha not in pinned and now - e["last_used"] >= self.min_age_sec
+                ),
+            )
+            for _, sha in candidates:
+                if total <= self.budget_bytes:
+                    break
+                entry = m["blobs"].pop(sha)
+                for p in entry["paths"]:
+                    if m["paths"].get(p) == sha:
+                        m["paths"].pop(p, None)
+                        try:
+                            os.remove(p)
+                        except FileNotFoundError:
+                            pass
+                try:
+                    os.remove(self.blob_path(sha))
+                except FileNotFoundError:
+                    pass
+                total -= entry["size"]
+                freed += entry["size"]
+                self._log(
+                    f"[model-store] витіснено {sha[:12]} ({entry['size'] / 1024 ** 3:.2f} GB): "
+                    f"{', '.join(os.path.basename(p) for p in entry['paths'])}"
+                )
+            if total > self.budget_bytes:
+                self._log(
+                    f"[model-store] бюджет {self.budget_bytes / 1024 ** 3:.1f} GB перевищено "
+                    f"({total / 1024 ** 3:.1f} GB), але решта файлів закріплені або свіжі"
+                )
+        return freed
+
+
+# ------------------ глобальний екземпляр ------------------
+
+_STORE: Optional[ModelStore] = None
+
+
+def init_model_store(root: str, *, budget_bytes: int = 0, min_age_sec: int = 3600, log=print) -> ModelStore:
+    """
+    Викликати один раз при старті воркера (в main.py), якщо сховище увімкнене.
+    """
+    global _STORE
+    _STORE = ModelStore(root, budget_bytes=budget_bytes, min_age_sec=min_age_sec, log=log)
+    return _STORE
+
+
+def get_store() -> Optional[ModelStore]:
+    return _STORE
@@ -0,0 +1,269 @@
+# output_watcher.py
+"""
+Спільне очікування результатів Comfy у {comfy_id}_video/ (і подібних теках).
+
+Замість glob + кількох stat на файл щосекунди і фіксованих 4–5 с "на стабільність":
+  - inotify (через ctypes, без залежностей), якщо доступний: прокидаємось на
+    IN_CLOSE_WRITE / IN_MOVED_TO, а не за таймером;
+  - інакше — один прохід os.scandir на кожне опитування.
+
+Файл готовий, щойно:
+  - MP4/MOV: контейнер структурно завершений (moov дописаний, mdat закритий) і
+    файл закрили після запису або він уже не змінюється;
+  - інші формати: файл закрили після запису, або (без inotify) розмір і mtime
+    не змінились між двома проходами.
+"""
+import os
+import time
+import errno
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from media_check import MP4_EXTS, mp4_structure_complete
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")
+
+RESCAN_SEC = 2.0          # страховочний повний прохід навіть з inotify
+SETTLE_SEC = 1.0          # без подій: файл, не змінений стільки секунд і між проходами, вважаємо дописаним
+
+
+class _Inotify:
+    _libc = None
+
+    def __init__(self):
+        if _Inotify._libc is None:
+            _Inotify._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        self.paths: Dict[int, str] = {}
+
+    @classmethod
+    def create(cls) -> Optional["_Inotify"]:
+        try:
+            return cls()
+        except (OSError, AttributeError):
+            return None
+
+    def add(self, path: str, mask: int) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            return False
+        self.paths[wd] = path
+        return True
+
+    def read(self, timeout: float) -> List[tuple]:
+        """[(dir_path, name, mask)] за timeout секунд (порожньо, якщо подій не було)."""
+        r, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not r:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        out = []
+        off = 0
+        while off + _EVENT.size <= len(data):
+            wd, mask, _, name_len = _EVENT.unpack_from(data, off)
+            off += _EVENT.size
+            name = data[off:off + name_len].split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+            off += name_len
+            out.append((self.paths.get(wd), name, mask))
+        return out
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Candidate:
+    __slots__ = ("path", "size", "mtime_ns", "prev", "closed_at")
+
+    def __init__(self, path):
+        self.path = path
+        self.size = -1
+        self.mtime_ns = 0
+        self.prev = None
+        self.closed_at = None
+
+    def update(self, size: int, mtime_ns: int):
+        self.prev = (self.size, self.mtime_ns)
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def complete(self, now: float) -> bool:
+        unchanged = self.prev == (self.size, self.mtime_ns)
+        settled = now - self.mtime_ns / 1e9 >= SETTLE_SEC
+        closed = self.closed_at == (self.size, self.mtime_ns)
+        if self.path.lower().endswith(MP4_EXTS):
+            return (closed or unchanged or settled) and mp4_structure_complete(self.path)
+        return closed or (unchanged and settled)
+
+
+class _Watch:
+    """Стан спостереження: inotify (якщо є) + кандидати з останнього проходу scandir."""
+
+    def __init__(self, patterns: List[str], min_size: int, newer_than: Optional[float]):
+        self.patterns = patterns
+        self.min_size = min_size
+        self.newer_than = newer_than
+        self.by_dir: Dict[str, List[str]] = {}
+        for pat in patterns:
+            self.by_dir.setdefault(os.path.dirname(pat), []).append(os.path.basename(pat))
+        self.ino = _Inotify.create()
+        self.watched = set()
+        self.candidates: Dict[str, _Candidate] = {}
+        self.closed_names = set()
+
+    def _ensure_watches(self):
+        if self.ino is None:
+            return
+        for d in self.by_dir:
+            if d in self.watched:
+                continue
+            if self.ino.add(d, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                self.watched.add(d)
+            else:
+                parent = os.path.dirname(d)
+                if parent not in self.watched and self.ino.add(parent, IN_CREATE | IN_MOVED_TO):
+                    self.watched.add(parent)
+
+    def scan(self) -> List[_Candidate]:
+        """Оновлює кандидатів; повертає їх відсортованими за mtime (старі -> нові)."""
+        self._ensure_watches()
+        seen = set()
+        for d, names in self.by_dir.items():
+            try:
+                it = os.scandir(d)
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    if not any(fnmatch.fnmatch(entry.name, n) for n in names):
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if st.st_size < self.min_size:
+                        continue
+                    if self.newer_than is not None and st.st_mtime < self.newer_than:
+                        continue
+                    c = self.candidates.get(entry.path)
+                    if c is None:
+                        c = self.candidates[entry.path] = _Candidate(entry.path)
+                    c.update(st.st_size, st.st_mtime_ns)
+                    if entry.path in self.closed_names:
+                        c.closed_at = (st.st_size, st.st_mtime_ns)
+                        self.closed_names.discard(entry.path)
+                    seen.add(entry.path)
+        for gone in set(self.candidates) - seen:
+            self.candidates.pop(gone, None)
+        return sorted(self.candidates.values(), key=lambda c: c.mtime_ns)
+
+    def sleep(self, timeout: float, poll_sec: float):
+        """Чекає подію inotify (або просто poll_sec без нього), не довше timeout."""
+        if self.ino is None:
+            time.sleep(max(0.0, min(poll_sec, timeout)))
+            return
+        for d, name, mask in self.ino.read(min(RESCAN_SEC, timeout)):
+            if d is not None and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.closed_names.add(os.path.join(d, name))
+
+    def close(self):
+        if self.ino is not None:
+            self.ino.close()
+
+
+def wait_for_outputs(
+    patterns: Iterable[str],
+    *,
+    timeout_sec: float,
+    min_size: int = 1,
+    newer_than: Optional[float] = None,
+    require: str = "newest",
+    poll_sec: float = 1.0,
+) -> List[str]:
+    """
+    Чекає файли за glob-патернами (фільтр лише по імені, теки можуть ще не існувати).
+    require="newest" — повертає, щойно найсвіжіший кандидат готовий;
+    require="all" — коли готові всі кандидати (сегменти перед concat).
+    Повертає готові кандидати, відсортовані за mtime (старі -> нові).
+    TimeoutError, якщо не дочекались.
+    """
+    patterns = list(patterns)
+    deadline = time.time() + timeout_sec
+    w = _Watch(patterns, min_size, newer_than)
+    try:
+        while True:
+            ready = w.scan()
+            now = time.time()
+            if ready:
+                if require == "all":
+                    if all(c.complete(now) for c in ready):
+                        return [c.path for c in ready]
+                elif ready[-1].complete(now):
+                    return [c.path for c in ready if c.complete(now)]
+
+            remaining = deadline - now
+            if remaining <= 0:
+                raise TimeoutError(f"не дочекались файлів {patterns}; бачили: {sorted(w.candidates)}")
+            w.sleep(remaining, poll_sec)
+    finally:
+        w.close()
+
+
+def iter_outputs(
+    patterns: Iterable[str],
+    *,
+    finished: Callable[[], bool],
+    timeout_sec: float,
+    min_size: int = 1,
+    poll_sec: float = 1.0,
+) -> Iterator[str]:
+    """
+    Віддає файли по одному, щойно кожен дописаний (у порядку mtime), поки продюсер
+    ще працює. Коли finished() стає True — дочікує незакриті кандидати і завершується.
+    Файл, що йде після ще недописаного, не віддається раніше за нього.
+    TimeoutError, якщо за timeout_sec від finished() не все дописалось.
+    """
+    patterns = list(patterns)
+    w = _Watch(patterns, min_size, None)
+    emitted = set()
+    deadline = None
+    try:
+        while True:
+            done = finished()
+            ready = w.scan()
+            now = time.time()
+            for c in ready:
+                if c.path in emitted:
+                    continue
+                if not c.complete(now):
+                    break
+                emitted.add(c.path)
+                yield c.path
+            pending = [c.path for c in ready if c.path not in emitted]
+            if done:
+                if not pending:
+                    return
+                if deadline is None:
+                    deadline = now + timeout_sec
+                if now >= deadline:
+                    raise TimeoutError(f"не дописались файли {pending}")
+            w.sleep(deadline - now if deadline else poll_sec, poll_sec)
+    finally:
+        w.close()
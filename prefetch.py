@@ -0,0 +1,155 @@
+# prefetch.py
+"""
+Lookahead: поки Comfy рахує поточну задачу, беремо наступну з API
+і у фоні докачуємо її залежності (LoRA, чекпоінти, input-файли),
+щоб наступний prompt стартував з усім уже на диску.
+"""
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchBudgetExceeded(RuntimeError):
+    pass
+
+
+class TransferBudget:
+    """
+    Обмежувач для фонових завантажень:
+      - max_bytes_per_sec: грубий token bucket по швидкості (0 = без ліміту)
+      - max_bytes: скільки всього можна скачати в межах одного prefetch
+      - min_free_bytes: скільки місця має лишитися на диску з моделями
+    Передається в download_dependencies(..., budget=...) і викликається на кожен chunk.
+    """
+
+    def __init__(self, *, max_bytes_per_sec: int = 0, max_bytes: int = 0, min_free_bytes: int = 0, disk_path: str = "/"):
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.disk_path = disk_path
+        self.consumed = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._next_disk_check = 0
+
+    def check_disk(self):
+        if not self.min_free_bytes:
+            return
+        try:
+            free = shutil.disk_usage(self.disk_path).free
+        except OSError:
+            return
+        if free < self.min_free_bytes:
+            raise PrefetchBudgetExceeded(
+                f"prefetch: на {self.disk_path} лишилось {free} байт (< {self.min_free_bytes}), зупиняємось"
+            )
+
+    def consume(self, n: int):
+        with self._lock:
+            self.consumed += n
+            consumed = self.consumed
+            check_disk = consumed >= self._next_disk_check
+            if check_disk:
+                # перевіряємо диск не частіше ніж раз на 64 MB
+                self._next_disk_check = consumed + 64 * 1024 * 1024
+
+        if self.max_bytes and consumed > self.max_bytes:
+            raise PrefetchBudgetExceeded(f"prefetch: перевищено бюджет {self.max_bytes} байт")
+        if check_disk:
+            self.check_disk()
+
+        if self.max_bytes_per_sec:
+            expected = consumed / self.max_bytes_per_sec
+            elapsed = time.monotonic() - self._started
+            if expected > elapsed:
+                time.sleep(expected - elapsed)
+
+
+class Prefetcher:
+    """
+    start() — викликати, коли поточна задача вже віддана в Comfy:
+        у фоні бере наступну задачу через get_task() і качає її dependency.
+    take() — на початку наступного циклу: повертає (task, deps_ready) або (None, False).
+    """
+
+    def __init__(
+        self,
+        *,
+        get_task,
+        download_dependencies,
+        log,
+        max_bytes_per_sec: int = 0,
+        max_bytes: int = 0,
+        min_free_bytes: int = 0,
+        disk_path: str = "/",
+    ):
+        self._get_task = get_task
+        self._download_dependencies = download_dependencies
+        self._log = log
+        # відкладена задача завжди одна (start() без take() нічого не робить) — один потік
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._budget_args = dict(
+            max_bytes_per_sec=max_bytes_per_sec,
+            max_bytes=max_bytes,
+            min_free_bytes=min_free_bytes,
+            disk_path=disk_path,
+        )
+        self._future = None
+
+    def start(self):
+        if self._future is not None:
+            return
+        self._future = self._pool.submit(self._lease_and_fetch)
+
+    def _lease_and_fetch(self):
+        task = self._get_task()
+        if not task:
+            return None, False
+
+        deps = task.get("dependency") or []
+        if not deps:
+            return task, True
+
+        budget = TransferBudget(**self._budget_args)
+        t0 = time.time()
+        try:
+            budget.check_disk()
+            self._download_dependencies(deps, budget=budget, task_id=task.get("id"), workflow=task.get("workflow_key"))
+        except PrefetchBudgetExceeded as e:
+            self._log(f"[prefetch] #{task.get('id')}: {e}; решту докачаємо перед стартом")
+            return task, False
+        except Exception as e:
+            self._log(f"[prefetch] #{task.get('id')}: помилка фонового завантаження: {e}")
+            return task, False
+
+        self._log(
+            f"[prefetch] #{task.get('id')}: залежності готові "
+            f"({budget.consumed / 1024 / 1024:.1f} MB за {time.time() - t0:.1f}s)"
+        )
+        return task, True
+
+    def take(self):
+        """Чекає завершення фонового prefetch і віддає задачу (або (None, False))."""
+        fut, self._future = self._future, None
+        if fut is None:
+            return None, False
+        try:
+            return fut.result()
+        except Exception as e:
+            self._log(f"[prefetch] помилка: {e}")
+            return None, False
+
+    def pending_task(self):
+        """Задача, яку prefetch уже взяв, але яка ще не стартувала (для повернення при зупинці)."""
+        fut = self._future
+        if fut is None or not fut.done():
+            return None
+        try:
+            task, _ = fut.result()
+        except Exception:
+            return None
+        return task
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,328 @@
+# ranged_download.py
+"""
+Завантаження великих моделей кількома зʼєднаннями з докачуванням.
+
+Якщо сервер віддає Accept-Ranges (пробуємо запитом Range: bytes=0-0),
+файл ділиться на діапазони, які паралельно пишуться через pwrite у
+заздалегідь виділений .part. Прогрес кожного діапазону лежить у sidecar
+<file>.part.progress, тож після обриву або рестарту контейнера докачується
+лише те, чого бракує. sha256 рахується по порядку, щойно наступний діапазон
+дописано, — після завершення хеш уже готовий.
+
+Civitai: редіректи на CDN requests проходить сам (і сам знімає Authorization
+при переході на інший хост), тому кожен діапазон іде на вихідний URL.
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Optional, Tuple
+
+import http_client
+
+RANGED_MIN_SIZE = 64 * 1024 * 1024     # менші файли качаємо одним потоком
+RANGE_SIZE = 32 * 1024 * 1024
+CONNECTIONS = 8
+RANGE_RETRIES = 6
+PROGRESS_SAVE_BYTES = 8 * 1024 * 1024  # як часто скидати прогрес діапазону в sidecar
+
+
+def stream_to_part(r, tmp_path, budget=None, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Пише відповідь у .part, паралельно рахує sha256 і перевіряє Content-Length,
+    щоб обірваний потік не став "готовим" файлом. Повертає sha256.
+    """
+    h = hashlib.sha256()
+    written = 0
+    with open(tmp_path, "wb") as f:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                f.write(chunk)
+                h.update(chunk)
+                written += len(chunk)
+                if budget:
+                    budget.consume(len(chunk))
+
+    expected = r.headers.get("Content-Length")
+    # при gzip/deflate Content-Length — це стиснутий розмір, порівнювати нема з чим
+    if expected and not r.headers.get("Content-Encoding") and int(expected) != written:
+        raise IOError(f"Обірване завантаження {tmp_path}: {written} з {expected} байт")
+    return h.hexdigest()
+
+
+def probe(url: str, headers=None, endpoint: str = "download.probe") -> Tuple[Optional[int], bool, str]:
+    """
+    Повертає (size, supports_ranges, validator). validator — ETag або Last-Modified,
+    щоб не докачувати .part, якщо файл на сервері змінився.
+    """
+    h = dict(headers or {})
+    h["Range"] = "bytes=0-0"
+    h["Accept-Encoding"] = "identity"
+    with http_client.get(url, endpoint=endpoint, headers=h, stream=True, timeout=(10, 60)) as r:
+        r.raise_for_status()
+        validator = r.headers.get("ETag") or r.headers.get("Last-Modified") or ""
+        if r.status_code == 206:
+            content_range = r.headers.get("Content-Range", "")  # bytes 0-0/12345
+            total = content_range.rsplit("/", 1)[-1]
+            size = int(total) if total.isdigit() else None
+            return size, size is not None, validator
+        length = r.headers.get("Content-Length")
+        return (int(length) if length else None), False, validator
+
+
+class _Progress:
+    """Sidecar з прогресом діапазонів: {"url", "size", "validator", "range_size", "done": [bytes, ...]}"""
+
+    def __init__(self, path: str, url: str, size: int, validator: str, range_size: int):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {
+            "url": url,
+            "size": size,
+            "validator": validator,
+            "range_size": range_size,
+            "done": [0] * ((size + range_size - 1) // range_size),
+        }
+
+    def load_matching(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            return False
+        same = all(old.get(k) == self.state[k] for k in ("size", "validator", "range_size"))
+        if same and len(old.get("done") or []) == len(self.state["done"]):
+            self.state["done"] = [int(x) for x in old["done"]]
+            return True
+        return False
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.state)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        for p in (self.path, self.path + ".tmp"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+
+def _range_bounds(idx: int, size: int, range_size: int) -> Tuple[int, int]:
+    start = idx * range_size
+    return start, min(size, start + range_size) - 1
+
+
+def _fetch_range(url, headers, fd, progress: _Progress, idx: int, budget, endpoint: str):
+    size = progress.state["size"]
+    range_size = progress.state["range_size"]
+    start, end = _range_bounds(idx, size, range_size)
+
+    attempt = 0
+    while True:
+        with progress.lock:
+            done = progress.state["done"][idx]
+        pos = start + done
+        if pos > end:
+            return
+        h = dict(headers or {})
+        h["Range"] = f"bytes={pos}-{end}"
+        h["Accept-Encoding"] = "identity"
+        try:
+            with http_client.get(url, endpoint=endpoint, retries=0, headers=h, stream=True, timeout=(10, 60)) as r:
+                if r.status_code != 206:
+                    raise IOError(f"сервер не віддав діапазон {pos}-{end}: HTTP {r.status_code}")
+                unsaved = 0
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if not chunk:
+                        continue
+                    if pos + len(chunk) > end + 1:
+                        chunk = chunk[: end + 1 - pos]
+                    os.pwrite(fd, chunk, pos)
+                    pos += len(chunk)
+                    unsaved += len(chunk)
+                    with progress.lock:
+                        progress.state["done"][idx] = pos - start
+                    if budget:
+                        budget.consume(len(chunk))
+                    if unsaved >= PROGRESS_SAVE_BYTES:
+                        progress.save()
+                        unsaved = 0
+                    if pos > end:
+                        break
+            if pos <= end:
+                raise IOError(f"діапазон {idx} обірвався на {pos} з {end + 1}")
+            return
+        except Exception:
+            progress.save()
+            attempt += 1
+            if attempt > RANGE_RETRIES:
+                raise
+            time.sleep(min(60, 2 ** attempt) + random.random())
+
+
+class _OrderedHasher:
+    """Рахує sha256 по порядку діапазонів, читаючи вже дописані шматки з .part."""
+
+    def __init__(self, fd, progress: _Progress):
+        self._fd = fd
+        self._progress = progress
+        self._h = hashlib.sha256()
+        self._next = 0
+        self._cond = threading.Condition()
+        self._ready = set()
+
+    def mark_ready(self, idx: int):
+        with self._cond:
+            self._ready.add(idx)
+            self._cond.notify()
+
+    def run(self, total: int, stop: threading.Event):
+        size = self._progress.state["size"]
+        range_size = self._progress.state["range_size"]
+        while self._next < total:
+            with self._cond:
+                while self._next not in self._ready:
+                    if stop.is_set():
+                        return
+                    self._cond.wait(0.5)
+            start, end = _range_bounds(self._next, size, range_size)
+            pos = start
+            while pos <= end:
+                b = os.pread(self._fd, min(8 * 1024 * 1024, end + 1 - pos), pos)
+                if not b:
+                    raise IOError("неочікуваний кінець .part при хешуванні")
+                self._h.update(b)
+                pos += len(b)
+            self._next += 1
+
+    @property
+    def hashed(self) -> int:
+        """Скільки діапазонів від початку файлу вже в хеші."""
+        return self._next
+
+    def hexdigest(self) -> str:
+        return self._h.hexdigest()
+
+
+def fetch_ranged(url: str, part_path: str, size: int, validator: str, *, headers=None, budget=None,
+                 connections: int = CONNECTIONS, range_size: Optional[int] = None,
+                 endpoint: str = "download.range", log=print) -> str:
+    range_size = range_size or RANGE_SIZE
+    progress = _Progress(part_path + ".progress", url, size, validator, range_size)
+    resumed = (
+        os.path.exists(part_path)
+        and os.path.getsize(part_path) == size
+        and progress.load_matching()
+    )
+    if not resumed:
+        with open(part_path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                f.truncate(size)
+        progress.save()
+    else:
+        have = sum(progress.state["done"])
+        log(f"[download] докачуємо {os.path.basename(part_path)}: вже є {have}/{size} байт")
+
+    total = len(progress.state["done"])
+    fd = os.open(part_path, os.O_RDWR)
+    stop = threading.Event()
+    hasher = _OrderedHasher(fd, progress)
+    errors = []
+    next_idx = [0]
+    idx_lock = threading.Lock()
+
+    def range_done(idx):
+        start, end = _range_bounds(idx, size, range_size)
+        with progress.lock:
+            return progress.state["done"][idx] >= end - start + 1
+
+    for i in range(total):
+        if range_done(i):
+            hasher.mark_ready(i)
+
+    def worker():
+        while not stop.is_set():
+            with idx_lock:
+                idx = next_idx[0]
+                next_idx[0] += 1
+            if idx >= total:
+                return
+            if range_done(idx):
+                continue
+            try:
+                _fetch_range(url, headers, fd, progress, idx, budget, endpoint)
+                hasher.mark_ready(idx)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                return
+
+    hash_error = []
+
+    def hash_worker():
+        try:
+            hasher.run(total, stop)
+        except Exception as e:
+            hash_error.append(e)
+            stop.set()
+
+    t_hash = threading.Thread(target=hash_worker, name="download-hash", daemon=True)
+    t_hash.start()
+    threads = [threading.Thread(target=worker, name=f"download-{i}", daemon=True) for i in range(max(1, connections))]
+    t0 = time.time()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        t_hash.join()
+        if hash_error:
+            raise hash_error[0]
+    finally:
+        stop.set()
+        os.close(fd)
+        if errors or hash_error:
+            progress.save()
+
+    # .part виділено на повний розмір заздалегідь, тож розмір нічого не каже;
+    # готовність — це діапазони з прогресу, що разом покривають [0, size), і всі вони в хеші
+    missing = [i for i in range(total) if not range_done(i)]
+    if missing or hasher.hashed != total:
+        raise IOError(
+            f"{part_path} не докачано: бракує діапазонів {missing[:8]}{'...' if len(missing) > 8 else ''}, "
+            f"у хеші {hasher.hashed}/{total}"
+        )
+    progress.remove()
+    dt = max(time.time() - t0, 1e-6)
+    log(f"[download] {os.path.basename(part_path)}: {size / 1024 ** 2:.0f} MB, {connections} зʼєднань, {size / dt / 1024 ** 2:.1f} MB/s")
+    return hasher.hexdigest()
+
+
+def fetch_to_part(url: str, part_path: str, *, headers=None, budget=None, endpoint: str = "download",
+                  connections: int = CONNECTIONS, log=print) -> str:
+    """
+    Качає url у part_path і повертає sha256. Великі файли з підтримкою Range — паралельно
+    і з докачуванням; решта — одним потоком, як раніше.
+    """
+    size, ranged, validator = probe(url, headers, endpoint=f"{endpoint}.probe")
+    if ranged and size and size >= RANGED_MIN_SIZE and connections > 1:
+        return fetch_ranged(
+            url, part_path, size, validator,
+            headers=headers, budget=budget, connections=connections,
+            endpoint=f"{endpoint}.range", log=log,
+        )
+
+    with http_client.get(url, endpoint=endpoint, headers=headers, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        return stream_to_part(r, part_path, budget)
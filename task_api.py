@@ -0,0 +1,266 @@
+# task_api.py
+"""
+Пакетна робота з task API:
+  - lease кількох задач одним запитом (worker/getTasks) з дедлайном оренди;
+  - повернення невзятих задач при зупинці (worker/releaseTasks);
+  - кілька змін статусу одним запитом (worker/updateTasks).
+
+Якщо бекенд ще не знає пакетних ендпоінтів, усе тихо відкочується
+на старі worker/getTask і worker/updateTask.
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+
+import http_client
+
+API_BASE = os.environ["API_BASE"]
+GET_TASKS_URL     = f"{API_BASE}/index.php?r=worker/getTasks"
+RELEASE_TASKS_URL = f"{API_BASE}/index.php?r=worker/releaseTasks"
+UPDATE_TASKS_URL  = f"{API_BASE}/index.php?r=worker/updateTasks"
+
+TERMINAL_STATUSES = ("done", "failed", "error")
+
+# дедлайн оренди, який TaskLeaser ставить на кожну задачу (unix time)
+LEASE_KEY = "_lease_until"
+# до дедлайну лишаємо запас, щоб встигнути стартувати задачу
+LEASE_MARGIN_SEC = 5
+
+_API_TOKEN = None
+_LOG = None
+
+
+def init_task_api(api_token: str, log_fn):
+    """
+    Викликати один раз при старті воркера (в main.py).
+    """
+    global _API_TOKEN, _LOG
+    _API_TOKEN = api_token
+    _LOG = log_fn
+
+
+def _unsupported(r) -> bool:
+    # старий бекенд не знає роуту -> 404/405/501
+    return r.status_code in (404, 405, 501)
+
+
+# ------------------ lease ------------------
+
+def lease_tasks(limit: int, lease_sec: int, loaded_models=None):
+    """
+    Повертає (tasks, lease_until) або None, якщо бекенд не підтримує getTasks.
+    """
+    data = {"token": _API_TOKEN, "limit": str(limit), "lease_sec": str(lease_sec)}
+    if loaded_models is not None:
+        data["loaded_models"] = json.dumps(list(loaded_models), ensure_ascii=False)
+
+    # без повторів: повтор після таймауту орендував би ще одну пачку
+    r = http_client.post(GET_TASKS_URL, endpoint="api.getTasks", data=data, timeout=15, retries=0)
+    if _unsupported(r):
+        return None
+    r.raise_for_status()
+    j = r.json()
+    if not j.get("success"):
+        return [], None
+    tasks = j.get("tasks") or []
+    lease_until = j.get("lease_until")
+    if lease_until is None:
+        lease_until = time.time() + lease_sec
+    return tasks, float(lease_until)
+
+
+def release_tasks(task_ids) -> bool:
+    task_ids = [t for t in task_ids if t is not None]
+    if not task_ids:
+        return True
+    try:
+        r = http_client.post(RELEASE_TASKS_URL, endpoint="api.releaseTasks", data={
+            "token": _API_TOKEN,
+            "ids": json.dumps(task_ids),
+        }, timeout=15)
+        r.raise_for_status()
+        return True
+    except Exception as e:
+        _LOG(f"[task-api] не вдалося повернути задачі {task_ids}: {e}")
+        return False
+
+
+def lease_left(task: dict):
+    """Секунд до кінця оренди задачі; None — задача взята без дедлайну (getTask)."""
+    until = task.get(LEASE_KEY)
+    return None if until is None else until - time.time()
+
+
+def filter_leased(tasks, log=None) -> list:
+    """
+    Лишає задачі, які ще можна стартувати. Ті, чия оренда от-от спливе, повертаються
+    на сервер; вже прострочені просто відкидаються — їх міг отримати інший воркер,
+    і запускати їх тут означало б дубль.
+    """
+    live, release, expired = [], [], []
+    for task in tasks:
+        left = lease_left(task)
+        if left is None or left > LEASE_MARGIN_SEC:
+            live.append(task)
+        elif left > 0:
+            release.append(task.get("id"))
+        else:
+            expired.append(task.get("id"))
+    log = log or _LOG or print
+    if release:
+        log(f"[task-api] оренда задач {release} спливає, повертаємо на сервер")
+        release_tasks(release)
+    if expired:
+        log(f"[task-api] оренда задач {expired} вже спливла, пропускаємо")
+    return live
+
+
+class TaskLeaser:
+    """
+    get_task(loaded_models=None) з тим самим контрактом, що й worker.get_task,
+    але бере задачі пачками по batch_size і віддає їх по одній з локальної черги.
+    """
+
+    def __init__(self, *, get_task_single, batch_size: int = 4, lease_sec: int = 600, log=print):
+        self._get_task_single = get_task_single
+        self._batch_size = max(1, batch_size)
+        self._lease_sec = lease_sec
+        self._log = log
+        self._queue = deque()
+        self._supported = True
+        self._lock = threading.Lock()
+
+    def get_task(self, loaded_models=None):
+        with self._lock:
+            self._drop_expired()
+            if not self._queue and self._supported:
+                self._refill(loaded_models)
+                self._drop_expired()
+            if self._queue:
+                return self._queue.popleft()
+        if not self._supported:
+            return self._get_task_single(loaded_models=loaded_models)
+        return None
+
+    def _drop_expired(self):
+        if self._queue:
+            self._queue = deque(filter_leased(self._queue, self._log))
+
+    def _refill(self, loaded_models):
+        try:
+            res = lease_tasks(self._batch_size, self._lease_sec, loaded_models)
+        except Exception as e:
+            self._log(f"Помилка запиту задач: {e}")
+            return
+        if res is None:
+            self._log("[task-api] бекенд не підтримує getTasks, працюємо по одній задачі")
+            self._supported = False
+            return
+        tasks, lease_until = res
+        if tasks:
+            for task in tasks:
+                task[LEASE_KEY] = lease_until
+            self._queue.extend(tasks)
+            self._log(f"[task-api] взято в оренду {len(tasks)} задач до {time.strftime('%H:%M:%S', time.localtime(lease_until))}")
+
+    def release_pending(self, extra=()):
+        """Повертає на сервер усі невзяті задачі (викликати при зупинці)."""
+        with self._lock:
+            ids = [t.get("id") for t in self._queue] + [t.get("id") for t in extra]
+            self._queue.clear()
+        if ids:
+            self._log(f"[task-api] повертаємо невзяті задачі: {ids}")
+            release_tasks(ids)
+
+
+# ------------------ пакетні статуси ------------------
+
+def _status_item(task_id, status, error=None, payload_update=None) -> dict:
+    item = {"id": task_id, "status": status}
+    if error:
+        item["error_message"] = error
+    if payload_update is not None:
+        item["payload_update"] = payload_update
+    return item
+
+
+class StatusBatcher:
+    """
+    update(task_id, status, error, payload_update) — кладе зміну статусу в буфер;
+    фоновий потік раз на flush_interval відправляє все одним worker/updateTasks.
+    Підряд ідучі проміжні статуси однієї задачі зливаються в один.
+    Якщо пакетний ендпоінт недоступний — відправляє через send_single (старий updateTask).
+    """
+
+    def __init__(self, *, send_single, flush_interval: float = 0.5, max_batch: int = 50, log=print):
+        self._send_single = send_single
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._log = log
+        self._pending = []
+        self._cond = threading.Condition()
+        self._supported = True
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="status-batcher", daemon=True)
+        self._thread.start()
+
+    def update(self, task_id, status, error=None, payload_update=None):
+        with self._cond:
+            last = self._pending[-1] if self._pending else None
+            if (
+                last is not None
+                and last["id"] == task_id
+                and last["status"] not in TERMINAL_STATUSES
+                and status not in TERMINAL_STATUSES
+                and not error
+            ):
+                merged = dict(last.get("payload_update") or {})
+                merged.update(payload_update or {})
+                last["status"] = status
+                if merged:
+                    last["payload_update"] = merged
+            else:
+                self._pending.append(_status_item(task_id, status, error, payload_update))
+
+            # фінальні статуси не тримаємо — сервер має дізнатися про них якнайшвидше
+            if status in TERMINAL_STATUSES or len(self._pending) >= self._max_batch:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self._flush_interval)
+                batch, self._pending = self._pending, []
+                stopped = self._stopped
+            if batch:
+                self._send(batch)
+            if stopped:
+                return
+
+    def _send(self, batch):
+        if self._supported:
+            try:
+                r = http_client.post(UPDATE_TASKS_URL, endpoint="api.updateTasks", data={
+                    "token": _API_TOKEN,
+                    "updates": json.dumps(batch, ensure_ascii=False),
+                }, timeout=15)
+                if _unsupported(r):
+                    self._log("[task-api] бекенд не підтримує updateTasks, шлемо статуси по одному")
+                    self._supported = False
+                else:
+                    r.raise_for_status()
+                    return
+            except Exception as e:
+                self._log(f"[task-api] пакетне оновлення статусів не вдалося ({e}), шлемо по одному")
+
+        for item in batch:
+            self._send_single(item["id"], item["status"], item.get("error_message"), item.get("payload_update"))
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
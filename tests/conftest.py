@@ -0,0 +1,8 @@
+import os
+import sys
+
+# worker/upload читають їх при імпорті
+os.environ.setdefault("API_BASE", "http://api.test")
+os.environ.setdefault("API_TOKEN", "test-token")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,96 @@
+"""
+Stand-in task API для тестів: старі worker/getTask, worker/updateTask і
+пакетні worker/getTasks, worker/updateTasks, worker/releaseTasks.
+batched=False — поводиться як старий бекенд (404 на пакетні роути).
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BATCHED_ROUTES = ("worker/getTasks", "worker/updateTasks", "worker/releaseTasks")
+
+
+class TaskServer:
+    def __init__(self, tasks=(), *, batched: bool = True, lease_until=None):
+        self.tasks = deque(tasks)
+        self.batched = batched
+        self.lease_until = lease_until  # None — now + lease_sec з запиту
+        self.fail = {}  # route -> HTTP-статус, яким відповідати замість обробки
+        self.calls = []
+        self.statuses = []
+        self.released = []
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, route: str) -> str:
+        return f"{self.base}/index.php?r={route}"
+
+    def routes(self):
+        return [route for route, _ in self.calls]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    # ---------- обробка ----------
+
+    def handle(self, route: str, form: dict):
+        with self._lock:
+            self.calls.append((route, form))
+            if route in self.fail:
+                return self.fail[route], {"success": False}
+            if route in BATCHED_ROUTES and not self.batched:
+                return 404, {"success": False, "error": "unknown route"}
+
+            if route == "worker/getTask":
+                if not self.tasks:
+                    return 200, {"success": False}
+                return 200, {"success": True, "task": self.tasks.popleft()}
+
+            if route == "worker/getTasks":
+                limit = int(form["limit"])
+                tasks = [self.tasks.popleft() for _ in range(min(limit, len(self.tasks)))]
+                until = self.lease_until if self.lease_until is not None else time.time() + int(form["lease_sec"])
+                return 200, {"success": bool(tasks), "tasks": tasks, "lease_until": until}
+
+            if route == "worker/updateTask":
+                self.statuses.append((int(form["id"]), form["status"]))
+                return 200, {"success": True}
+
+            if route == "worker/updateTasks":
+                for item in json.loads(form["updates"]):
+                    self.statuses.append((item["id"], item["status"]))
+                return 200, {"success": True}
+
+            if route == "worker/releaseTasks":
+                self.released.extend(json.loads(form["ids"]))
+                return 200, {"success": True}
+
+        return 404, {"success": False}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                route = parse_qs(urlparse(self.path).query).get("r", [""])[0]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+                form = {k: v[0] for k, v in parse_qs(body).items()}
+                code, resp = server.handle(route, form)
+                data = json.dumps(resp).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,88 @@
+import json
+import time
+
+import pytest
+
+import comfy_exec
+
+
+class _FakeWs:
+    """Події /ws за розкладом: [(секунд від старту, event), ...]."""
+
+    def __init__(self, script):
+        self.t0 = time.time()
+        self.script = list(script)
+
+    def recv(self, timeout):
+        if self.script and self.t0 + self.script[0][0] <= time.time() + timeout:
+            at, event = self.script.pop(0)
+            time.sleep(max(0.0, self.t0 + at - time.time()))
+            return 0x1, json.dumps(event)
+        time.sleep(max(0.0, timeout))
+        return None
+
+    def close(self):
+        pass
+
+
+class _Resp:
+    status_code = 200
+    text = ""
+
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+@pytest.fixture
+def comfy(monkeypatch):
+    calls = {"cancel": [], "post": []}
+
+    def fake_post(url, **kw):
+        calls["post"].append(url)
+        return _Resp({"prompt_id": "ours"})
+
+    monkeypatch.setattr(comfy_exec.http_client, "post", fake_post)
+    monkeypatch.setattr(comfy_exec.http_client, "get", lambda url, **kw: _Resp({}))
+    monkeypatch.setattr(comfy_exec, "cancel_prompt", lambda pid, server=None: calls["cancel"].append(pid) or True)
+
+    def run(script, **kw):
+        monkeypatch.setattr(comfy_exec, "_connect", lambda server, client_id: _FakeWs(script))
+        return comfy_exec.execute({"1": {"class_type": "KSampler", "inputs": {}}}, server="comfy:8188", **kw)
+
+    return run, calls
+
+
+def _event(typ, **data):
+    return {"type": typ, "data": dict(data, prompt_id="ours")}
+
+
+def test_queue_wait_does_not_count_against_run_timeout(comfy):
+    run, calls = comfy
+    script = [
+        (0.4, _event("execution_start")),
+        (0.5, _event("executing", node="1")),
+        (0.7, _event("execution_success")),
+    ]
+    result = run(script, timeout_sec=0.5, queue_timeout_sec=2)
+    assert result["stats"]["queue_sec"] >= 0.3
+    assert calls["cancel"] == []
+
+
+def test_queue_timeout_cancels_only_our_prompt(comfy):
+    run, calls = comfy
+    with pytest.raises(TimeoutError, match="черзі"):
+        run([], timeout_sec=5, queue_timeout_sec=0.2)
+    assert calls["cancel"] == ["ours"]
+    assert not any(url.endswith("/interrupt") for url in calls["post"])
+
+
+def test_stall_cancels_only_our_prompt(comfy, monkeypatch):
+    run, calls = comfy
+    monkeypatch.setattr(comfy_exec, "_STALL_SEC", 0.2)
+    with pytest.raises(comfy_exec.ComfyStallError):
+        run([(0.0, _event("execution_start")), (0.05, _event("executing", node="1"))], timeout_sec=5)
+    assert calls["cancel"] == ["ours"]
+    assert not any(url.endswith("/interrupt") for url in calls["post"])
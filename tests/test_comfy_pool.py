@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import comfy_pool
+from comfy_pool import Backend, BackendPool
+
+
+class FakePool(BackendPool):
+    """Пул без мережі: health-check відповідає з self.alive."""
+
+    def __init__(self, backends, **kw):
+        self.alive = {b.name: True for b in backends}
+        kw.setdefault("log", lambda m: None)
+        super().__init__(backends, **kw)
+
+    def _check(self, b):
+        return self.alive[b.name]
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(n, slots=1, **kw):
+        pool = FakePool([Backend(f"gpu{i}", f"127.0.0.1:{3000 + i}", slots=slots) for i in range(n)], **kw)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def _wait(cond, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_acquire_prefers_backend_with_resident_models(make_pool):
+    pool = make_pool(2)
+    a = pool.acquire({"sdxl.safetensors"})
+    b = pool.acquire({"wan.safetensors"})
+    assert a is not b
+    pool._free(comfy_pool._Lease(pool, a))
+    pool._free(comfy_pool._Lease(pool, b))
+
+    assert pool.acquire({"wan.safetensors"}) is b
+    assert pool.acquire({"sdxl.safetensors"}) is a
+
+
+def test_acquire_times_out_when_full(make_pool):
+    pool = make_pool(1, slots=2)
+    assert pool.acquire() and pool.acquire()
+    assert pool.acquire(timeout=0.1) is None
+
+
+def test_backend_faults_take_it_out_of_rotation(make_pool):
+    pool = make_pool(2, max_failures=2, health_interval=60)
+    gpu0, gpu1 = pool.backends
+
+    gpu1.failures = 1
+    for _ in range(2):
+        gpu0.in_flight += 1  # слот, узятий acquire()
+        with pool.bind(gpu0) as lease:
+            lease.fault = True
+    assert not gpu0.healthy and gpu0.failures == 2
+    assert gpu0.in_flight == 0
+
+    # успішна задача лічильник скидає
+    gpu1.in_flight += 1
+    with pool.bind(gpu1):
+        pass
+    assert gpu1.healthy and gpu1.failures == 0
+
+    assert pool.acquire() is gpu1
+    assert pool.acquire(timeout=0.1) is None
+
+
+def test_health_check_readmits_backend(make_pool):
+    pool = make_pool(1, health_interval=0.1)
+    (gpu0,) = pool.backends
+
+    pool.alive["gpu0"] = False
+    assert _wait(lambda: not gpu0.healthy)
+    assert pool.acquire(timeout=0.2) is None
+
+    gpu0.failures = 5
+    pool.alive["gpu0"] = True
+    assert _wait(lambda: gpu0.healthy)
+    assert gpu0.failures == 0
+    assert pool.acquire(timeout=1) is gpu0
+
+
+def test_jobs_spread_over_all_backends(make_pool):
+    """Імітовані GPU: кожен бекенд має виконувати prompt-и строго по одному, а всі 4 — разом."""
+    pool = make_pool(4)
+    lock = threading.Lock()
+    running = {b.name: 0 for b in pool.backends}
+    ran = {b.name: 0 for b in pool.backends}
+    peak = {"total": 0, "per_backend": 0}
+    all_busy = threading.Barrier(4, timeout=5)
+
+    def comfy_call(first_wave):
+        backend = comfy_pool.current()
+        with lock:
+            running[backend.name] += 1
+            ran[backend.name] += 1
+            peak["total"] = max(peak["total"], sum(running.values()))
+            peak["per_backend"] = max(peak["per_backend"], running[backend.name])
+        if first_wave:
+            all_busy.wait()  # перші 4 задачі мають іти одночасно, кожна на своєму бекенді
+        time.sleep(0.005)
+        with lock:
+            running[backend.name] -= 1
+        comfy_pool.comfy_done()
+
+    def run(b, first_wave):
+        with pool.bind(b):
+            comfy_call(first_wave)
+
+    jobs = 24
+    with ThreadPoolExecutor(max_workers=pool.capacity) as runner:
+        futures = [runner.submit(run, pool.acquire(), i < 4) for i in range(jobs)]
+        for f in futures:
+            f.result()
+
+    assert sum(ran.values()) == jobs
+    assert all(ran.values()), ran
+    assert peak["total"] == 4
+    assert peak["per_backend"] == 1
+    assert all(b.in_flight == 0 for b in pool.backends)
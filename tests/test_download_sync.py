@@ -0,0 +1,54 @@
+import json
+import os
+
+import download_dependencies as dd
+
+
+def test_sync_stays_inside_target_dir(tmp_path, monkeypatch):
+    target = tmp_path / "input"
+    monkeypatch.setattr(dd, "COMFYUI_INPUT_DIR", str(target))
+    dd.init_downloader("token", "http://api.test/getFile", str(tmp_path / "train"), lambda m: None,
+                       file_manifest_url="http://api.test/manifest")
+    monkeypatch.chdir(tmp_path)
+
+    manifest = [
+        {"name": "a.txt", "size": 3},
+        {"name": "../../escape.txt", "size": 3},
+        {"name": "../../../../../../../../etc/evil.txt", "size": 3},
+    ]
+    monkeypatch.setattr(dd, "fetch_file_manifest", lambda prefix, names=None: manifest)
+    fetched = []
+
+    def fake_download(name, local_path, budget=None, expected_size=None, expected_sha256=None):
+        fetched.append(name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "w") as f:
+            f.write("abc")
+        return local_path
+
+    monkeypatch.setattr(dd, "_download_one", fake_download)
+
+    ok, failed, stats = dd.sync_files("ds/", [], "input")
+    expected = str(target / "ds" / "a.txt")
+    assert ok == [expected]
+    assert fetched == ["ds/a.txt"]
+    assert stats["skipped"] == 2
+    assert not (tmp_path / "escape.txt").exists()
+    assert not (tmp_path / "ds").exists()  # не відносно cwd
+
+    state_file = dd._sync_state_path("ds/", str(target))
+    with open(state_file) as f:
+        assert list(json.load(f)["files"]) == [expected]
+
+    # файл зник з маніфесту — прибираємо його, а відносні ключі старого стану не чіпаємо
+    (tmp_path / "input_rel.txt").write_text("abc")
+    with open(state_file) as f:
+        state = json.load(f)
+    st = os.stat(tmp_path / "input_rel.txt")
+    state["files"]["input_rel.txt"] = {"size": 3, "mtime_ns": st.st_mtime_ns}
+    with open(state_file, "w") as f:
+        json.dump(state, f)
+    manifest[:] = []
+    dd.sync_files("ds/", [], "input")
+    assert not os.path.exists(expected)
+    assert (tmp_path / "input_rel.txt").exists()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+
+import hash_cache
+
+
+def test_prehash_is_reused_by_sha256_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(hash_cache, "CACHE_DIR", str(tmp_path / ".sha256"))
+    path = tmp_path / "merged.mp4"
+    data = b"\x00\x00\x00\x18ftypmp42" + bytes(range(256)) * 4096
+    path.write_bytes(data)
+
+    reads = []
+    release = threading.Event()
+    real_read = hash_cache._sha256_read
+
+    def slow_read(p):
+        reads.append(p)
+        release.wait(5)
+        return real_read(p)
+
+    monkeypatch.setattr(hash_cache, "_sha256_read", slow_read)
+    fut = hash_cache.prehash(str(path))
+    assert hash_cache.prehash(str(path)) is fut
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(hash_cache.sha256_file(str(path))))
+    waiter.start()
+    release.set()
+    waiter.join(5)
+
+    expected = hashlib.sha256(data).hexdigest()
+    assert fut.result() == expected
+    assert result == [expected]
+    assert reads == [str(path)]  # файл прочитано один раз
+    assert hash_cache.lookup(str(path)) == expected
+
+
+def test_memory_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(hash_cache, "CACHE_DIR", str(tmp_path / ".sha256"))
+    monkeypatch.setattr(hash_cache, "MEM_ENTRIES", 3)
+    monkeypatch.setattr(hash_cache, "_MEM", hash_cache.OrderedDict())
+    for i in range(5):
+        p = tmp_path / f"f{i}"
+        p.write_bytes(b"x" * i)
+        hash_cache.remember(str(p), "0" * 64)
+    assert len(hash_cache._MEM) == 3
+    # з памʼяті витіснено, але диск кешу ще знає
+    assert hash_cache.lookup(str(tmp_path / "f0")) == "0" * 64
+
+
+def test_prune_drops_entries_of_gone_changed_and_old_files(tmp_path, monkeypatch):
+    cache = tmp_path / ".sha256"
+    monkeypatch.setattr(hash_cache, "CACHE_DIR", str(cache))
+    keep, gone, changed = (tmp_path / n for n in ("keep", "gone", "changed"))
+    for p in (keep, gone, changed):
+        p.write_bytes(b"data")
+        hash_cache.remember(str(p), "1" * 64)
+    gone.unlink()
+    changed.write_bytes(b"other data")
+    assert len(os.listdir(cache)) == 3
+
+    assert hash_cache.prune() == 2
+    assert len(os.listdir(cache)) == 1
+    hash_cache._MEM.clear()
+    assert hash_cache.lookup(str(keep)) == "1" * 64
+
+    old = os.path.join(cache, os.listdir(cache)[0])
+    os.utime(old, (0, 0))
+    assert hash_cache.prune(max_age_days=7) == 1
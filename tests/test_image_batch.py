@@ -0,0 +1,57 @@
+import base64
+import json
+
+from comfy_stream import parse_prompt_response
+from image_batch import merge_workflows
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+def _workflow(prompt, seed):
+    return {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sdxl.safetensors"}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": ["4", 1]}},
+        "10": {"class_type": "KSampler", "inputs": {"seed": seed, "model": ["4", 0], "positive": ["6", 0]}},
+        "17": {"class_type": "VAEDecode", "inputs": {"samples": ["10", 0], "vae": ["4", 2]}},
+        "19": {"class_type": "SaveImage", "inputs": {"filename_prefix": "lora_char", "images": ["17", 0]}},
+    }
+
+
+def _chunks(body: bytes, size=7):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def test_merge_shares_loader_and_tags_outputs():
+    batch = merge_workflows([_workflow("cat", 1), _workflow("dog", 2)], tag="t1")
+    loaders = [n for n in batch.workflow.values() if n["class_type"] == "CheckpointLoaderSimple"]
+    assert len(loaders) == 1
+    assert batch.sinks == [{"b0_19"}, {"b1_19"}]
+    assert batch.workflow["b1_19"]["inputs"]["filename_prefix"] == "t1-1-lora_char"
+
+
+def test_route_comfyui_api_response(tmp_path):
+    batch = merge_workflows([_workflow("cat", 1), _workflow("dog", 2)], tag="t1")
+    # так відповідає comfyui-api: images — голі base64, імена — окремим списком
+    body = json.dumps({
+        "id": "p1",
+        "images": [base64.b64encode(PNG).decode(), base64.b64encode(PNG + b"x").decode()],
+        "filenames": ["t1-1-lora_char_00001_.png", "t1-0-lora_char_00001_.png"],
+    }).encode()
+
+    result = parse_prompt_response(_chunks(body), out_dir=str(tmp_path))
+    groups = batch.route(result["images"])
+
+    assert groups is not None
+    assert [g[0]["filename"] for g in groups] == ["t1-0-lora_char_00001_.png", "t1-1-lora_char_00001_.png"]
+    assert [g[0]["size"] for g in groups] == [len(PNG) + 1, len(PNG)]
+
+
+def test_route_ws_files_by_node():
+    batch = merge_workflows([_workflow("cat", 1), _workflow("dog", 2)], tag="t1")
+    groups = batch.route([{"node": "b1_19", "path": "/x/b.png"}, {"node": "b0_19", "path": "/x/a.png"}])
+    assert [g[0]["path"] for g in groups] == ["/x/a.png", "/x/b.png"]
+
+
+def test_route_unknown_image_is_ambiguous():
+    batch = merge_workflows([_workflow("cat", 1), _workflow("dog", 2)], tag="t1")
+    assert batch.route([{"index": 0}]) is None
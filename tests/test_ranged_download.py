@@ -0,0 +1,38 @@
+import hashlib
+
+import pytest
+
+import ranged_download
+
+
+def _fake_fetch(data, skip=()):
+    def fetch(url, headers, fd, progress, idx, budget, endpoint):
+        if idx in skip:
+            return  # "успішний" діапазон, який нічого не записав
+        start, end = ranged_download._range_bounds(idx, progress.state["size"], progress.state["range_size"])
+        ranged_download.os.pwrite(fd, data[start:end + 1], start)
+        with progress.lock:
+            progress.state["done"][idx] = end - start + 1
+    return fetch
+
+
+def test_ranged_fetch_hashes_all_ranges(tmp_path, monkeypatch):
+    data = bytes(range(256)) * 40
+    monkeypatch.setattr(ranged_download, "_fetch_range", _fake_fetch(data))
+    part = str(tmp_path / "model.part")
+
+    sha = ranged_download.fetch_ranged("http://x/m", part, len(data), "etag", range_size=1000, connections=3,
+                                       log=lambda m: None)
+    assert sha == hashlib.sha256(data).hexdigest()
+    assert open(part, "rb").read() == data
+
+
+def test_ranged_fetch_rejects_uncovered_ranges(tmp_path, monkeypatch):
+    data = bytes(range(256)) * 40
+    monkeypatch.setattr(ranged_download, "_fetch_range", _fake_fetch(data, skip={4}))
+    part = str(tmp_path / "model.part")
+
+    # .part уже має повний розмір (fallocate) — перевірка розміру цього б не помітила
+    with pytest.raises(IOError, match="не докачано"):
+        ranged_download.fetch_ranged("http://x/m", part, len(data), "etag", range_size=1000, connections=3,
+                                     log=lambda m: None)
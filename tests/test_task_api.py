@@ -0,0 +1,146 @@
+import time
+
+import pytest
+
+import task_api
+import worker
+from image_batch import ImageBatcher
+from model_affinity import AffinityScheduler
+from task_api import LEASE_KEY, StatusBatcher, TaskLeaser, filter_leased
+from task_server import TaskServer
+
+
+def _tasks(n, ttype="lora_image"):
+    return [{"id": i, "type": ttype, "workflow_key": "lora_xl_v1", "payload": {}, "dependency": []} for i in range(1, n + 1)]
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    servers = []
+    task_api.init_task_api("test-token", lambda m: None)
+    monkeypatch.setattr(worker, "log", lambda m: None)
+
+    def start(tasks=(), **kw):
+        srv = TaskServer(tasks, **kw)
+        servers.append(srv)
+        monkeypatch.setattr(task_api, "GET_TASKS_URL", srv.url("worker/getTasks"))
+        monkeypatch.setattr(task_api, "UPDATE_TASKS_URL", srv.url("worker/updateTasks"))
+        monkeypatch.setattr(task_api, "RELEASE_TASKS_URL", srv.url("worker/releaseTasks"))
+        monkeypatch.setattr(worker, "GET_TASK_URL", srv.url("worker/getTask"))
+        monkeypatch.setattr(worker, "UPDATE_TASK_URL", srv.url("worker/updateTask"))
+        return srv
+
+    yield start
+    for srv in servers:
+        srv.close()
+
+
+def _leaser(batch_size=3, lease_sec=600):
+    return TaskLeaser(get_task_single=worker.get_task, batch_size=batch_size, lease_sec=lease_sec, log=lambda m: None)
+
+
+def test_leases_batch_and_returns_unstarted_on_shutdown(serve):
+    srv = serve(_tasks(5))
+    leaser = _leaser(batch_size=3)
+
+    assert leaser.get_task()["id"] == 1
+    assert leaser.get_task()["id"] == 2
+    assert srv.routes() == ["worker/getTasks"]
+
+    leaser.release_pending()
+    assert srv.released == [3]
+    assert [t["id"] for t in srv.tasks] == [4, 5]
+
+
+def test_old_backend_falls_back_to_get_task(serve):
+    srv = serve(_tasks(2), batched=False)
+    leaser = _leaser()
+
+    assert leaser.get_task()["id"] == 1
+    assert leaser.get_task()["id"] == 2
+    assert leaser.get_task() is None
+    assert srv.routes() == ["worker/getTasks", "worker/getTask", "worker/getTask", "worker/getTask"]
+
+
+def test_leasing_is_not_retried(serve):
+    srv = serve(_tasks(2))
+    srv.fail = {"worker/getTasks": 503, "worker/getTask": 503}
+
+    assert _leaser().get_task() is None
+    assert worker.get_task() is None
+    # повтор міг би орендувати ще одну пачку/задачу, яку ніхто не запустить
+    assert srv.routes() == ["worker/getTasks", "worker/getTask"]
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_status_batcher_against_both_endpoints(serve, batched):
+    srv = serve(batched=batched)
+    batcher = StatusBatcher(send_single=worker.send_task_status, flush_interval=0.05, log=lambda m: None)
+    batcher.update(1, "running", payload_update={"stage": "a"})
+    batcher.update(1, "running", payload_update={"stage": "b"})  # зливається з попереднім
+    batcher.update(2, "done")
+    batcher.update(1, "done")
+    batcher.close()
+
+    assert sorted(srv.statuses) == [(1, "done"), (1, "running"), (2, "done")]
+    if batched:
+        assert set(srv.routes()) == {"worker/updateTasks"}
+    else:
+        assert srv.routes().count("worker/updateTask") == 3
+
+
+def test_expiring_lease_is_released_not_started(serve):
+    srv = serve(_tasks(2), lease_until=time.time() + 2)
+    leaser = _leaser()
+
+    assert leaser.get_task() is None
+    assert sorted(srv.released) == [1, 2]
+
+
+def test_expired_lease_is_dropped_without_release(serve):
+    srv = serve(_tasks(2), lease_until=time.time() - 1)
+    leaser = _leaser()
+
+    assert leaser.get_task() is None
+    # задачу вже міг отримати інший воркер — повертати її не наше право
+    assert srv.released == []
+
+
+def test_buffered_tasks_respect_lease(serve):
+    srv = serve()
+    stale, fresh = _tasks(2)
+    stale[LEASE_KEY] = time.time() + 1
+    fresh[LEASE_KEY] = time.time() + 600
+    queue = [stale, fresh]
+
+    scheduler = AffinityScheduler(
+        get_task=lambda loaded_models=None: queue.pop(0) if queue else None,
+        task_models=lambda t: frozenset(),
+        buffer_size=2,
+        lease_check=filter_leased,
+        log=lambda m: None,
+    )
+    scheduler._fill()
+    assert scheduler.next_task()["id"] == 2
+    assert srv.released == [1]
+
+
+def test_batcher_held_tasks_respect_lease(serve):
+    srv = serve()
+    other = dict(_tasks(1, "frame_wan")[0], id=7)
+    other[LEASE_KEY] = time.time() - 1
+    queue = [other]
+    batcher = ImageBatcher(
+        get_task=lambda: queue.pop(0) if queue else None,
+        batch_key=lambda t: "k",
+        max_batch=2,
+        max_wait=0.05,
+        lease_check=filter_leased,
+        log=lambda m: None,
+    )
+    first = _tasks(1)[0]
+    assert batcher.collect(first) == [first]
+    assert batcher.pending() == [other]
+    assert batcher.next_task() is None
+    assert batcher.pending() == []
+    assert srv.released == []
@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+import upscale_runner
+
+
+def test_watch_failure_cancels_prompt_before_raising(monkeypatch, tmp_path):
+    monkeypatch.setattr(upscale_runner, "TMP_DIR", str(tmp_path))
+    cancelled = threading.Event()
+    comfy_returned = threading.Event()
+    calls = []
+
+    def fake_comfy(workflow_key, payload, timeout_sec, comfy_id):
+        # Comfy "рахує", доки prompt не знімуть
+        assert cancelled.wait(5)
+        comfy_returned.set()
+        raise RuntimeError("interrupted")
+
+    def failing_watch(*a, **kw):
+        raise TimeoutError("segments stalled")
+        yield  # noqa — генератор
+
+    def fake_cancel(prompt_id, server=None):
+        calls.append(prompt_id)
+        cancelled.set()
+        return True
+
+    monkeypatch.setattr(upscale_runner, "iter_outputs", failing_watch)
+    monkeypatch.setattr(upscale_runner, "cancel_prompt", fake_cancel)
+
+    with pytest.raises(TimeoutError):
+        upscale_runner.run_upscale_streaming(
+            workflow_key="wan_video_upscale", payload={}, run_comfy_training_workflow=fake_comfy, log=lambda m: None,
+        )
+    assert len(calls) == 1
+    # помилка задачі виходить лише після того, як Comfy відпустив GPU
+    assert comfy_returned.is_set()
+
+
+class _StubMerger:
+    def __init__(self, out_path, log):
+        self.out_path = out_path
+        self.failed = None
+
+    def append(self, path, info):
+        pass
+
+    def finish(self):
+        open(self.out_path, "wb").close()
+        return True
+
+    def abort(self):
+        pass
+
+
+def test_segments_upload_as_parts_while_comfy_runs(monkeypatch, tmp_path):
+    import upload
+
+    monkeypatch.setattr(upscale_runner, "TMP_DIR", str(tmp_path))
+    monkeypatch.setattr(upscale_runner, "_StreamMerger", _StubMerger)
+    info = {"codec": "avc1", "width": 64, "height": 64, "fps": 16, "frames": 16, "duration": 1.0}
+    monkeypatch.setattr(upscale_runner, "validate_segments", lambda paths, log: [dict(info) for _ in paths])
+
+    segments = []
+    for i in range(3):
+        seg = tmp_path / f"seg_{i}.mp4"
+        seg.write_bytes(bytes([i]) * 1000)
+        segments.append(str(seg))
+
+    events = []
+    all_parts_sent = threading.Event()
+
+    def fake_upload_chunked(path, task_id, file_name=None, **kw):
+        events.append(("part", file_name))
+        if len([e for e in events if e[0] == "part"]) == len(segments):
+            all_parts_sent.set()
+        return {"status": "ok"}
+
+    merged = []
+
+    def fake_merge(task_id, file_name, parts):
+        merged.append((file_name, [p["file_name"] for p in parts]))
+        return {"status": "ok", "path": f"/results/{file_name}"}
+
+    monkeypatch.setattr(upload, "upload_chunked", fake_upload_chunked)
+    monkeypatch.setattr(upload, "merge_parts", fake_merge)
+
+    def fake_watch(patterns, finished, timeout_sec, min_size):
+        yield from segments
+        while not finished():
+            time.sleep(0.01)
+
+    def fake_comfy(workflow_key, payload, timeout_sec, comfy_id):
+        # Comfy "генерує", поки частини не поїхали на сервер; без аплоаду під час генерації — таймаут
+        assert all_parts_sent.wait(5)
+        events.append(("comfy_returned", None))
+        return {"id": comfy_id}
+
+    monkeypatch.setattr(upscale_runner, "iter_outputs", fake_watch)
+
+    parts = upload.PartUploader(42, log=lambda m: None)
+    result, final, local, segs, report = upscale_runner.run_upscale_streaming(
+        workflow_key="wan_video_upscale", payload={}, run_comfy_training_workflow=fake_comfy,
+        log=lambda m: None, parts=parts,
+    )
+    assert report["mode"] == "stream_copy"
+    assert events.index(("comfy_returned", None)) == len(segments)
+
+    res = parts.finish("upscale.mp4")
+    assert res["path"] == "/results/upscale.mp4"
+    assert merged == [("upscale.mp4", [f"part{i:04d}-seg_{i}.mp4" for i in range(3)])]
+
+
+def test_incompatible_segment_cancels_part_upload(monkeypatch, tmp_path):
+    import upload
+
+    monkeypatch.setattr(upload, "upload_chunked", lambda *a, **kw: {"status": "ok"})
+    merged = []
+    monkeypatch.setattr(upload, "merge_parts", lambda *a: merged.append(a))
+    parts = upload.PartUploader(42, log=lambda m: None)
+    parts.add(str(tmp_path / "missing.mp4"))
+    parts.abort("сегмент не збігається з першим")
+
+    assert parts.finish("upscale.mp4") is None
+    assert merged == []
@@ -0,0 +1,10 @@
+from workflow_templates import compile_text
+
+
+def test_unused_skips_ignored_keys():
+    template = compile_text('{"1": {"inputs": {"text": "param_prompt", "seed": param_seed}}}')
+    payload = {"prompt": "a cat", "seed": 1, "task_id": 7, "typo_seed": 2}
+
+    assert template.unused(payload) == ["task_id", "typo_seed"]
+    assert template.unused(payload, ignore={"task_id"}) == ["typo_seed"]
+    assert template.fill(payload)["1"]["inputs"] == {"text": "a cat", "seed": 1}
@@ -1,44 +1,52 @@
 import os
+import json
 import time
-import hashlib
-import requests
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import http_client
+import hash_cache
 
 API_BASE = os.environ["API_BASE"]
 _API_TOKEN = None
 _UPLOAD_FILE_URL = None
 _UPLOAD_IMAGE_URL = None
 _LOG = None
+_WINDOW = 1
+_IMAGE_WORKERS = 4
+PROGRESS_LOG_SEC = 5.0      # не частіше одного рядка прогресу на N секунд
 UPLOAD_INIT  = f"{API_BASE}/index.php?r=chunkUpload/uploadInit"
 UPLOAD_CHUNK  = f"{API_BASE}/index.php?r=chunkUpload/uploadChunk"
 UPLOAD_FINAL  = f"{API_BASE}/index.php?r=chunkUpload/uploadFinal"
+UPLOAD_MERGE  = f"{API_BASE}/index.php?r=chunkUpload/mergeParts"
 
 
-def init_uploader(api_token: str, upload_file_url: str, upload_image_url: str, log_fn):
+def init_uploader(api_token: str, upload_file_url: str, upload_image_url: str, log_fn, chunk_window: int = 1,
+                  image_workers: int = 4):
     """
     Викликати один раз при старті воркера (в main.py).
+    chunk_window — максимум шматків upload_chunked одночасно в польоті.
+    image_workers — скільки зображень однієї задачі upload_images шле паралельно.
     """
-    global _API_TOKEN, _UPLOAD_FILE_URL, _UPLOAD_IMAGE_URL, _LOG
+    global _API_TOKEN, _UPLOAD_FILE_URL, _UPLOAD_IMAGE_URL, _LOG, _WINDOW, _IMAGE_WORKERS
     _API_TOKEN = api_token
     _UPLOAD_FILE_URL = upload_file_url
     _UPLOAD_IMAGE_URL = upload_image_url
     _LOG = log_fn
+    _WINDOW = max(1, int(chunk_window))
+    _IMAGE_WORKERS = max(1, int(image_workers))
 
 def sha256_file(path, chunk=1024 * 1024):
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        while True:
-            b = f.read(chunk)
-            if not b:
-                break
-            h.update(b)
-    return h.hexdigest()
+    # хеш з кешу (path, size, mtime_ns, inode) — вже пораховані файли не читаються вдруге
+    return hash_cache.sha256_file(path)
 
 
 def upload_file(task_id: int, path: str):
     files = {"file": open(path, "rb")}
     data = {"token": _API_TOKEN, "task_id": task_id, "file_name": os.path.basename(path)}
     try:
-        r = requests.post(_UPLOAD_FILE_URL, data=data, files=files, timeout=120)
+        r = http_client.post(_UPLOAD_FILE_URL, endpoint="upload.file", data=data, files=files, timeout=120)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -52,7 +60,7 @@ def upload_image(task_id: int, path: str):
     files = {"file": open(path, "rb")}
     data = {"token": _API_TOKEN, "task_id": task_id, "file_name": os.path.basename(path)}
     try:
-        r = requests.post(_UPLOAD_IMAGE_URL, data=data, files=files, timeout=120)
+        r = http_client.post(_UPLOAD_IMAGE_URL, endpoint="upload.image", data=data, files=files, timeout=120)
         r.raise_for_status()
         resp = r.json()
         return resp.get("result_path")
@@ -63,20 +71,183 @@ def upload_image(task_id: int, path: str):
         files["file"].close()
 
 
+def upload_images(task_id: int, paths: list):
+    """
+    Усі зображення задачі паралельно (зʼєднання беруться з пулу http_client).
+    Повертає список result_path у порядку paths або None, якщо хоч одне не пройшло.
+    """
+    workers = max(1, min(_IMAGE_WORKERS, len(paths)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-image") as ex:
+        results = list(ex.map(lambda p: upload_image(task_id, p), paths))
+    if not all(results):
+        failed = [os.path.basename(p) for p, r in zip(paths, results) if not r]
+        _LOG(f"[upload] #{task_id}: не завантажились {', '.join(failed)}")
+        return None
+    return results
+
+
+class _Rewind(Exception):
+    """Сервер втратив або не отримав попередні шматки — треба почати заново з його offset."""
+
+    def __init__(self, offset: int):
+        super().__init__(f"rewind to {offset}")
+        self.offset = offset
+
+
+class _ChunkPipeline:
+    """
+    Ковзне вікно шматків в польоті. Сервер приймає шматки по порядку і на
+    чужий offset відповідає 409 {"expected_offset"}; шматки, що обігнали
+    попередників, чекають, поки confirmed дожене їхній offset, і повторюються
+    з тими самими даними (без повторного читання файлу).
+    """
+
+    def __init__(self, file_name: str, task_id, headers: dict, confirmed: int, max_retries: int):
+        self.file_name = file_name
+        self.task_id = task_id
+        self.headers = {**headers, "Content-Type": "application/octet-stream"}
+        self.max_retries = max_retries
+        self.confirmed = confirmed
+        self._cond = threading.Condition()
+
+    def note(self, server_offset: int):
+        with self._cond:
+            if server_offset > self.confirmed:
+                self.confirmed = server_offset
+                self._cond.notify_all()
+
+    def reset(self, server_offset: int):
+        with self._cond:
+            self.confirmed = server_offset
+
+    def _wait_confirmed(self, offset: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.confirmed >= offset, timeout)
+
+    def send(self, offset: int, data) -> float:
+        """Відправляє шматок [offset, offset+len(data)). Повертає час мережевих запитів."""
+        end = offset + len(data)
+        attempt = 0
+        waits = 0
+        spent = 0.0
+        while True:
+            start = max(offset, self.confirmed)
+            if start >= end:
+                return spent
+            t0 = time.monotonic()
+            try:
+                rr = http_client.post(
+                    UPLOAD_CHUNK,
+                    endpoint="upload.chunk",
+                    headers=self.headers,
+                    params={"task_id": self.task_id, "file_name": self.file_name, "offset": str(start)},
+                    data=data[start - offset:],
+                    timeout=120,
+                )
+                spent += time.monotonic() - t0
+
+                if rr.status_code == 409:
+                    expected = int(rr.json().get("expected_offset", start))
+                    if expected == start:
+                        raise RuntimeError(f"409 on expected offset {start}")
+                    if expected > start:
+                        self.note(expected)
+                        continue
+                    # попередній шматок ще в дорозі — чекаємо його, а не шлемо дані наново
+                    waits += 1
+                    if waits > 3 or not self._wait_confirmed(start, 5.0 * waits):
+                        raise _Rewind(expected)
+                    continue
+
+                rr.raise_for_status()
+                jj = rr.json()
+                if jj.get("status") != "ok":
+                    raise RuntimeError(jj)
+                self.note(int(jj["uploaded_bytes"]))
+                return spent
+
+            except _Rewind:
+                raise
+            except Exception as e:
+                spent += time.monotonic() - t0
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                sleep = min(2 ** attempt, 30)
+                _LOG(f"[upload] chunk @{start}: retry {attempt}/{self.max_retries} after {sleep}s: {e}")
+                time.sleep(sleep)
+
+
+class _Tuner:
+    """
+    Підлаштовує вікно (hill climbing за сумарною швидкістю) і розмір шматка
+    (щоб один запит тривав ~TARGET_SEC при поточній швидкості одного потоку).
+    """
+    TARGET_SEC = 2.0
+    MIN_CHUNK = 1024 * 1024
+    MAX_CHUNK = 32 * 1024 * 1024
+
+    def __init__(self, chunk_size: int, window: int, max_window: int):
+        self.chunk_size = chunk_size
+        self.window = window
+        self.max_window = max_window
+        self._direction = 1
+        self._last_rate = 0.0
+        self._bytes = 0
+        self._net_sec = 0.0
+        self._t0 = time.monotonic()
+        self._chunks = 0
+
+    def record(self, nbytes: int, net_sec: float):
+        self._bytes += nbytes
+        self._net_sec += net_sec
+        self._chunks += 1
+        if self._chunks < max(4, self.window * 2):
+            return
+
+        wall = max(time.monotonic() - self._t0, 1e-6)
+        rate = self._bytes / wall
+        per_stream = self._bytes / max(self._net_sec, 1e-6)
+
+        if self.max_window > 1:
+            if rate < self._last_rate * 0.95:
+                self._direction = -self._direction
+            if rate < self._last_rate * 0.95 or rate > self._last_rate * 1.05:
+                self.window = max(1, min(self.max_window, self.window + self._direction))
+        self._last_rate = rate
+
+        size = int(per_stream * self.TARGET_SEC) // self.MIN_CHUNK * self.MIN_CHUNK
+        self.chunk_size = max(self.MIN_CHUNK, min(self.MAX_CHUNK, size))
+
+        self._bytes = 0
+        self._net_sec = 0.0
+        self._chunks = 0
+        self._t0 = time.monotonic()
+
+
 def upload_chunked(
     file_path: str,
     task_id: int,
     chunk_size: int = 2 * 1024 * 1024,
     max_retries: int = 8,
+    window: int = None,
+    file_name: str = None,
 ):
+    """
+    window — скільки шматків одночасно в польоті (None -> з init_uploader).
+    window=1 — послідовно, як раніше; розмір шматка адаптується і тоді.
+    file_name — імʼя на сервері (за замовчуванням basename файлу).
+    """
     total_size = os.path.getsize(file_path)
     file_hash = sha256_file(file_path)
+    file_name = file_name or os.path.basename(file_path)
+    max_window = max(1, window or _WINDOW)
 
     headers = {"X-Auth-Token": _API_TOKEN}
 
-    r = requests.post(UPLOAD_INIT, headers=headers, data={
+    r = http_client.post(UPLOAD_INIT, endpoint="upload.init", headers=headers, data={
         "task_id": task_id,
-        "file_name": os.path.basename(file_path),
+        "file_name": file_name,
         "total_size": str(total_size),
         "sha256": file_hash,
     }, timeout=30)
@@ -88,54 +259,27 @@ def upload_chunked(
     uploaded = int(j["uploaded_bytes"])
     _LOG(f"[upload] resume from {uploaded}/{total_size}")
 
-    with open(file_path, "rb") as f:
-        f.seek(uploaded)
-        offset = uploaded
-
-        while offset < total_size:
-            data = f.read(chunk_size)
-            if not data:
-                break
+    pipe = _ChunkPipeline(file_name, task_id, headers, uploaded, max_retries)
+    tuner = _Tuner(chunk_size, min(2, max_window), max_window)
+    t_start = time.monotonic()
 
-            attempt = 0
-            while True:
+    with open(file_path, "rb") as f:
+        # шматки — memoryview-зрізи mmap: ні копій у bytes, ні повторних read на retry
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if total_size else None
+        view = memoryview(mm) if mm is not None else memoryview(b"")
+        try:
+            _send_window(pipe, tuner, view, total_size, uploaded, max_window, max_retries)
+        finally:
+            view.release()
+            if mm is not None:
                 try:
-                    rr = requests.post(
-                        UPLOAD_CHUNK,
-                        headers={**headers, "Content-Type": "application/octet-stream"},
-                        params={"task_id": task_id, "file_name": os.path.basename(file_path), "offset": str(offset)},
-                        data=data,
-                        timeout=120,
-                    )
-
-                    if rr.status_code == 409:
-                        jj = rr.json()
-                        offset = int(jj.get("expected_offset", offset))
-                        f.seek(offset)
-                        _LOG(f"[upload] offset mismatch, jump to {offset}")
-                        data = f.read(chunk_size)
-                        continue
-
-                    rr.raise_for_status()
-                    jj = rr.json()
-                    if jj.get("status") != "ok":
-                        raise RuntimeError(jj)
+                    mm.close()
+                except BufferError:
+                    pass  # зріз ще тримає обʼєкт запиту; mmap закриється разом з ним
 
-                    offset = int(jj["uploaded_bytes"])
-                    _LOG(f"[upload] {offset}/{total_size}")
-                    break
-
-                except Exception as e:
-                    attempt += 1
-                    if attempt > max_retries:
-                        raise
-                    sleep = min(2 ** attempt, 30)
-                    _LOG(f"[upload] retry {attempt}/{max_retries} after {sleep}s: {e}")
-                    time.sleep(sleep)
-
-    rf = requests.post(UPLOAD_FINAL, headers=headers, data={
+    rf = http_client.post(UPLOAD_FINAL, endpoint="upload.final", headers=headers, data={
         "task_id": task_id,
-        "file_name": os.path.basename(file_path),
+        "file_name": file_name,
         "total_size": str(total_size),
         "sha256": file_hash,
     }, timeout=60)
@@ -144,9 +288,149 @@ def upload_chunked(
     if jf.get("status") != "ok":
         raise RuntimeError(jf)
 
-    _LOG(f"[upload] DONE: {jf.get('path')} size={jf.get('size')}")
+    _LOG(f"[upload] DONE: {jf.get('path')} size={jf.get('size')} in {time.monotonic() - t_start:.1f}s")
     return jf
 
+
+def _send_window(pipe: _ChunkPipeline, tuner: _Tuner, view, total_size: int, uploaded: int,
+                 max_window: int, max_retries: int):
+    next_offset = uploaded
+    rewinds = 0
+    t_start = time.monotonic()
+    last_log = 0.0
+
+    with ThreadPoolExecutor(max_workers=max_window, thread_name_prefix="upload-chunk") as ex:
+        inflight = {}
+        while pipe.confirmed < total_size:
+            while len(inflight) < tuner.window and next_offset < total_size:
+                data = view[next_offset:min(total_size, next_offset + tuner.chunk_size)]
+                inflight[ex.submit(pipe.send, next_offset, data)] = len(data)
+                next_offset += len(data)
+
+            if not inflight:
+                # усе відправлено, але сервер підтвердив менше — шлемо з його offset
+                rewinds += 1
+                if rewinds > max_retries:
+                    raise RuntimeError(f"upload stalled at {pipe.confirmed}/{total_size}")
+                next_offset = pipe.confirmed
+                continue
+
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            rewind_to = None
+            for fut in done:
+                nbytes = inflight.pop(fut)
+                try:
+                    tuner.record(nbytes, fut.result())
+                except _Rewind as e:
+                    rewind_to = e.offset if rewind_to is None else min(rewind_to, e.offset)
+
+            if rewind_to is not None:
+                rewinds += 1
+                if rewinds > max_retries:
+                    raise RuntimeError(f"upload keeps rewinding, server at {rewind_to}/{total_size}")
+                for fut in list(inflight):
+                    try:
+                        fut.result()
+                    except _Rewind as e:
+                        rewind_to = min(rewind_to, e.offset)
+                inflight.clear()
+                _LOG(f"[upload] offset mismatch, jump to {rewind_to}")
+                pipe.reset(rewind_to)
+                next_offset = rewind_to
+
+            now = time.monotonic()
+            if now - last_log >= PROGRESS_LOG_SEC:
+                last_log = now
+                rate = (pipe.confirmed - uploaded) / max(now - t_start, 1e-6) / 1024 ** 2
+                _LOG(
+                    f"[upload] {pipe.confirmed}/{total_size} {rate:.1f} MB/s "
+                    f"(window={tuner.window}, chunk={tuner.chunk_size / 1024 ** 2:.1f} MB)"
+                )
+
+
+def merge_parts(task_id, file_name: str, parts: list):
+    """
+    Просить сервер склеїти вже завантажені частини (copy-only concat) у file_name.
+    parts — [{"index", "file_name", "size", "sha256"}] у порядку відтворення.
+    Повертає відповідь як uploadFinal; None — сервер не знає mergeParts (старий бекенд).
+    """
+    headers = {"X-Auth-Token": _API_TOKEN}
+    r = http_client.post(UPLOAD_MERGE, endpoint="upload.merge", headers=headers, data={
+        "task_id": task_id,
+        "file_name": file_name,
+        "parts": json.dumps(parts),
+    }, timeout=600)
+    if r.status_code in (404, 405, 501):
+        return None
+    r.raise_for_status()
+    j = r.json()
+    if j.get("status") != "ok":
+        raise RuntimeError(j)
+    return j
+
+
+class PartUploader:
+    """
+    Аплоад сегментів відео окремими частинами, поки Comfy ще генерує наступні.
+    add(path) — частина йде у фон (по одній за раз, кожна — upload_chunked);
+    finish(file_name) — дочікується частин і просить сервер склеїти їх (merge_parts),
+    тож після GPU лишається дослати останній сегмент і дочекатися склейки.
+    None з finish() — частин немає/не вдалися/сервер не вміє склеювати:
+    викликач аплоадить локально склеєний файл як раніше.
+    """
+
+    def __init__(self, task_id, log=None):
+        self.task_id = task_id
+        self._log = log or _LOG
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-part")
+        self._parts = []
+        self.failed = None
+
+    def add(self, path: str):
+        if self.failed:
+            return
+        index = len(self._parts)
+        name = f"part{index:04d}-{os.path.basename(path)}"
+        self._parts.append(self._pool.submit(self._upload, index, path, name))
+
+    def _upload(self, index: int, path: str, name: str) -> dict:
+        t0 = time.monotonic()
+        upload_chunked(path, self.task_id, file_name=name)
+        part = {"index": index, "file_name": name, "size": os.path.getsize(path), "sha256": sha256_file(path)}
+        self._log(f"[upload] #{self.task_id}: частина {index} ({part['size']} байт) за {time.monotonic() - t0:.1f}s")
+        return part
+
+    def abort(self, reason: str):
+        """Частини більше не потрібні (напр. несумісний сегмент): решту не шлемо."""
+        if not self.failed:
+            self.failed = reason
+            self._log(f"[upload] #{self.task_id}: аплоад частинами скасовано: {reason}")
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def finish(self, file_name: str):
+        try:
+            if self.failed or not self._parts:
+                return None
+            try:
+                parts = [f.result() for f in self._parts]
+            except Exception as e:
+                self._log(f"[upload] #{self.task_id}: частина не завантажилась ({e}), аплоадимо файл цілком")
+                return None
+            t0 = time.monotonic()
+            try:
+                res = merge_parts(self.task_id, file_name, parts)
+            except Exception as e:
+                self._log(f"[upload] #{self.task_id}: склейка на сервері не вдалася ({e}), аплоадимо файл цілком")
+                return None
+            if res is None:
+                self._log(f"[upload] #{self.task_id}: сервер не підтримує mergeParts, аплоадимо файл цілком")
+                return None
+            self._log(f"[upload] #{self.task_id}: {len(parts)} частин склеєно на сервері за {time.monotonic() - t0:.1f}s")
+            return res
+        finally:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
 def upload_samples(task_id, samples_dir="/opt/output/sample"):
     if not os.path.isdir(samples_dir):
         _LOG(f"[INFO] samples dir not found: {samples_dir}")
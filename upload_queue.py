@@ -0,0 +1,114 @@
+# upload_queue.py
+"""
+Фонова черга аплоадів: готовий результат віддається сюди, а GPU одразу
+береться за наступну задачу. Статус done/failed відправляється з колбеків
+лише тоді, коли аплоад реально завершився.
+"""
+import os
+import queue
+import threading
+import traceback
+
+
+class UploadJob:
+    __slots__ = ("task_id", "path", "size", "upload", "on_done", "on_error")
+
+    def __init__(self, task_id, path, size, upload, on_done, on_error):
+        self.task_id = task_id
+        self.path = path
+        self.size = size
+        self.upload = upload
+        self.on_done = on_done
+        self.on_error = on_error
+
+
+class UploadQueue:
+    """
+    workers=0 — синхронний режим (як раніше): submit() виконує аплоад одразу.
+    max_queued_bytes — скільки байт може чекати в черзі; submit() блокується,
+    поки місце не звільниться, щоб TMP_DIR не переповнився.
+    """
+
+    def __init__(self, *, workers: int = 2, max_queued_bytes: int = 0, log=print):
+        self._log = log
+        self._workers = workers
+        self._max_bytes = max_queued_bytes
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+        self._q = queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name=f"upload-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    def submit(self, *, task_id, path: str, upload, on_done, on_error):
+        """
+        upload(): виконує аплоад і повертає результат (None/False = невдача — вирішує on_done).
+        on_done(result) / on_error(exc) викликаються з потоку аплоаду.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        job = UploadJob(task_id, path, size, upload, on_done, on_error)
+
+        if not self._workers:
+            self._execute(job)
+            return
+
+        with self._cond:
+            # одна велика задача завжди проходить, якщо черга порожня
+            while self._max_bytes and self._queued_bytes and self._queued_bytes + size > self._max_bytes:
+                self._log(
+                    f"[upload-queue] #{task_id}: черга повна ({self._queued_bytes} байт), чекаємо"
+                )
+                self._cond.wait()
+            self._queued_bytes += size
+
+        self._log(f"[upload-queue] #{task_id}: {os.path.basename(path)} ({size} байт) в черзі")
+        self._q.put(job)
+
+    def _execute(self, job: UploadJob):
+        try:
+            result = job.upload()
+        except Exception as e:
+            try:
+                job.on_error(e)
+            except Exception:
+                self._log(f"[upload-queue] #{job.task_id}: on_error впав:\n{traceback.format_exc()}")
+            return
+        try:
+            job.on_done(result)
+        except Exception:
+            self._log(f"[upload-queue] #{job.task_id}: on_done впав:\n{traceback.format_exc()}")
+
+    def _run(self):
+        while True:
+            job = self._q.get()
+            if job is None:
+                self._q.task_done()
+                return
+            try:
+                self._execute(job)
+            finally:
+                with self._cond:
+                    self._queued_bytes -= job.size
+                    self._cond.notify_all()
+                self._q.task_done()
+
+    def drain(self):
+        """Чекає, поки всі поставлені аплоади завершаться."""
+        if self._workers:
+            self._q.join()
+
+    def close(self):
+        self.drain()
+        for _ in self._threads:
+            self._q.put(None)
+        for t in self._threads:
+            t.join()
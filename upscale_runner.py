@@ -1,10 +1,20 @@
 import os
 import time
-import glob
-import shutil
+import uuid
+import threading
+import contextvars
 import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable, Optional, Tuple, List
 
+import comfy_pool
+import hash_cache
+from comfy_exec import cancel_prompt
+from handoff import hand_off
+from media_check import ffprobe_check, probe_mp4, video_ok
+from output_watcher import iter_outputs, wait_for_outputs
+
 
 # ====== налаштування шляхів (підправ env у контейнері, якщо треба) ======
 COMFY_ROOT = "/opt/ComfyUI"
@@ -12,26 +22,46 @@ COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR") or os.path.join(COMFY_ROOT
 VIDEO_OUT_DIR = os.path.join(COMFY_OUTPUT_DIR, "video")
 
 TMP_DIR = os.environ.get("TMP_DIR") or "/tmp/comfy_worker"
+# 1 — додатково ганяти повний ffprobe (повільно); за замовчуванням лише in-process перевірка MP4
+FFPROBE_DEEP = os.environ.get("FFPROBE_DEEP", "0") == "1"
+# 1 — склеювати сегменти по мірі появи, поки Comfy ще працює (див. _StreamMerger)
+UPSCALE_STREAM_MERGE = os.environ.get("UPSCALE_STREAM_MERGE", "0") == "1"
 
 
 # -----------------------
 # helpers (re-use friendly)
 # -----------------------
 
-def ffprobe_ok(path: str) -> bool:
-    return True
-    # p = subprocess.run(
-    #     ["ffprobe", "-hide_banner", "-v", "error", "-show_format", "-show_streams", path],
-    #     stdout=subprocess.DEVNULL,
-    #     stderr=subprocess.PIPE,
-    #     text=True,
-    # )
-    # return p.returncode == 0
-
-def copy_to_tmp(src_path: str, out_name: str) -> str:
-    os.makedirs(TMP_DIR, exist_ok=True)
-    dst = os.path.join(TMP_DIR, out_name)
-    shutil.copyfile(src_path, dst)
+def ffprobe_ok(path: str, deep: bool = FFPROBE_DEEP) -> bool:
+    # moov/mdat/відеодоріжка читаються in-process (мікросекунди); ffprobe — лише при deep
+    return video_ok(path, deep=deep)
+
+def validate_segments(mp4_files: List[str], log) -> List[dict]:
+    """
+    Checks every segment before concat; returns probe info per segment
+    (duration/codec/resolution/fps). Raises if any segment is broken.
+    """
+    infos = []
+    bad = []
+    for p in mp4_files:
+        info = probe_mp4(p)
+        if not info or not info.get("frames") or (FFPROBE_DEEP and not ffprobe_check(p)):
+            bad.append(p)
+            continue
+        infos.append(info)
+    if bad:
+        raise RuntimeError(f"UPSCALE: невалідні mp4 сегменти: {bad}")
+    for p, info in zip(mp4_files, infos):
+        log(
+            f"UPSCALE: сегмент {os.path.basename(p)}: {info['codec']} {info['width']}x{info['height']} "
+            f"{info['fps']}fps {info['duration']:.2f}s"
+        )
+    return infos
+
+def handoff_to_tmp(src_path: str, out_name: str, log, consume: bool = False) -> str:
+    # hardlink -> reflink -> rename (лише своє) -> copy; див. handoff.py
+    dst, method = hand_off(src_path, os.path.join(TMP_DIR, out_name), consume=consume)
+    log(f"UPSCALE: {os.path.basename(src_path)} -> {dst} ({method})")
     return dst
 
 def wait_for_stable_files(
@@ -40,63 +70,26 @@ def wait_for_stable_files(
     min_size: int = 100_000,
     settle_sec: float = 4.0,
     poll_sec: float = 1.0,
+    log=print,
 ) -> List[str]:
     """
-    Wait until at least one file exists that matches pattern and looks "stable"
-    (size doesn't change over settle_sec and ffprobe passes for mp4 files).
+    Wait until files matching pattern exist and all of them are finished
+    (closed after writing / mp4 container complete, see output_watcher).
     Returns list of matching files sorted by mtime asc (oldest->newest).
+    settle_sec is kept for compatibility: fixed stability sleeps are gone.
     """
-    deadline = time.time() + timeout_sec
-    last_seen = None
-
-    while time.time() < deadline:
-        files = [f for f in glob.glob(pattern) if os.path.isfile(f)]
-        if files:
-            newest = files[-1]
-            try:
-                sz = os.path.getsize(newest)
-                # debug log
-                # log is not passed here, so use print or refactor; quick hack:
-                print(f"[wait_for_stable_files] newest={newest} size={sz}", flush=True)
-            except OSError:
-                pass
-            files.sort(key=lambda p: os.path.getmtime(p))  # oldest -> newest
-            last_seen = files[:]
-
-            # Filter only sufficiently large
-            big = []
-            for f in files:
-                try:
-                    if os.path.getsize(f) >= min_size:
-                        big.append(f)
-                except OSError:
-                    continue
-
-            if big:
-                # Ensure newest is stable
-                newest = big[-1]
-                try:
-                    s1 = os.path.getsize(newest)
-                    time.sleep(settle_sec)
-                    s2 = os.path.getsize(newest)
-                    if s1 == s2:
-                        # If mp4, validate container
-                        if newest.lower().endswith(".mp4"):
-                            if ffprobe_ok(newest):
-                                return big
-                        else:
-                            return big
-                except OSError:
-                    pass
-
-        time.sleep(poll_sec)
-
-    raise RuntimeError(f"Timed out waiting files by pattern: {pattern}. Last seen: {last_seen}")
+    try:
+        files = wait_for_outputs([pattern], timeout_sec=timeout_sec, min_size=min_size, require="all", poll_sec=poll_sec)
+    except TimeoutError as e:
+        raise RuntimeError(f"Timed out waiting files by pattern: {pattern}. {e}")
+    log(f"UPSCALE: {len(files)} mp4 готові, найновіший {files[-1]}")
+    return files
 
 def wait_for_video_outputs_in_comfy_id_dir(
     comfy_id: str,
     timeout_sec: int = 900,
     min_size: int = 100_000,
+    log=print,
 ) -> Tuple[str, List[str]]:
     """
     comfyui-api stores outputs in:
@@ -112,6 +105,7 @@ def wait_for_video_outputs_in_comfy_id_dir(
         min_size=min_size,
         settle_sec=4.0,
         poll_sec=1.0,
+        log=log,
     )
     return out_dir, mp4s
 
@@ -122,7 +116,7 @@ def ffmpeg_concat_mp4s_copy(
 ) -> str:
     """
     Concatenate MP4 segments without re-encoding (fast).
-    Assumes same codec/res/fps/pix_fmt (true in your case).
+    Assumes same codec/res/fps/pix_fmt (checked up front by plan_concat).
     """
     if not mp4_files:
         raise ValueError("No mp4 files to concat")
@@ -198,6 +192,320 @@ def ffmpeg_concat_mp4s_reencode(
     return out_path
 
 
+# -----------------------
+# concat planner
+# -----------------------
+
+# mp4 fourcc -> encoder, яким нормалізуємо невідповідні сегменти під еталон
+_ENCODERS = {"avc1": "libx264", "avc3": "libx264", "hvc1": "libx265", "hev1": "libx265"}
+
+
+def _stream_key(info: dict) -> tuple:
+    """Все, що має збігатися між сегментами, щоб concat(copy) дав коректний файл."""
+    return (
+        info.get("codec"), info.get("width"), info.get("height"), info.get("fps"),
+        info.get("pix_fmt"), info.get("timebase"), info.get("has_audio"),
+    )
+
+
+def plan_concat(infos: List[dict]) -> dict:
+    """
+    Decides how to merge segments from their probe info (no ffmpeg calls):
+      copy      — all segments share codec/res/fps/pix_fmt/timebase;
+      normalize — re-encode only segments that differ from the dominant
+                  signature (by frame count), then copy-concat.
+    """
+    keys = [_stream_key(i) for i in infos]
+    weight = Counter()
+    for k, info in zip(keys, infos):
+        weight[k] += info.get("frames") or 1
+    reference = weight.most_common(1)[0][0]
+    mismatched = [i for i, k in enumerate(keys) if k != reference]
+    plan = {
+        "mode": "normalize" if mismatched else "copy",
+        "reference": dict(zip(("codec", "width", "height", "fps", "pix_fmt", "timebase", "has_audio"), reference)),
+        "reencode": mismatched,
+    }
+    if mismatched and reference[0] not in _ENCODERS:
+        # еталон нам нічим кодувати — переганяємо все в H.264
+        plan["mode"] = "reencode_all"
+        plan["reencode"] = list(range(len(infos)))
+    return plan
+
+
+def _normalize_segment(src: str, dst: str, ref: dict, threads: int) -> Tuple[str, float]:
+    encoder = _ENCODERS.get(ref["codec"], "libx264")
+    cmd = [
+        "ffmpeg", "-hide_banner", "-y", "-v", "error", "-i", src,
+        "-c:v", encoder, "-crf", "19", "-threads", str(threads),
+        "-vf", f"scale={ref['width']}:{ref['height']}",
+        "-r", str(ref["fps"]),
+        "-pix_fmt", ref["pix_fmt"] or "yuv420p",
+    ]
+    if ref["timebase"]:
+        cmd += ["-video_track_timescale", ref["timebase"].split("/", 1)[1]]
+    if encoder == "libx265":
+        cmd += ["-tag:v", ref["codec"]]
+    cmd += ["-c:a", "aac"] if ref["has_audio"] else ["-an"]
+    cmd.append(dst)
+    t0 = time.time()
+    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if p.returncode != 0 or not ffprobe_ok(dst):
+        raise RuntimeError(f"normalize {os.path.basename(src)} failed:\n{p.stderr[-1500:]}")
+    return dst, time.time() - t0
+
+
+def concat_planned(mp4_files: List[str], infos: List[dict], out_path: str, log) -> Tuple[str, dict]:
+    """
+    Merges segments according to plan_concat; returns (out_path, report) where
+    report (decision + timings) goes into the task's payload_update.
+    """
+    t0 = time.time()
+    plan = plan_concat(infos)
+    report = {
+        "mode": plan["mode"],
+        "segments": len(mp4_files),
+        "reencoded": [os.path.basename(mp4_files[i]) for i in plan["reencode"]],
+        "reference": plan["reference"],
+    }
+    log(f"UPSCALE: concat plan={plan['mode']}, re-encode {len(plan['reencode'])}/{len(mp4_files)}")
+
+    parts = list(mp4_files)
+    normalized = []
+    if plan["reencode"]:
+        if plan["mode"] == "reencode_all":
+            plan["reference"].update(codec="avc1", pix_fmt="yuv420p")
+        cpus = os.cpu_count() or 1
+        n = min(len(plan["reencode"]), cpus)
+        threads = max(1, cpus // n)
+        # кодує сам ffmpeg, тож потоки лише тримають n процесів ffmpeg паралельно
+        t1 = time.time()
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            futures = {
+                i: pool.submit(
+                    _normalize_segment, mp4_files[i],
+                    os.path.join(os.path.dirname(out_path), f".norm_{i:04d}.mp4"),
+                    plan["reference"], threads,
+                )
+                for i in plan["reencode"]
+            }
+            try:
+                for i, fut in futures.items():
+                    parts[i], sec = fut.result()
+                    normalized.append(parts[i])
+                    log(f"UPSCALE: {os.path.basename(mp4_files[i])} перекодовано за {sec:.1f}s")
+            except Exception:
+                for fut in futures.values():
+                    fut.cancel()
+                raise
+        report["reencode_sec"] = round(time.time() - t1, 2)
+
+    try:
+        t2 = time.time()
+        out = ffmpeg_concat_mp4s_copy(parts, out_path, log=log)
+        report["concat_sec"] = round(time.time() - t2, 2)
+    finally:
+        for p in normalized:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+    report["total_sec"] = round(time.time() - t0, 2)
+    return out, report
+
+
+class _StreamMerger:
+    """
+    Copy-only merge that grows while Comfy is still writing segments.
+    Every finished segment is remuxed to MPEG-TS (timestamps shifted by the
+    duration merged so far) straight into stdin of one long-lived ffmpeg that
+    writes the final mp4. After the last segment only the moov is left to write,
+    so the tail after GPU work does not grow with file size.
+    """
+
+    def __init__(self, out_path: str, log):
+        self.out_path = out_path
+        self.log = log
+        self.proc = None
+        self.err = None
+        self.offset = 0.0
+        self.frames = 0
+        self.failed = None
+
+    def _start(self):
+        os.makedirs(os.path.dirname(self.out_path), exist_ok=True)
+        self.err = open(self.out_path + ".ffmpeg.log", "w+")
+        cmd = [
+            "ffmpeg", "-hide_banner", "-y", "-v", "error",
+            "-f", "mpegts", "-i", "pipe:0",
+            "-map", "0", "-c", "copy", "-bsf:a", "aac_adtstoasc",
+            self.out_path,
+        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.err)
+
+    def append(self, path: str, info: dict):
+        if self.failed:
+            return
+        if self.proc is None:
+            self._start()
+        cmd = [
+            "ffmpeg", "-hide_banner", "-v", "error", "-i", path,
+            "-map", "0", "-c", "copy",
+            "-output_ts_offset", f"{self.offset:.6f}",
+            "-f", "mpegts", "pipe:1",
+        ]
+        p = subprocess.run(cmd, stdout=self.proc.stdin, stderr=subprocess.PIPE, text=True)
+        if p.returncode != 0:
+            self.failed = f"remux {os.path.basename(path)}: {p.stderr[-1000:]}"
+            self.log(f"[ffmpeg] stream merge: {self.failed}")
+            return
+        self.offset += info.get("duration") or 0.0
+        self.frames += info.get("frames") or 0
+        self.log(f"[ffmpeg] stream merge: +{os.path.basename(path)} (до {self.offset:.1f}s)")
+
+    def finish(self) -> bool:
+        """Закриває вхід ffmpeg і перевіряє результат (кількість кадрів = сума сегментів)."""
+        if self.proc is None:
+            return False
+        self.proc.stdin.close()
+        rc = self.proc.wait()
+        self.err.seek(0)
+        stderr = self.err.read()[-1500:]
+        self.err.close()
+        os.remove(self.err.name)
+        if self.failed or rc != 0:
+            self.log(f"[ffmpeg] stream merge failed (rc={rc}): {self.failed or stderr}")
+            self._drop()
+            return False
+        info = probe_mp4(self.out_path)
+        if not info or info.get("frames") != self.frames or not ffprobe_ok(self.out_path):
+            self.log(f"[ffmpeg] stream merge: невалідний результат ({info}), очікували {self.frames} кадрів")
+            self._drop()
+            return False
+        return True
+
+    def abort(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.err.close()
+            os.remove(self.err.name)
+        self._drop()
+
+    def _drop(self):
+        try:
+            os.remove(self.out_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_upscale_streaming(
+    *,
+    workflow_key: str,
+    payload: dict,
+    run_comfy_training_workflow,
+    wait_timeout_sec: int = 1800,
+    comfy_timeout_sec: int = 7200,
+    log,
+    parts=None,
+) -> Tuple[dict, str, str, List[str], dict]:
+    """
+    Same contract as run_upscale_and_wait_video, but segments are validated and
+    merged while Comfy is still running (comfy_id is chosen here, so
+    {comfy_id}_video can be watched before /prompt returns).
+    Falls back to the regular concat if the streaming merge fails.
+    parts (upload.PartUploader): every finished segment is also uploaded as an
+    indexed part right away; the server merges them after the task is done.
+    """
+    comfy_id = str(uuid.uuid4())
+    out_dir = os.path.join(COMFY_OUTPUT_DIR, f"{comfy_id}_video")
+    box = {}
+
+    def call():
+        try:
+            box["result"] = run_comfy_training_workflow(
+                workflow_key, payload, timeout_sec=comfy_timeout_sec, comfy_id=comfy_id
+            )
+        except BaseException as e:
+            box["error"] = e
+        box["done_at"] = time.time()
+
+    # copy_context: виклик Comfy лишається на бекенді цієї задачі (comfy_pool)
+    t = threading.Thread(target=contextvars.copy_context().run, args=(call,), name=f"comfy-{comfy_id[:8]}", daemon=True)
+    t.start()
+
+    merger = _StreamMerger(os.path.join(TMP_DIR, f"upscale_{comfy_id[:8]}.mp4"), log)
+    segments, infos = [], []
+    try:
+        for seg in iter_outputs(
+            [os.path.join(out_dir, "*.mp4")],
+            finished=lambda: not t.is_alive(),
+            timeout_sec=wait_timeout_sec,
+            min_size=100_000,
+        ):
+            infos += validate_segments([seg], log)
+            segments.append(seg)
+            if not merger.failed and _stream_key(infos[-1]) != _stream_key(infos[0]):
+                # несумісний сегмент: потокову склейку кидаємо, далі вирішить plan_concat
+                merger.failed = f"{os.path.basename(seg)} не збігається з першим сегментом"
+                log(f"[ffmpeg] stream merge: {merger.failed}")
+                if parts is not None:
+                    # сервер склеює лише copy — такі частини йому не допоможуть
+                    parts.abort(merger.failed)
+            if parts is not None:
+                parts.add(seg)
+            # один сегмент склеювати не треба — merge стартує з другого
+            if len(segments) == 2:
+                merger.append(segments[0], infos[0])
+            if len(segments) >= 2:
+                merger.append(seg, infos[-1])
+        t.join()
+        if "error" in box:
+            raise box["error"]
+    except BaseException as e:
+        merger.abort()
+        if parts is not None:
+            parts.abort(f"{type(e).__name__}: {e}")
+        if t.is_alive():
+            # задача впаде, а GPU ще рахує наш prompt: знімаємо його і чекаємо потік,
+            # щоб слот бекенда не звільнився під зайнятим Comfy
+            backend = comfy_pool.current()
+            cancel_prompt(comfy_id, backend.comfy if backend else None)
+            t.join()
+        raise
+
+    result = box["result"]
+    log(f"✅ Comfy задача завершена: {result.get('id')}")
+    if result.get("files") is not None or result.get("id") != comfy_id:
+        # виконання через /ws (шляхи з executed) або comfyui-api проігнорував наш id —
+        # звичайний шлях після завершення
+        log(f"UPSCALE: сегменти з результату Comfy {result.get('id')}, без потокової склейки")
+        merger.abort()
+        if parts is not None:
+            parts.abort(f"сегменти не з {comfy_id}_video")
+        return _finish_upscale(result, log, wait_timeout_sec)
+
+    if not segments:
+        raise RuntimeError(f"UPSCALE: Comfy завершився, а mp4 в {out_dir} немає")
+
+    if len(segments) == 1:
+        final = segments[0]
+        local = handoff_to_tmp(final, f"upscale_{comfy_id[:8]}.mp4", log)
+        report = {"mode": "single", "segments": 1}
+    elif merger.finish():
+        final = local = merger.out_path
+        report = {
+            "mode": "stream_copy",
+            "segments": len(segments),
+            "finalize_sec": round(time.time() - box["done_at"], 2),
+        }
+        log(f"UPSCALE: stream merge {len(segments)} сегментів готовий через {report['finalize_sec']}s після Comfy: {final}")
+    else:
+        final, report = concat_planned(segments, infos, os.path.join(out_dir, f"{comfy_id}_merged.mp4"), log)
+        local = handoff_to_tmp(final, f"upscale_{comfy_id[:8]}.mp4", log, consume=True)
+    return result, final, local, segments, report
+
+
 # -----------------------
 # main runner for upscale task
 # -----------------------
@@ -210,50 +518,67 @@ def run_upscale_and_wait_video(
     wait_timeout_sec: int = 1800,
     comfy_timeout_sec: int = 7200,
     log,
-) -> Tuple[dict, str, str, List[str]]:
+) -> Tuple[dict, str, str, List[str], dict]:
     """
     Runs an UPSCALE workflow via comfyui-api, then waits for MP4 outputs in
       /opt/ComfyUI/output/{comfy_id}_video/*.mp4
-    If multiple MP4 segments exist, concatenates them into a single MP4.
-    Copies final MP4 to TMP_DIR and returns paths.
+    If multiple MP4 segments exist, concatenates them into a single MP4 (see plan_concat).
+    Hands final MP4 off to TMP_DIR (hardlink/reflink, our merged file is moved) and returns paths.
     """
-    started_at = time.time()
-
     result = run_comfy_training_workflow(workflow_key, payload, timeout_sec=comfy_timeout_sec)
+    log(f"✅ Comfy задача завершена: {result.get('id')}")
+    return _finish_upscale(result, log, wait_timeout_sec)
+
+
+def _finish_upscale(result: dict, log, wait_timeout_sec: int) -> Tuple[dict, str, str, List[str], dict]:
     comfy_id = result.get("id")
-    log(f"✅ Comfy задача завершена: {comfy_id}")
     if not comfy_id:
         raise RuntimeError(f"UPSCALE: comfy result has no id: {result}")
 
-    out_dir, mp4_files = wait_for_video_outputs_in_comfy_id_dir(
-        comfy_id=comfy_id,
-        timeout_sec=wait_timeout_sec,
-        min_size=100_000,
-    )
+    if result.get("files") is not None:
+        # виконання через /ws: сегменти в порядку подій executed
+        mp4_files = [f["path"] for f in result["files"] if f["path"].lower().endswith(".mp4")]
+        if not mp4_files:
+            raise RuntimeError(f"UPSCALE: Comfy не повернув mp4 в outputs: {result.get('outputs')}")
+        out_dir = os.path.dirname(mp4_files[0])
+    else:
+        out_dir, mp4_files = wait_for_video_outputs_in_comfy_id_dir(
+            comfy_id=comfy_id,
+            timeout_sec=wait_timeout_sec,
+            min_size=100_000,
+            log=log,
+        )
+
+    infos = validate_segments(mp4_files, log)
 
     # Decide final mp4:
     if len(mp4_files) == 1:
         final_comfy_mp4 = mp4_files[0]
+        report = {"mode": "single", "segments": 1}
         log(f"UPSCALE: single mp4 output detected: {final_comfy_mp4}")
     else:
-        # Multiple segments -> concat
+        # Multiple segments -> planned concat (copy, re-encode only mismatched)
         # Use a deterministic name inside comfy output dir
         final_comfy_mp4 = os.path.join(out_dir, f"{comfy_id}_merged.mp4")
-        final_comfy_mp4 = ffmpeg_concat_mp4s_copy(mp4_files, final_comfy_mp4, log=log)
+        final_comfy_mp4, report = concat_planned(mp4_files, infos, final_comfy_mp4, log)
         log(f"UPSCALE: merged mp4: {final_comfy_mp4}")
 
-    # Copy to TMP
-    local_tmp_path = copy_to_tmp(final_comfy_mp4, f"upscale_{comfy_id[:8]}.mp4")
-    return result, final_comfy_mp4, local_tmp_path, mp4_files
+    # Hand off to TMP: merged mp4 is ours, Comfy's own segment only gets linked
+    local_tmp_path = handoff_to_tmp(
+        final_comfy_mp4, f"upscale_{comfy_id[:8]}.mp4", log, consume=len(mp4_files) > 1
+    )
+    return result, final_comfy_mp4, local_tmp_path, mp4_files, report
 
 
-def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, log):
+def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, log, parts=None):
     """
     Handler in the same style as handle_wan_task, but for upscale+vfi workflows.
     - input copying into ComfyUI/input is NOT done here (as per your note).
     - waits for comfy outputs in {comfy_id}_video folder
     - if comfy produced multiple mp4 segments (common with rebatch), merges them
       into a single mp4 (concat copy, fallback re-encode).
+    - with parts (upload.PartUploader) segments are uploaded while Comfy runs;
+      this always uses the streaming runner.
     """
     tid = task["id"]
     workflow_key = task["workflow_key"]
@@ -263,7 +588,7 @@ def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, lo
     update_task(tid, "running", payload_update={"stage": "comfy_upscale_started"})
 
     try:
-        result, comfy_mp4_path, local_path, segments = run_upscale_and_wait_video(
+        kwargs = dict(
             workflow_key=workflow_key,
             payload=payload,
             run_comfy_training_workflow=run_comfy_training_workflow,
@@ -271,6 +596,15 @@ def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, lo
             comfy_timeout_sec=7200,
             log=log,
         )
+        if parts is not None:
+            result, comfy_mp4_path, local_path, segments, concat_report = run_upscale_streaming(parts=parts, **kwargs)
+        elif UPSCALE_STREAM_MERGE:
+            result, comfy_mp4_path, local_path, segments, concat_report = run_upscale_streaming(**kwargs)
+        else:
+            result, comfy_mp4_path, local_path, segments, concat_report = run_upscale_and_wait_video(**kwargs)
+        if parts is None or parts.failed:
+            # хеш для upload_chunked рахується вже зараз, поки файл у page cache
+            hash_cache.prehash(local_path, log)
 
         payload_update = {
             "note": "Upscale video generated via comfyui-api (merged if segmented).",
@@ -280,6 +614,7 @@ def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, lo
             "video_local": local_path,
             "video_segments": segments,
             "segments_count": len(segments),
+            "concat": concat_report,
         }
 
         update_task(tid, "done", None, payload_update)
@@ -288,5 +623,7 @@ def handle_upscale_task(task: dict, run_comfy_training_workflow, update_task, lo
 
     except Exception as e:
         log(f"❌ UPSCALE-задача #{tid} помилка: {e}")
+        if parts is not None:
+            parts.abort(str(e))
         update_task(tid, "error", str(e), payload_update={"stage": "comfy_upscale_failed"})
         raise
@@ -1,10 +1,12 @@
 # wan_runner.py
 import os
 import time
-import glob
-import shutil,subprocess
 from typing import Optional, Iterable, Tuple
 
+from handoff import hand_off
+from media_check import video_ok
+from output_watcher import wait_for_outputs
+
 
 # ====== налаштування шляхів (підправ env у контейнері, якщо треба) ======
 COMFY_ROOT = "/opt/ComfyUI"
@@ -12,6 +14,10 @@ COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR") or os.path.join(COMFY_ROOT
 VIDEO_OUT_DIR = os.path.join(COMFY_OUTPUT_DIR, "video")
 
 TMP_DIR = os.environ.get("TMP_DIR") or "/tmp/comfy_worker"
+# 1 — додатково ганяти повний ffprobe (повільно); за замовчуванням лише in-process перевірка MP4
+FFPROBE_DEEP = os.environ.get("FFPROBE_DEEP", "0") == "1"
+
+VIDEO_EXTS = (".mp4", ".webm", ".mov", ".mkv", ".gif")
 
 
 # ====== helpers ======
@@ -25,54 +31,32 @@ def wait_for_new_file_by_patterns(
 ) -> Optional[str]:
     """
     Чекає, поки зʼявиться новий файл (mtime >= started_at - slack), який підходить під patterns (glob).
-    Повертає шлях до найсвіжішого валідного файлу або None.
+    Повертає шлях до найсвіжішого дописаного файлу або None.
     """
-    deadline = time.time() + timeout_sec
     os.makedirs(VIDEO_OUT_DIR, exist_ok=True)
+    try:
+        found = wait_for_outputs(
+            patterns,
+            timeout_sec=timeout_sec,
+            min_size=min_size,
+            newer_than=started_at - mtime_slack_sec,
+            poll_sec=poll_sec,
+        )
+    except TimeoutError:
+        return None
+    return found[-1]
 
-    while time.time() < deadline:
-        candidates = []
-        for pat in patterns:
-            candidates.extend(glob.glob(pat))
-
-        candidates = [p for p in candidates if os.path.isfile(p)]
-        candidates = [p for p in candidates if os.path.getmtime(p) >= started_at - mtime_slack_sec]
-
-        if candidates:
-            # найновіший перший
-            candidates.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-
-            for p in candidates:
-                try:
-                    if os.path.getsize(p) >= min_size:
-                        return p
-                except OSError:
-                    continue
-
-        time.sleep(poll_sec)
+def wait_for_newest_file(pattern: str, timeout_sec: int = 600, min_size: int = 100_000) -> str:
+    try:
+        return wait_for_outputs([pattern], timeout_sec=timeout_sec, min_size=min_size)[-1]
+    except TimeoutError as e:
+        raise RuntimeError(f"File not found by pattern: {pattern}. {e}")
 
-    return None
 
-def wait_for_newest_file(pattern: str, timeout_sec: int = 600, min_size: int = 100_000) -> str:
-    deadline = time.time() + timeout_sec
-    best = None
-    while time.time() < deadline:
-        files = glob.glob(pattern)
-        files = [f for f in files if os.path.isfile(f)]
-        if files:
-            files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-            for f in files:
-                if os.path.getsize(f) >= min_size:
-                    return f
-            best = files[0]
-        time.sleep(1)
-    raise RuntimeError(f"File not found by pattern: {pattern}. Last seen: {best}")
-
-
-def copy_to_tmp(src_path: str, out_name: str) -> str:
-    os.makedirs(TMP_DIR, exist_ok=True)
-    dst = os.path.join(TMP_DIR, out_name)
-    shutil.copyfile(src_path, dst)
+def handoff_to_tmp(src_path: str, out_name: str, log, consume: bool = False) -> str:
+    # hardlink -> reflink -> rename (лише своє) -> copy; див. handoff.py
+    dst, method = hand_off(src_path, os.path.join(TMP_DIR, out_name), consume=consume)
+    log(f"WAN: {os.path.basename(src_path)} -> {dst} ({method})")
     return dst
 
 def pick_wan_video_from_comfy_result(result: dict) -> str:
@@ -121,47 +105,34 @@ def wait_for_wan_video_output(
         )
     return p
 
-def ffprobe_ok(path: str) -> bool:
-    p = subprocess.run(
-        ["ffprobe", "-hide_banner", "-v", "error", "-show_format", "-show_streams", path],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    return p.returncode == 0
+def ffprobe_ok(path: str, deep: bool = FFPROBE_DEEP) -> bool:
+    # moov/mdat/відеодоріжка читаються in-process (мікросекунди); ffprobe — лише при deep
+    return video_ok(path, deep=deep)
 
 def wait_for_video_in_comfy_id_dir(comfy_id: str, timeout_sec: int = 900, min_size: int = 100_000) -> str:
     out_dir = os.path.join(COMFY_OUTPUT_DIR, f"{comfy_id}_video")
     pattern = os.path.join(out_dir, "*.mp4")
 
-    deadline = time.time() + timeout_sec
-    last_best = None
-
-    while time.time() < deadline:
-        files = [f for f in glob.glob(pattern) if os.path.isfile(f)]
-        if files:
-            files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-            best = files[0]
-            last_best = best
-
-            try:
-                size1 = os.path.getsize(best)
-                if size1 >= min_size:
-                    # чекаємо стабільності довше (5с) + щоб файл "постарів"
-                    time.sleep(5)
-                    size2 = os.path.getsize(best)
-                    age = time.time() - os.path.getmtime(best)
+    # watcher повертає файл, щойно mp4 закрили/дописали moov — без фіксованих 5 с очікування
+    try:
+        best = wait_for_outputs([pattern], timeout_sec=timeout_sec, min_size=min_size)[-1]
+    except TimeoutError as e:
+        raise RuntimeError(f"WAN: відео не знайдено/не фіналізовано в {out_dir} за {timeout_sec}s. {e}")
 
-                    if size2 == size1 and age >= 5:
-                        # головне: файл реально валідний mp4
-                        if ffprobe_ok(best):
-                            return best
-            except OSError:
-                pass
+    # головне: файл реально валідний mp4
+    if not ffprobe_ok(best):
+        raise RuntimeError(f"WAN: {best} дописаний, але це не валідний mp4")
+    return best
 
-        time.sleep(1)
 
-    raise RuntimeError(f"WAN: відео не знайдено/не фіналізовано в {out_dir} за {timeout_sec}s. Last seen: {last_best}")
+def video_from_executed(result: dict) -> str:
+    """Останнє відео з outputs (події executed) — без сканування тек."""
+    videos = [f["path"] for f in result.get("files") or [] if f["path"].lower().endswith(VIDEO_EXTS)]
+    if not videos:
+        raise RuntimeError(f"WAN: Comfy не повернув відео в outputs: {result.get('outputs')}")
+    if not ffprobe_ok(videos[-1]):
+        raise RuntimeError(f"WAN: {videos[-1]} не валідне відео")
+    return videos[-1]
 
 
 # ====== main runner ======
@@ -177,7 +148,7 @@ def run_wan_and_wait_video(
     """
     Запускає WAN workflow,
     потім чекає появи відео в ComfyUI/output/{comfy_id}_video/,
-    копіює його в TMP_DIR.
+    передає його в TMP_DIR (hardlink/reflink, копія — лише в крайньому разі).
     """
     started_at = time.time()
 
@@ -188,7 +159,11 @@ def run_wan_and_wait_video(
         raise RuntimeError(f"WAN: comfy result has no id: {result}")
 
 
-    comfy_video_path = wait_for_video_in_comfy_id_dir(comfy_id, timeout_sec=wait_timeout_sec)
+    if result.get("files") is not None:
+        # виконання через /ws: шлях уже відомий з події executed
+        comfy_video_path = video_from_executed(result)
+    else:
+        comfy_video_path = wait_for_video_in_comfy_id_dir(comfy_id, timeout_sec=wait_timeout_sec)
 
     # comfy_video_path = wait_for_wan_video_output(
     #     comfy_id=comfy_id,
@@ -198,7 +173,7 @@ def run_wan_and_wait_video(
     # )
 
     ext = os.path.splitext(comfy_video_path)[1] or ".mp4"
-    local_tmp_path = copy_to_tmp(comfy_video_path, f"wan_{comfy_id[:8]}{ext}")
+    local_tmp_path = handoff_to_tmp(comfy_video_path, f"wan_{comfy_id[:8]}{ext}", log)
 
     return result, comfy_video_path, local_tmp_path
 
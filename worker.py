@@ -4,21 +4,36 @@
 
 import os
 import time
+import threading
 import json
 import uuid
 import traceback
-import requests
-import base64
 import subprocess
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import http_client
+import hash_cache
 from download_dependencies import (
     init_downloader,
-    download_dependencies
+    download_dependencies,
+    release_task_models,
 )
-from upload import init_uploader, upload_image, upload_file, upload_chunked, upload_samples
+from handoff import hand_off, release_comfy_output
+from upload import init_uploader, upload_image, upload_images, upload_file, upload_chunked, upload_samples, PartUploader
 from wan_runner import handle_wan_task
 from upscale_runner import handle_upscale_task
+from comfy_stream import post_prompt
+from comfy_exec import init_comfy_exec, execute as execute_in_comfy, ProgressReporter
+import comfy_pool
+from comfy_pool import BackendPool, Backend, parse_backends, is_backend_fault, comfy_done
+from workflow_templates import Template, load_template, compile_object, ITERATION_PREFIX
+from prefetch import Prefetcher
+from upload_queue import UploadQueue
+from model_affinity import AffinityScheduler, models_in_workflow
+from image_batch import ImageBatcher, merge_workflows, batch_signature, chain_workflows, prev_image_marker
+from task_api import init_task_api, release_tasks, filter_leased, TaskLeaser, StatusBatcher
+from model_store import init_model_store
+from image_encode import init_image_encoder, reencode_images, shutdown_image_encoder
 
 # ------------------ Налаштування ------------------
 
@@ -33,6 +48,25 @@ UPLOAD_FILE_URL   = f"{API_BASE}/index.php?r=worker/uploadFile"
 COMFY_SERVER = "127.0.0.1:3000"            # ComfyUI на Salad-сервері
 COMFY_HTTP   = f"http://{COMFY_SERVER}"
 
+# напряму в ComfyUI (/prompt + /ws): прогрес/ETA в update_task, таймаут на зависання вузла
+COMFY_WS_ENABLED = os.environ.get("COMFY_WS_ENABLED", "0") == "1"
+COMFYUI_SERVER = os.environ.get("COMFYUI_SERVER") or "127.0.0.1:8188"      # сам ComfyUI за comfyui-api
+COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR") or "/opt/ComfyUI/output"
+COMFY_STALL_SEC = float(os.environ.get("COMFY_STALL_SEC", "600"))          # вузол без жодної події стільки — завис
+COMFY_NODE_STALL_SEC = json.loads(os.environ.get("COMFY_NODE_STALL_SEC") or "{}")  # {"VHS_VideoCombine": 1800}
+PROGRESS_REPORT_SEC = float(os.environ.get("PROGRESS_REPORT_SEC", "10"))  # не частіше оновлювати прогрес задачі
+
+# кілька Comfy на одній машині (по одному на GPU): "127.0.0.1:3000,127.0.0.1:3001" або JSON
+# [{"name": "gpu0", "http": "127.0.0.1:3000", "comfy": "127.0.0.1:8188", "slots": 1}]; порожньо — один COMFY_SERVER
+COMFY_BACKENDS = os.environ.get("COMFY_BACKENDS", "")
+COMFY_HEALTH_PATH = os.environ.get("COMFY_HEALTH_PATH", "/docs")
+COMFY_HEALTH_SEC = float(os.environ.get("COMFY_HEALTH_SEC", "15"))
+# тримати в черзі ComfyUI наступний prompt, поки поточна задача зберігає/аплоадить результат
+COMFY_PRIME = os.environ.get("COMFY_PRIME", "0") == "1"
+COMFY_PRIME_WAIT_SEC = int(os.environ.get("COMFY_PRIME_WAIT_SEC", "3600"))  # + до таймаутів: prompt може чекати попередній
+# скільки задач пулу може одночасно зберігати/аплоадити результат понад слоти Comfy (0 — по одній на слот)
+COMFY_POST_TASKS = int(os.environ.get("COMFY_POST_TASKS", "0"))
+
 CHECK_INTERVAL = 5                         # сек. пауза між циклами
 
 TMP_DIR = "/tmp/comfy_worker"
@@ -43,6 +77,59 @@ TRAIN_DATA_DIR = "/opt/lora_train_data"
 TRAIN_OUTPUT_DIR = "/opt/lora_train_output"
 os.makedirs(TRAIN_OUTPUT_DIR, exist_ok=True)
 DOWNLOAD_FILE_URL = f"{API_BASE}/index.php?r=worker/getFile"
+FILE_MANIFEST_URL = f"{API_BASE}/index.php?r=worker/getFileManifest"
+
+MODEL_DIR = os.environ.get("MODEL_DIR") or "/opt/ComfyUI/models"
+
+# lookahead: поки Comfy рахує задачу, беремо наступну і качаємо її залежності у фоні
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_MAX_MBPS = float(os.environ.get("PREFETCH_MAX_MBPS", "0"))        # 0 = без ліміту
+PREFETCH_MAX_GB = float(os.environ.get("PREFETCH_MAX_GB", "0"))            # 0 = без ліміту
+PREFETCH_MIN_FREE_GB = float(os.environ.get("PREFETCH_MIN_FREE_GB", "10")) # не чіпати останні N GB диска
+
+# фонові аплоади: 0 = синхронно (як раніше), N = кількість потоків аплоаду
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "0"))
+UPLOAD_QUEUE_MAX_MB = int(os.environ.get("UPLOAD_QUEUE_MAX_MB", "4096"))  # ліміт байт у черзі (TMP_DIR)
+# 1 — сегменти upscale аплоадяться частинами ще під час генерації, склеює сервер
+# (chunkUpload/mergeParts); без підтримки на сервері — аплоад цілого файлу, як раніше
+UPSCALE_PART_UPLOAD = os.environ.get("UPSCALE_PART_UPLOAD", "0") == "1"
+UPLOAD_CHUNK_WINDOW = int(os.environ.get("UPLOAD_CHUNK_WINDOW", "4"))      # шматків upload_chunked в польоті (1 = послідовно)
+IMAGE_UPLOAD_WORKERS = int(os.environ.get("IMAGE_UPLOAD_WORKERS", "4"))    # зображень однієї задачі паралельно (keep_all_outputs)
+
+# Перекодування зображень перед аплоадом, за workflow_key ("*" — решта):
+# {"qwen_image_uni": {"format": "webp", "quality": 90, "metadata": "keep"}, "*": {"format": "webp"}}
+IMAGE_ENCODE = json.loads(os.environ.get("IMAGE_ENCODE") or "{}")
+IMAGE_ENCODE_WORKERS = int(os.environ.get("IMAGE_ENCODE_WORKERS", "2"))   # процесів кодування
+
+# model affinity: скільки задач тримати в локальному буфері (0 = вимкнено, беремо по одній)
+AFFINITY_BUFFER = int(os.environ.get("AFFINITY_BUFFER", "0"))
+AFFINITY_MAX_SKIPS = int(os.environ.get("AFFINITY_MAX_SKIPS", "4"))  # aging: після N пропусків задача йде першою
+
+# Пакетний запуск сумісних lora_image/lora_test одним prompt (0/1 = вимкнено)
+IMAGE_BATCH_MAX = int(os.environ.get("IMAGE_BATCH_MAX", "0"))
+IMAGE_BATCH_WAIT_SEC = float(os.environ.get("IMAGE_BATCH_WAIT_SEC", "2"))  # скільки чекати сумісні задачі
+
+# frame_qwen: усі iterations одним графом (зображення між кроками не покидає ComfyUI)
+ITERATIONS_UNROLL = os.environ.get("ITERATIONS_UNROLL", "0") == "1"
+
+# оренда кількох задач одним запитом (0/1 = по одній, як раніше) і пакетні статуси
+LEASE_BATCH = int(os.environ.get("LEASE_BATCH", "0"))
+LEASE_SEC = int(os.environ.get("LEASE_SEC", "900"))
+STATUS_BATCH = os.environ.get("STATUS_BATCH", "0") == "1"
+STATUS_FLUSH_SEC = float(os.environ.get("STATUS_FLUSH_SEC", "0.5"))
+HTTP_METRICS_EVERY = int(os.environ.get("HTTP_METRICS_EVERY", "50"))  # лог метрик HTTP кожні N задач
+IDLE_MIN_SLEEP = 0.5                       # сек. перша пауза при порожній черзі, далі росте до CHECK_INTERVAL
+
+_STATUS_BATCHER = None
+
+# content-addressed сховище моделей з LRU-витісненням (hardlink-и в папки ComfyUI)
+MODEL_STORE_ENABLED = os.environ.get("MODEL_STORE_ENABLED", "0") == "1"
+MODEL_STORE_DIR = os.environ.get("MODEL_STORE_DIR") or os.path.join(MODEL_DIR, ".store")
+MODEL_STORE_BUDGET_GB = float(os.environ.get("MODEL_STORE_BUDGET_GB", "0"))      # 0 = без витіснення
+MODEL_STORE_MIN_AGE_SEC = int(os.environ.get("MODEL_STORE_MIN_AGE_SEC", "3600"))  # свіжі файли не чіпаємо
+
+# паралельне завантаження великих моделей по Range з докачуванням (1 = одним потоком, як раніше)
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
 
 #COMFYUI_DIR = "/opt/ComfyUI"
 #COMFYUI_LORA_DIR = os.path.join(COMFYUI_DIR, "models", "loras")
@@ -55,9 +142,15 @@ def log(msg: str):
     print(f"[{ts}] {msg}", flush=True)
 
 
-def get_task():
+def get_task(loaded_models=None):
+    data = {"token": API_TOKEN}
+    if loaded_models is not None:
+        # підказка бекенду: які моделі вже в памʼяті Comfy (може ігнорувати)
+        data["loaded_models"] = json.dumps(list(loaded_models), ensure_ascii=False)
     try:
-        r = requests.post(GET_TASK_URL, data={"token": API_TOKEN}, timeout=15)
+        # не повторюємо: сервер міг уже видати задачу, повтор видасть ще одну;
+        # наступний цикл опитування і так спитає знову
+        r = http_client.post(GET_TASK_URL, endpoint="api.getTask", data=data, timeout=15, retries=0)
         r.raise_for_status()
         data = r.json()
         if not data.get("success"):
@@ -68,6 +161,12 @@ def get_task():
         return None
 
 def update_task(task_id, status, error=None, payload_update=None):
+    if _STATUS_BATCHER is not None:
+        _STATUS_BATCHER.update(task_id, status, error, payload_update)
+        return
+    send_task_status(task_id, status, error, payload_update)
+
+def send_task_status(task_id, status, error=None, payload_update=None):
     payload = {
         "token": API_TOKEN,
         "id": task_id,
@@ -78,7 +177,7 @@ def update_task(task_id, status, error=None, payload_update=None):
     if payload_update is not None:
         payload["payload_update"] = json.dumps(payload_update, ensure_ascii=False)
     try:
-        requests.post(UPDATE_TASK_URL, data=payload, timeout=15)
+        http_client.post(UPDATE_TASK_URL, endpoint="api.updateTask", data=payload, timeout=15)
     except Exception as e:
         log(f"Не вдалося оновити статус задачі {task_id}: {e}")
 
@@ -102,41 +201,30 @@ def clear_dir(samples_dir="/opt/output/sample"):
 # API: /prompt, /history/{id}, /view?filename=...&subfolder=...&type=... :contentReference[oaicite:0]{index=0}
 
 
-def build_workflow_from_payload(workflow_key: str, payload: dict) -> dict:
+# ключі payload, які читає/додає сам воркер (не шаблон) — про них не попереджаємо
+WORKER_PAYLOAD_KEYS = frozenset({"task_id", "keep_all_outputs", "keep_iteration_outputs", "iterations"})
+
+
+def build_workflow_from_payload(workflow_key: str, payload: dict, report_unused: bool = True) -> dict:
     path = os.path.join(WORKFLOWS_DIR, f"{workflow_key}.json")
     if not os.path.isfile(path):
         raise FileNotFoundError(f"Workflow template not found: {path}")
 
-    with open(path, "r", encoding="utf-8") as f:
-        txt = f.read()
-
-    # Проходимо по ВСІХ ключах payload
-    for key, value in payload.items():
-        placeholder = f"param_{key}"
-
-        # None → null
-        if value is None:
-            replacement = "null"
-        # числа
-        elif isinstance(value, (int, float)):
-            replacement = str(value)
-        elif (key == 'lora_nodes' or key == 'images_edit'):
-            replacement = str(value)
-        else:
-            s = str(value)
-            dumped = json.dumps(s, ensure_ascii=False)
-            replacement = dumped[1:-1]  # викидаємо зовнішні лапки
+    # шаблон парситься один раз і кешується до зміни mtime файлу
+    template = load_template(path)
 
-        # І тупо заміняємо в тексті ВСІ входження param_<key>
-        txt = txt.replace(placeholder, replacement)
+    unused = template.unused(payload, ignore=WORKER_PAYLOAD_KEYS) if report_unused else None
+    if unused:
+        log(f"[workflow] {workflow_key}: ключі payload без плейсхолдерів у шаблоні: {', '.join(unused)}")
 
-    # Тепер це вже повинен бути валідний JSON
-    try:
-        workflow = json.loads(txt)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Не вдалося розпарсити workflow після підстановки: {e}\nШматок: {txt}")
+    return template.fill(payload)
 
-    return workflow
+def compile_iteration_template(base_workflow: dict):
+    """
+    Компілює itr_* плейсхолдери вже побудованого workflow — один раз на задачу,
+    далі кожна ітерація лише заповнює слоти.
+    """
+    return compile_object(base_workflow, ITERATION_PREFIX)
 
 def apply_iteration_to_workflow_text(base_workflow: dict, mapping: dict) -> dict:
     """
@@ -144,32 +232,51 @@ def apply_iteration_to_workflow_text(base_workflow: dict, mapping: dict) -> dict
     mapping: {'itr_image': '...', 'itr_prompt': '...', 'itr_first_image': '...'}  (будь-які з них)
     Повертає dict workflow для конкретної ітерації.
     """
-    txt = json.dumps(base_workflow, ensure_ascii=False)
+    template = base_workflow if isinstance(base_workflow, Template) else compile_iteration_template(base_workflow)
+    values = {k[len(ITERATION_PREFIX):] if k.startswith(ITERATION_PREFIX) else k: v for k, v in mapping.items()}
+    return template.fill(values)
 
-    for k, v in mapping.items():
-        # важливо: підставляємо як СТРОКУ, екрановану через json.dumps,
-        # але без зовнішніх лапок, щоб збігалось з твоїм стилем підстановок
-        if v is None:
-            rep = "null"
-        else:
-            dumped = json.dumps(str(v), ensure_ascii=False)
-            rep = dumped[1:-1]
+def comfy_http() -> str:
+    """comfyui-api бекенда, привʼязаного до потоку задачі (пул), або COMFY_HTTP."""
+    b = comfy_pool.current()
+    return b.http if b else COMFY_HTTP
+
+
+def comfyui_server():
+    """Сам ComfyUI для /ws (None — той, що з init_comfy_exec)."""
+    b = comfy_pool.current()
+    return b.comfy if b else None
+
+
+def comfy_timeout(sec: int) -> int:
+    """Таймаут виклику Comfy: з COMFY_PRIME prompt спершу чекає в черзі за попереднім."""
+    return sec + (COMFY_PRIME_WAIT_SEC if COMFY_PRIME else 0)
 
-        txt = txt.replace(k, rep)
 
-    return json.loads(txt)
+def comfy_queue_timeout(sec: int) -> int:
+    """Скільки prompt може чекати в черзі ComfyUI (/ws рахує timeout_sec від execution_start)."""
+    return COMFY_PRIME_WAIT_SEC if COMFY_PRIME else sec
+
+
+def check_prompt_id(sent: str, result: dict) -> dict:
+    """Результат має належати саме нашому prompt (у черзі їх може бути кілька)."""
+    got = result.get("id")
+    if got and got != sent:
+        raise RuntimeError(f"Comfy повернув результат prompt {got}, а чекали {sent}")
+    return result
+
 
 def queue_prompt_to_comfy(workflow: dict, client_id: str) -> str:
     """
     Відправляємо workflow в ComfyUI через /prompt.
     Повертає prompt_id.
     """
-    url = f"{COMFY_HTTP}/prompt"
+    url = f"{comfy_http()}/prompt"
     payload = {
         "prompt": workflow,
         "client_id": client_id,
     }
-    r = requests.post(url, json=payload, timeout=600)
+    r = http_client.post(url, endpoint="comfy.prompt", json=payload, timeout=600)
     r.raise_for_status()
     data = r.json()
     prompt_id = data.get("prompt_id")
@@ -177,58 +284,75 @@ def queue_prompt_to_comfy(workflow: dict, client_id: str) -> str:
         raise RuntimeError(f"ComfyUI не повернув prompt_id: {data}")
     return prompt_id
 
-def run_comfy_workflow(workflow_key: str, payload: dict, timeout_sec: int = 7200) -> dict:
-    client_id = str(uuid.uuid4())
-
+def run_comfy_workflow(workflow_key: str, payload: dict, timeout_sec: int = 7200, comfy_id: str | None = None) -> dict:
     workflow = build_workflow_from_payload(workflow_key, payload)
-    url = f"{COMFY_HTTP}/prompt"
+    url = f"{comfy_http()}/prompt"
 
     body = {
         "prompt": workflow,
-        # Можеш задати свій id для трейсінгу:
-        "id": str(uuid.uuid4()),
+        # свій id: runner може стежити за {id}_video ще до відповіді (див. upscale_runner)
+        "id": comfy_id or str(uuid.uuid4()),
     }
 
-    # timeout = (connect_timeout, read_timeout)
-    r = requests.post(url, json=body, timeout=(5, timeout_sec))
+    if COMFY_WS_ENABLED:
+        # result["files"] — шляхи з подій executed; runner-и беруть відео звідти, а не з {id}_video
+        result = execute_in_comfy(
+            workflow, timeout_sec=timeout_sec, queue_timeout_sec=comfy_queue_timeout(timeout_sec),
+            prompt_id=comfy_id, on_progress=progress_reporter(payload), server=comfyui_server(),
+        )
+    else:
+        # timeout = (connect_timeout, read_timeout)
+        # Для тренування / відео images не потрібні (результат лежить на диску),
+        # тому base64 з відповіді лише проходить крізь парсер і не тримається в памʼяті.
+        result = check_prompt_id(body["id"], post_prompt(url, body, out_dir=None, timeout=(5, comfy_timeout(timeout_sec))))
 
-    if r.status_code >= 400:
-        raise RuntimeError(f"comfyui-api помилка {r.status_code}: {r.text}")
+    # runner-и роблять один виклик Comfy на задачу — далі лише файли/аплоад
+    comfy_done()
+    return result
 
-    data = r.json()
-    # Для тренування тобі не обов'язково потрібні images,
-    # ComfyUI workflow може просто зберегти LoRA на диск.
-    return data
+
+def progress_reporter(payload: dict):
+    tid = (payload or {}).get("task_id")
+    return ProgressReporter(tid, update_task, PROGRESS_REPORT_SEC) if tid else None
 
 
 
-def run_workflow_via_comfy_api(workflow: dict, client_id: str) -> dict:
-    url = f"{COMFY_HTTP}/prompt"
+def run_workflow_via_comfy_api(workflow: dict, client_id: str, on_progress=None, timeout_sec: int = 600) -> dict:
+    """
+    /prompt з потоковим декодуванням: кожне зображення одразу пишеться у файл в TMP_DIR.
+    result["images"] — список {"index", "path", "size", "format", ...}.
+    З COMFY_WS_ENABLED — напряму в ComfyUI, зображення беруться з подій executed.
+    """
+    if COMFY_WS_ENABLED:
+        data = execute_in_comfy(
+            workflow, timeout_sec=timeout_sec, queue_timeout_sec=comfy_queue_timeout(timeout_sec),
+            on_progress=on_progress, server=comfyui_server(),
+        )
+        data["images"] = [
+            dict(f, index=i, size=os.path.getsize(f["path"]), format=os.path.splitext(f["path"])[1].lstrip("."))
+            for i, f in enumerate(x for x in data["files"] if x["kind"] == "images")
+        ]
+        return data
+
+    url = f"{comfy_http()}/prompt"
     payload = {
         "prompt": workflow,
         "client_id": client_id,
+        "id": str(uuid.uuid4()),
     }
-    r = requests.post(url, json=payload, timeout=(5, 600))
-
-    if r.status_code >= 400:
-        # тут побачимо справжню причину 500
-        raise RuntimeError(
-            f"comfyui-api помилка {r.status_code}: {r.text}"
-        )
-
-    data = r.json()
+    data = check_prompt_id(payload["id"], post_prompt(url, payload, out_dir=TMP_DIR, timeout=(5, comfy_timeout(timeout_sec))))
     if "images" not in data:
         raise RuntimeError(f"Несподіваний формат відповіді comfyui-api: {data}")
     return data
 
-def generate_with_comfy(workflow_key: str, payload: dict) -> str:
+def generate_with_comfy(workflow_key: str, payload: dict) -> list:
     """
     Повний цикл:
       1) побудувати workflow_json
       2) /prompt -> prompt_id
       3) чекати /history/prompt_id
-      4) забрати перше зображення через /view
-      5) повернути локальний шлях до PNG
+      4) забрати зображення (перше або всі — payload["keep_all_outputs"])
+      5) повернути локальні шляхи, перший — основний результат
     """
     client_id = str(uuid.uuid4())
 
@@ -236,85 +360,125 @@ def generate_with_comfy(workflow_key: str, payload: dict) -> str:
     workflow = build_workflow_from_payload(workflow_key, payload)
 
     # 2) запускаємо workflow через comfyui-api
-    result = run_workflow_via_comfy_api(workflow, client_id)
+    result = run_workflow_via_comfy_api(workflow, client_id, on_progress=progress_reporter(payload))
+    comfy_done()
     task_id = result.get("id")
     log(f"comfyui-api task_id={task_id}")
 
-    images = result.get("images") or []
-    if not images:
-        raise RuntimeError(f"comfyui-api не повернув images: {result}")
-
-    # 3) беремо перше зображення
-    first = images[0]
+    # 3) зображення вже на диску
+    return save_images_from_comfy_result(result, payload.get("task_id"), bool(payload.get("keep_all_outputs")))
 
-    # comfyui-api може повернути або чистий base64-рядок,
-    # або dict з полями типу {"image": "...", "filename": "..."}
-    if isinstance(first, dict):
-        b64_data = first.get("image") or first.get("data")
-        filename = first.get("filename") or f"{task_id}.png"
-    else:
-        b64_data = first
-        filename = f"{task_id}.png"
+def generate_batch_with_comfy(workflow_key: str, payloads: list) -> list:
+    """
+    Один prompt на кілька сумісних задач (див. image_batch).
+    Повертає списки локальних шляхів у порядку payloads; None — задача не отримала зображення.
+    """
+    batch = merge_workflows([build_workflow_from_payload(workflow_key, p) for p in payloads])
+    reporters = [r for r in map(progress_reporter, payloads) if r]
 
-    if not b64_data:
-        raise RuntimeError(f"Немає base64 даних у images[0]: {first}")
+    def on_progress(progress, force=False):
+        for r in reporters:
+            r(progress, force)
 
-    # 4) зберігаємо в TMP_DIR
-    ext = os.path.splitext(filename)[1] or ".png"
-    safe_id = (task_id or "comfy")[:8]
-    tmp_name = f"comfy_{safe_id}{ext}"
-    local_path = os.path.join(TMP_DIR, tmp_name)
+    result = run_workflow_via_comfy_api(batch.workflow, str(uuid.uuid4()), on_progress=on_progress)
+    comfy_done()
+    log(f"comfyui-api task_id={result.get('id')}: пачка з {len(payloads)} задач, спільних вузлів {batch.shared}")
 
-    os.makedirs(TMP_DIR, exist_ok=True)
-    with open(local_path, "wb") as f:
-        f.write(base64.b64decode(b64_data))
+    images = result.get("images") or []
+    groups = batch.route(images)
+    if groups is None:
+        discard_images(images)
+        raise RuntimeError("Не вдалося розкласти зображення пачки по задачах (немає ні node, ні filename)")
 
-    log(f"Зображення збережено локально: {local_path}")
-    return local_path
+    paths = []
+    for payload, group in zip(payloads, groups):
+        try:
+            paths.append(save_images_from_comfy_result(
+                {"images": group}, payload.get("task_id"), bool(payload.get("keep_all_outputs")),
+            ))
+        except RuntimeError:
+            paths.append(None)
+    return paths
+
+def discard_images(images: list):
+    for image in images:
+        if image.get("path"):
+            try:
+                os.remove(image["path"])
+            except FileNotFoundError:
+                pass
 
 def save_first_image_from_comfy_result(result: dict, task_id: str | None = None) -> str:
+    """
+    Повертає шлях першого зображення з результату run_workflow_via_comfy_api;
+    решта декодованих файлів видаляється (усі виходи — save_images_from_comfy_result).
+    """
     images = result.get("images") or []
-    if not images:
+    if not images or not images[0].get("path"):
         raise RuntimeError(f"comfyui-api не повернув images: {result}")
 
-    first = images[0]
-
-    if isinstance(first, dict):
-        b64_data = first.get("image") or first.get("data")
-        filename = first.get("filename") or (f"{task_id}.png" if task_id else "comfy.png")
-    else:
-        b64_data = first
-        filename = (f"{task_id}.png" if task_id else "comfy.png")
-
-    if not b64_data:
-        raise RuntimeError(f"Немає base64 даних у images[0]: {first}")
-
-    ext = os.path.splitext(filename)[1] or ".png"
-    safe_id = (task_id or "comfy")[:8]
-    tmp_name = f"comfy_{safe_id}{ext}"
-    local_path = os.path.join(TMP_DIR, tmp_name)
-
-    os.makedirs(TMP_DIR, exist_ok=True)
-    with open(local_path, "wb") as f:
-        f.write(base64.b64decode(b64_data))
+    discard_images(images[1:])
 
-    log(f"Зображення збережено локально: {local_path}")
+    local_path = images[0]["path"]
+    log(f"Зображення збережено локально: {local_path} ({images[0].get('size')} байт)")
     return local_path
 
 
-def generate_with_comfy_iterations(workflow_key: str, payload: dict) -> str:
+def save_images_from_comfy_result(result: dict, task_id, keep_all: bool = False) -> list:
+    """
+    Локальні шляхи зображень результату, перший — основний (result_path).
+    keep_all=False — лише перше, як save_first_image_from_comfy_result. Інакше всі виходи
+    переносяться в TMP_DIR як {task_id}_{node}_{index}.ext (hand_off, без копіювання).
+    """
+    if not keep_all:
+        return [save_first_image_from_comfy_result(result)]
+
+    images = [im for im in result.get("images") or [] if im.get("path")]
+    if not images:
+        raise RuntimeError(f"comfyui-api не повернув images: {result}")
+    paths = []
+    for i, image in enumerate(images):
+        src = image["path"]
+        node = image.get("node")
+        index = image.get("index", i)
+        name = f"{task_id}_{node}_{index}" if node is not None else f"{task_id}_{index}"
+        ext = os.path.splitext(src)[1] or ".png"
+        # файли з потокового декодування вже наші (TMP_DIR) — їх можна просто перейменувати
+        consume = os.path.dirname(os.path.abspath(src)) == os.path.abspath(TMP_DIR)
+        dst, _ = hand_off(src, os.path.join(TMP_DIR, name + ext), consume=consume)
+        paths.append(dst)
+    log(f"Зображення задачі #{task_id} збережено локально: {len(paths)} шт.")
+    return paths
+
+
+def generate_with_comfy_iterations(workflow_key: str, payload: dict) -> list:
     """
     1) будуємо base_workflow через існуючий build_workflow_from_payload (без iterations)
     2) потім проганяємо iterations, кожну — окремий запуск workflow
     3) кожен результат стає itr_first_image наступного кроку
+    Повертає шляхи виходів останнього кроку (+ проміжні з keep_iteration_outputs).
     """
     iterations = payload.get("iterations") or []
+    if not iterations:
+        raise ValueError("payload.iterations порожній")
+    keep_all = bool(payload.get("keep_all_outputs"))
 
     # 1) перша підстановка (payload -> workflow) як і було
     base_workflow = build_workflow_from_payload(workflow_key, payload)
+    itr_template = compile_iteration_template(base_workflow)
+
+    if ITERATIONS_UNROLL and len(iterations) > 1:
+        try:
+            chain = unroll_iterations(itr_template, iterations, bool(payload.get("keep_iteration_outputs")))
+        except ValueError as e:
+            log(f"[iterations] ланцюжок не розгортається в один граф ({e}), запускаємо кроки окремо")
+        else:
+            return run_unrolled_iterations(chain, payload, len(iterations))
 
     first_img = None
     last_out = None
+    final = []
+    steps = []
 
     for idx, it in enumerate(iterations):
         ref_img = it.get("image")
@@ -323,7 +487,7 @@ def generate_with_comfy_iterations(workflow_key: str, payload: dict) -> str:
             first_img = ref_img
 
         wf_i = apply_iteration_to_workflow_text(
-            base_workflow,
+            itr_template,
             {
                 "itr_first_image": first_img,
                 "itr_image": ref_img,
@@ -331,14 +495,166 @@ def generate_with_comfy_iterations(workflow_key: str, payload: dict) -> str:
             }
         )
 
-        result = run_workflow_via_comfy_api(wf_i, client_id=str(uuid.uuid4()))
-
-        local_path = save_first_image_from_comfy_result(result)  # <-- винеси існуючий шматок в хелпер
+        result = run_workflow_via_comfy_api(wf_i, client_id=str(uuid.uuid4()), on_progress=progress_reporter(payload))
 
-        last_out = local_path
+        if idx == len(iterations) - 1:
+            final = save_images_from_comfy_result(result, payload.get("task_id"), keep_all)
+            last_out = final[0]
+        else:
+            last_out = save_first_image_from_comfy_result(result)
+            steps.append(last_out)
         first_img = last_out
 
-    return last_out
+    comfy_done()
+    return final + (steps if payload.get("keep_iteration_outputs") else [])
+
+
+def unroll_iterations(itr_template, iterations: list, keep_outputs: bool = False):
+    """Усі кроки одним графом: itr_first_image кроку k — вихід кроку k-1 всередині ComfyUI."""
+    steps = []
+    for idx, it in enumerate(iterations):
+        steps.append(apply_iteration_to_workflow_text(
+            itr_template,
+            {
+                "itr_first_image": it.get("image") if idx == 0 else prev_image_marker(idx),
+                "itr_image": it.get("image"),
+                "itr_prompt": it.get("prompt", ""),
+            }
+        ))
+    return chain_workflows(steps, keep_outputs=keep_outputs)
+
+
+def run_unrolled_iterations(chain, payload: dict, steps: int) -> list:
+    result = run_workflow_via_comfy_api(
+        chain.workflow, str(uuid.uuid4()), on_progress=progress_reporter(payload), timeout_sec=600 * steps,
+    )
+    comfy_done()
+    log(f"comfyui-api task_id={result.get('id')}: {steps} ітерацій одним prompt, спільних вузлів {chain.shared}")
+
+    images = result.get("images") or []
+    groups = chain.route(images)
+    if groups is None:
+        discard_images(images)
+        raise RuntimeError("Не вдалося знайти вихід останньої ітерації серед зображень результату")
+    final = save_images_from_comfy_result(
+        {"images": groups[-1]}, payload.get("task_id"), bool(payload.get("keep_all_outputs")),
+    )
+    # проміжні кроки є серед виходів лише з keep_iteration_outputs (див. chain_workflows)
+    intermediate = [save_first_image_from_comfy_result({"images": g}) for g in groups[:-1] if g]
+    return final + intermediate
+
+
+def task_models(task: dict) -> frozenset:
+    """Моделі, які завантажить Comfy для цієї задачі (з loader-вузлів зібраного workflow)."""
+    payload = dict(task.get("payload") or {}, task_id=task["id"])
+    try:
+        workflow = build_workflow_from_payload(task["workflow_key"], payload, report_unused=False)
+    except Exception:
+        # шаблон не зібрався — орієнтуємось хоча б на файли з dependency
+        return frozenset(
+            f"{d.get('type')}:{d.get('file_name')}"
+            for d in (task.get("dependency") or [])
+            if isinstance(d, dict) and d.get("file_name")
+        )
+    return models_in_workflow(workflow)
+
+
+def image_batch_key(task: dict):
+    """Ключ сумісності для ImageBatcher: шаблон + моделі + стек LoRA."""
+    payload = dict(task.get("payload") or {}, task_id=task["id"])
+    workflow = build_workflow_from_payload(task["workflow_key"], payload, report_unused=False)
+    return task["workflow_key"], batch_signature(workflow)
+
+
+# ------------------ Аплоад результатів ------------------
+
+class DeferredDone:
+    """
+    update_task для runner-ів: проміжні статуси йдуть одразу,
+    а "done" з payload_update запамʼятовується і відправляється вже після аплоаду.
+    """
+    def __init__(self):
+        self.payload_update = None
+
+    def __call__(self, task_id, status, error=None, payload_update=None):
+        if status == "done":
+            self.payload_update = payload_update
+            return
+        update_task(task_id, status, error, payload_update)
+
+
+def on_upload_done(task_id, payload_update, result):
+    if not result:
+        update_task(task_id, "failed", "Upload failed")
+        return
+
+    update = dict(payload_update or {})
+    if isinstance(result, str):
+        update["result_path"] = result
+    elif isinstance(result, list):
+        # upload_images: перший — основний результат, решта — додаткові виходи
+        update["result_path"] = result[0]
+        update["result_paths"] = result
+    elif isinstance(result, dict):
+        remote = result.get("result_path") or result.get("path")
+        if remote:
+            update.setdefault("result_path", remote)
+
+    update_task(task_id, "done", None, update)
+    log(f"✅ Завершено задачу #{task_id}, result={update.get('result_path')}")
+
+    # аплоад підтверджено — вихідна тека Comfy ({comfy_id}_video) більше не потрібна
+    if update.get("video_comfy_output"):
+        release_comfy_output(update.get("comfy_id"), log)
+
+
+def on_upload_error(task_id, exc):
+    err = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    log(f"❌ Помилка аплоаду задачі #{task_id}: {exc}")
+    update_task(task_id, "failed", err)
+
+
+def submit_upload(uploads: UploadQueue, task_id, path: str, upload, payload_update=None):
+    uploads.submit(
+        task_id=task_id,
+        path=path,
+        upload=upload,
+        on_done=lambda result: on_upload_done(task_id, payload_update, result),
+        on_error=lambda exc: on_upload_error(task_id, exc),
+    )
+
+
+def upload_upscale(task_id, path: str, parts=None):
+    """Сегменти вже на сервері — лишається склейка там; інакше (чи якщо вона не вдалась) — файл цілком."""
+    if parts is not None:
+        result = parts.finish(os.path.basename(path))
+        if result:
+            return result
+    return upload_chunked(file_path=path, task_id=task_id)
+
+
+def image_encode_spec(workflow_key: str | None):
+    return IMAGE_ENCODE.get(workflow_key) or IMAGE_ENCODE.get("*")
+
+
+def submit_image_upload(uploads: UploadQueue, task_id, paths: list, payload_update=None, workflow_key=None):
+    """
+    Одне зображення — upload_image, як і раніше; кілька — upload_images паралельно.
+    З IMAGE_ENCODE файли спершу перекодовуються (у потоці аплоаду, не GPU);
+    звіт про стиснення потрапляє в payload "done" як image_encode.
+    """
+    spec = image_encode_spec(workflow_key)
+    update = dict(payload_update or {})
+
+    def upload():
+        files = paths
+        if spec:
+            files, update["image_encode"] = reencode_images(paths, spec, TMP_DIR)
+        if len(files) == 1:
+            return upload_image(task_id, files[0])
+        return upload_images(task_id, files)
+
+    submit_upload(uploads, task_id, paths[0], upload, update)
 
 
 # ------------------ Головний цикл ------------------
@@ -363,65 +679,317 @@ def main():
         download_file_url=DOWNLOAD_FILE_URL,
         train_data_dir=TRAIN_DATA_DIR,
         log_fn=log,
+        connections=DOWNLOAD_CONNECTIONS,
+        file_manifest_url=FILE_MANIFEST_URL,
+    )
+    init_uploader(
+        API_TOKEN, UPLOAD_FILE_URL, UPLOAD_IMAGE_URL, log,
+        chunk_window=UPLOAD_CHUNK_WINDOW, image_workers=IMAGE_UPLOAD_WORKERS,
     )
-    init_uploader(API_TOKEN, UPLOAD_FILE_URL, UPLOAD_IMAGE_URL, log)
+    init_task_api(API_TOKEN, log)
+    init_image_encoder(IMAGE_ENCODE_WORKERS, log)
+    init_comfy_exec(COMFYUI_SERVER, COMFY_OUTPUT_DIR, COMFY_STALL_SEC, COMFY_NODE_STALL_SEC, log)
+    pruned = hash_cache.prune()
+    if pruned:
+        log(f"[hash] прибрано {pruned} застарілих записів кешу sha256")
+    if MODEL_STORE_ENABLED:
+        init_model_store(
+            MODEL_STORE_DIR,
+            budget_bytes=int(MODEL_STORE_BUDGET_GB * 1024 ** 3),
+            min_age_sec=MODEL_STORE_MIN_AGE_SEC,
+            log=log,
+        )
+        log(f"Сховище моделей: {MODEL_STORE_DIR}, бюджет {MODEL_STORE_BUDGET_GB or '∞'} GB")
+
+    global _STATUS_BATCHER
+    if STATUS_BATCH:
+        _STATUS_BATCHER = StatusBatcher(send_single=send_task_status, flush_interval=STATUS_FLUSH_SEC, log=log)
+        log("Пакетні оновлення статусів увімкнено")
+
+    leaser = None
+    lease_task = get_task
+    if LEASE_BATCH > 1:
+        leaser = TaskLeaser(get_task_single=get_task, batch_size=LEASE_BATCH, lease_sec=LEASE_SEC, log=log)
+        lease_task = leaser.get_task
+        log(f"Оренда задач пачками по {LEASE_BATCH} увімкнена")
+
+    scheduler = None
+    next_task = lease_task
+    if AFFINITY_BUFFER > 0:
+        scheduler = AffinityScheduler(
+            get_task=lease_task,
+            task_models=task_models,
+            buffer_size=AFFINITY_BUFFER,
+            max_skips=AFFINITY_MAX_SKIPS,
+            lease_check=filter_leased,
+            log=log,
+        )
+        next_task = scheduler.next_task
+        log(f"Model affinity увімкнено: буфер {AFFINITY_BUFFER} задач")
+
+    batcher = None
+    if IMAGE_BATCH_MAX > 1:
+        batcher = ImageBatcher(
+            get_task=next_task,
+            batch_key=image_batch_key,
+            max_batch=IMAGE_BATCH_MAX,
+            max_wait=IMAGE_BATCH_WAIT_SEC,
+            lease_check=filter_leased,
+            log=log,
+        )
+        next_task = batcher.next_task
+        log(f"Пакетний запуск image-задач: до {IMAGE_BATCH_MAX} задач, очікування {IMAGE_BATCH_WAIT_SEC} с")
+
+    prefetcher = None
+    if PREFETCH_ENABLED:
+        prefetcher = Prefetcher(
+            get_task=next_task,
+            download_dependencies=download_dependencies,
+            log=log,
+            max_bytes_per_sec=int(PREFETCH_MAX_MBPS * 1024 * 1024),
+            max_bytes=int(PREFETCH_MAX_GB * 1024 ** 3),
+            min_free_bytes=int(PREFETCH_MIN_FREE_GB * 1024 ** 3),
+            disk_path=MODEL_DIR,
+        )
+        log("Prefetch наступної задачі увімкнено")
+
+    uploads = UploadQueue(
+        workers=UPLOAD_WORKERS,
+        max_queued_bytes=UPLOAD_QUEUE_MAX_MB * 1024 * 1024,
+        log=log,
+    )
+
+    pool = runner = runner_slots = None
+    # COMFY_PRIME: 2 слоти на бекенд — один prompt виконується, наступний чекає в черзі ComfyUI
+    slots = 2 if COMFY_PRIME else 1
+    backends = parse_backends(COMFY_BACKENDS, default_comfy=COMFYUI_SERVER, default_slots=slots)
+    if COMFY_PRIME and not backends:
+        backends = [Backend("comfy0", COMFY_HTTP, COMFYUI_SERVER, slots=slots)]
+    if backends:
+        pool = BackendPool(
+            backends,
+            health_path=COMFY_HEALTH_PATH,
+            health_interval=COMFY_HEALTH_SEC,
+            log=log,
+        )
+        # потік задачі тримається й після comfy_done() (збереження/аплоад), тож потоків більше
+        # за слоти: інакше задача на звільненому слоті чекала б у черзі executor-а
+        workers = pool.capacity + (COMFY_POST_TASKS or pool.capacity)
+        runner = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="comfy-task")
+        runner_slots = threading.BoundedSemaphore(workers)
+        log(f"Пул Comfy: {', '.join(f'{b.name}={b.http}x{b.slots}' for b in backends)}")
+
+    def iteration():
+        if pool:
+            return run_pool_iteration(pool, runner, prefetcher, uploads, next_task, scheduler, batcher, runner_slots)
+        return run_loop_iteration(prefetcher, uploads, next_task, scheduler, batcher)
+
     log("Воркер запущено. Очікуємо задачі...")
-    while True:
-        task = get_task()
+    idle_sleep = IDLE_MIN_SLEEP
+    tasks_seen = 0
+    try:
+        while True:
+            if iteration():
+                idle_sleep = IDLE_MIN_SLEEP
+                tasks_seen += 1
+                if HTTP_METRICS_EVERY and tasks_seen % HTTP_METRICS_EVERY == 0:
+                    http_client.log_metrics(log)
+            else:
+                time.sleep(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, CHECK_INTERVAL)
+    finally:
+        # невзяті задачі повертаємо на сервер, щоб їх підхопив інший воркер
+        unstarted = list(scheduler.pending()) if scheduler else []
+        if batcher:
+            unstarted.extend(batcher.pending())
+        if prefetcher and prefetcher.pending_task():
+            unstarted.append(prefetcher.pending_task())
+        if leaser:
+            leaser.release_pending(extra=unstarted)
+        elif unstarted:
+            release_tasks([t.get("id") for t in unstarted])
+
+        if runner:
+            runner.shutdown(wait=True)
+            pool.close()
+        uploads.close()
+        shutdown_image_encoder()
+        if prefetcher:
+            prefetcher.shutdown()
+        if _STATUS_BATCHER is not None:
+            _STATUS_BATCHER.close()
+        http_client.log_metrics(log)
+
+
+def run_loop_iteration(prefetcher, uploads: UploadQueue, next_task=get_task, scheduler=None, batcher=None):
+    task, deps_ready = (None, False)
+    if prefetcher:
+        task, deps_ready = prefetcher.take()
+    if not task:
+        task = next_task()
+    if not task:
+        return False
+
+    # задача могла пролежати в буфері (prefetch/affinity/пачка) довше за оренду
+    tasks = filter_leased(batcher.collect(task) if batcher else [task], log)
+    if not tasks:
+        return True
+    deps_ready = deps_ready and tasks[0] is task
+    process_batch(tasks, deps_ready, uploads, prefetcher, scheduler)
+    time.sleep(1)
+    return True
+
+
+def run_pool_iteration(pool: BackendPool, runner: ThreadPoolExecutor, prefetcher, uploads: UploadQueue,
+                       next_task=get_task, scheduler=None, batcher=None, runner_slots=None):
+    """
+    Диспетчер пулу: чекає вільний слот на будь-якому бекенді, бере задачу і запускає
+    її в окремому потоці на бекенді з найбільшою кількістю вже завантажених моделей.
+    Завислий/мертвий бекенд тримає лише власні слоти.
+    runner_slots — вільні потоки runner-а: задачу не беремо, поки її нема де запустити.
+    """
+    runner_slots = runner_slots or threading.Semaphore(1)  # без ліміту: семафор лише цього виклику
+    runner_slots.acquire()
+    submitted = False
+    try:
+        pool.wait_free()
+        task, deps_ready = (None, False)
+        if prefetcher:
+            task, deps_ready = prefetcher.take()
         if not task:
-            time.sleep(CHECK_INTERVAL)
-            continue
+            task = next_task()
+        if not task:
+            return False
+
+        tasks = filter_leased(batcher.collect(task) if batcher else [task], log)
+        if not tasks:
+            return True
+        deps_ready = deps_ready and tasks[0] is task
+        backend = pool.acquire(task_models(tasks[0]))
+        log(f"[comfy-pool] {task_ids(tasks)} -> {backend.name} ({backend.in_flight}/{backend.slots})")
+
+        def run():
+            try:
+                with pool.bind(backend) as lease:
+                    lease.fault = is_backend_fault(process_batch(tasks, deps_ready, uploads, None, scheduler))
+            finally:
+                runner_slots.release()
+
+        runner.submit(run)
+        submitted = True
+    finally:
+        if not submitted:
+            runner_slots.release()
+    # prefetch запускає лише диспетчер: один потік — одна відкладена задача
+    if prefetcher:
+        prefetcher.start()
+    return True
+
+
+def task_ids(tasks: list) -> str:
+    return ", ".join(f"#{t['id']}" for t in tasks)
 
+
+def process_batch(tasks: list, deps_ready: bool, uploads: UploadQueue, prefetcher=None, scheduler=None):
+    """
+    Пачка сумісних image-задач одним prompt (deps_ready стосується першої).
+    Якщо пачка не вдалась — кожна задача проганяється окремо, щоб помилка
+    однієї не валила решту. Повертає помилку для обліку бекенда, як process_task.
+    """
+    if len(tasks) == 1:
+        return process_task(tasks[0], deps_ready, uploads, prefetcher, scheduler)
+
+    workflow_key = tasks[0]["workflow_key"]
+    ready = {tasks[0]["id"]} if deps_ready else set()
+    try:
+        for i, task in enumerate(tasks):
+            tid = task["id"]
+            task["payload"] = task.get("payload") or {}
+            task["payload"]["task_id"] = tid
+            log(f"Отримано задачу #{tid} [{task['type']}] workflow={workflow_key} (пачка {i + 1}/{len(tasks)})")
+            if tid not in ready:
+                download_dependencies(task["dependency"] or [], task_id=tid, workflow=workflow_key)
+                ready.add(tid)
+        if scheduler:
+            scheduler.note_started(tasks[0])
+        if prefetcher:
+            prefetcher.start()
+
+        paths = generate_batch_with_comfy(workflow_key, [t["payload"] for t in tasks])
+    except Exception as e:
+        log(f"⚠️ Пачка {task_ids(tasks)} не вдалась ({e}), виконуємо задачі окремо")
+        errors = [process_task(t, t["id"] in ready, uploads, None, scheduler) for t in tasks]
+        return next((err for err in errors if is_backend_fault(err)), None)
+
+    for task, local_paths in zip(tasks, paths):
         tid = task["id"]
-        ttype = task["type"]
-        workflow_key = task["workflow_key"]
-        payload = task["payload"] or {}
-        task["payload"]["task_id"] = tid
+        release_task_models(tid)
+        if local_paths is None:
+            update_task(tid, "failed", "comfyui-api не повернув зображення для задачі в пачці")
+            continue
+        submit_image_upload(uploads, tid, local_paths, workflow_key=workflow_key)
+    return None
 
-        try:
-            log(f"Отримано задачу #{tid} [{ttype}] workflow={workflow_key}")
-            download_dependencies(task["dependency"] or [])
-
-            # приклад: type == 'lora_image' або 'frame_image' — все одно, ми просто шлемо в Comfy
-            if ttype in ("lora_image", "frame_image", "other", "lora_test"):
-                local_path = generate_with_comfy(workflow_key, payload)
-                remote_path = upload_image(tid, local_path)
-                if remote_path:
-                    update_task(tid, "done", None, {"result_path": remote_path})
-                    log(f"✅ Завершено задачу #{tid}, result={remote_path}")
-                else:
-                    update_task(tid, "failed", "Upload failed")
-            elif ttype == "frame_wan":
-                local_video = handle_wan_task(task, run_comfy_workflow, update_task, log)
-                upload_file(tid, local_video)
-            elif ttype == "upscale":
-                local_video = handle_upscale_task(task, run_comfy_workflow, update_task, log)
-                #upload_file(tid, local_video)
-                up = upload_chunked(
-                    file_path=local_video,
-                    task_id=tid,
-                )
-            elif ttype == "frame_qwen":
-                local_path = generate_with_comfy_iterations(workflow_key, payload)
-                remote_path = upload_image(tid, local_path)
-                if remote_path:
-                    update_task(tid, "done", None, {"result_path": remote_path})
-                    log(f"✅ Завершено задачу #{tid}, result={remote_path}")
-                else:
-                    update_task(tid, "failed", "Upload failed")
-            else:
-                update_task(tid, "failed", f"Невідомий тип задачі: {ttype}")
-
-        except NotImplementedError as e:
-            # ти ще не реалізував build_workflow_from_payload
-            log(f"❌ build_workflow_from_payload не реалізований: {e}")
-            update_task(tid, "failed", "Workflow builder not implemented")
-        except Exception as e:
-            err = traceback.format_exc()
-            log(f"❌ Помилка задачі #{tid}: {e}")
-            update_task(tid, "failed", err)
-
-        time.sleep(1)
+
+def process_task(task: dict, deps_ready: bool, uploads: UploadQueue, prefetcher=None, scheduler=None):
+    """Виконує одну задачу; повертає перехоплену помилку (None — успіх) для обліку бекенда."""
+    tid = task["id"]
+    ttype = task["type"]
+    workflow_key = task["workflow_key"]
+    payload = task["payload"] or {}
+    task["payload"]["task_id"] = tid
+
+    try:
+        log(f"Отримано задачу #{tid} [{ttype}] workflow={workflow_key}")
+        if deps_ready:
+            log(f"Залежності задачі #{tid} вже завантажені у фоні")
+        else:
+            download_dependencies(task["dependency"] or [], task_id=tid, workflow=workflow_key)
+
+        if scheduler:
+            scheduler.note_started(task)
+
+        # GPU зайнятий цією задачею — готуємо наступну
+        if prefetcher:
+            prefetcher.start()
+
+        # приклад: type == 'lora_image' або 'frame_image' — все одно, ми просто шлемо в Comfy
+        if ttype in ("lora_image", "frame_image", "other", "lora_test"):
+            submit_image_upload(uploads, tid, generate_with_comfy(workflow_key, payload), workflow_key=workflow_key)
+        elif ttype == "frame_wan":
+            # done відправимо після аплоаду, а не одразу після генерації
+            deferred = DeferredDone()
+            local_video = handle_wan_task(task, run_comfy_workflow, deferred, log)
+            submit_upload(uploads, tid, local_video, lambda: upload_file(tid, local_video), deferred.payload_update)
+        elif ttype == "upscale":
+            deferred = DeferredDone()
+            parts = PartUploader(tid, log) if UPSCALE_PART_UPLOAD else None
+            local_video = handle_upscale_task(task, run_comfy_workflow, deferred, log, parts=parts)
+            submit_upload(
+                uploads, tid, local_video,
+                lambda: upload_upscale(tid, local_video, parts),
+                deferred.payload_update,
+            )
+        elif ttype == "frame_qwen":
+            submit_image_upload(
+                uploads, tid, generate_with_comfy_iterations(workflow_key, payload), workflow_key=workflow_key,
+            )
+        else:
+            update_task(tid, "failed", f"Невідомий тип задачі: {ttype}")
+
+    except NotImplementedError as e:
+        # ти ще не реалізував build_workflow_from_payload
+        log(f"❌ build_workflow_from_payload не реалізований: {e}")
+        update_task(tid, "failed", "Workflow builder not implemented")
+        return e
+    except Exception as e:
+        err = traceback.format_exc()
+        log(f"❌ Помилка задачі #{tid}: {e}")
+        update_task(tid, "failed", err)
+        return e
+    finally:
+        release_task_models(tid)
+    return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,385 @@
+# workflow_templates.py
+"""
+Скомпільовані шаблони workflow.
+
+Шаблон у WORKFLOWS_DIR — це "майже JSON": плейсхолдери param_* стоять
+або всередині рядків ("param_prompt", "param_task_id.safetensors"),
+або голими значеннями (param_seed), або навіть цілими шматками обʼєкта
+(param_lora_nodes, param_images_edit).
+
+Замість str.replace по всьому тексту на кожну задачу ми один раз парсимо
+шаблон у дерево, запамʼятовуємо, де саме стоїть кожен плейсхолдер, і далі
+лише заповнюємо ці слоти типізованими значеннями.
+"""
+import os
+import re
+import json
+import marshal
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+PARAM_PREFIX = "param_"
+ITERATION_PREFIX = "itr_"
+
+_NAME_CHARS = "[A-Za-z0-9_]+"
+_SLOT_MARK = "\u0000slot:"
+_SPLICE_MARK = "\u0000splice:"
+
+
+# ------------------ вузли скомпільованого дерева ------------------
+
+class _Static:
+    """
+    Незмінна частина шаблону. Контейнери тримаємо у marshal — loads() робить
+    глибоку копію в C, це в кілька разів швидше за рекурсивне копіювання.
+    """
+    __slots__ = ("value", "packed")
+
+    def __init__(self, value):
+        self.value = value
+        self.packed = marshal.dumps(value) if isinstance(value, (dict, list)) else None
+
+    def fill(self, values):
+        if self.packed is None:
+            return self.value
+        return marshal.loads(self.packed)
+
+
+class _Value:
+    """Голий плейсхолдер на місці значення: "seed": param_seed"""
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def fill(self, values):
+        if self.name not in values:
+            raise ValueError(f"Шаблон очікує параметр '{self.name}', але його немає в payload")
+        return _bare_value(self.name, values[self.name])
+
+
+class _Str:
+    """Рядок з одним або кількома плейсхолдерами: "param_task_id.safetensors" """
+    __slots__ = ("parts",)
+
+    def __init__(self, parts: List[Tuple[Optional[str], str]]):
+        # (імʼя плейсхолдера або None, сирий текст)
+        self.parts = parts
+
+    def fill(self, values):
+        out = []
+        for name, text in self.parts:
+            if name is None:
+                out.append(text)
+            else:
+                v = _string_value(name, values)
+                # невідомий плейсхолдер лишаємо як є — так само, як робив str.replace
+                out.append(text if v is None else v)
+        return "".join(out)
+
+
+class _Splice:
+    """Плейсхолдер на місці членів обʼєкта: param_lora_nodes"""
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def members(self, values) -> Iterable[Tuple[str, Any]]:
+        if self.name not in values:
+            raise ValueError(f"Шаблон очікує фрагмент '{self.name}', але його немає в payload")
+        value = values[self.name]
+        if value is None:
+            return ()
+        if isinstance(value, dict):
+            return _copy_json(value).items()
+        text = str(value).strip().strip(",").strip()
+        if not text:
+            return ()
+        try:
+            parsed = json.loads("{" + text + "}")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Фрагмент '{self.name}' не є валідним набором JSON-полів: {e}\nШматок: {text}")
+        return parsed.items()
+
+
+class _Dict:
+    __slots__ = ("packed", "dynamic", "splices")
+
+    def __init__(self, items):
+        # items: list[(key: str | _Str, node) | _Splice]
+        # Статичні поля пакуємо одним marshal-блоком; динамічні ключі теж кладемо туди
+        # (зі значенням None), щоб після підстановки зберігся порядок полів шаблону.
+        static = {}
+        self.dynamic = []
+        self.splices = []
+        for item in items:
+            if isinstance(item, _Splice):
+                self.splices.append(item)
+                continue
+            key, node = item
+            if isinstance(key, _Str):
+                self.dynamic.append((key, node))
+                continue
+            if isinstance(node, _Static):
+                static[key] = node.value
+            else:
+                static[key] = None
+                self.dynamic.append((key, node))
+        self.packed = marshal.dumps(static)
+
+    def fill(self, values):
+        out = marshal.loads(self.packed)
+        for key, node in self.dynamic:
+            if isinstance(key, _Str):
+                key = key.fill(values)
+            out[key] = node.fill(values)
+        for splice in self.splices:
+            for k, v in splice.members(values):
+                out[k] = v
+        return out
+
+
+class _List:
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+    def fill(self, values):
+        return [node.fill(values) for node in self.items]
+
+
+# ------------------ підстановка значень ------------------
+
+def _copy_json(v):
+    if isinstance(v, dict):
+        return {k: _copy_json(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_copy_json(x) for x in v]
+    return v
+
+
+def _bare_value(name: str, value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (dict, list)):
+        return _copy_json(value)
+    # рядок на місці голого значення — як і раніше, це сирий JSON ("20", "true", "[...]")
+    try:
+        return json.loads(str(value))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Параметр '{name}' стоїть у шаблоні без лапок, але не є JSON-значенням: {value!r} ({e})")
+
+
+def _to_text(value) -> str:
+    if value is None:
+        return "null"
+    return str(value)
+
+
+def _string_value(name: str, values) -> str:
+    if name in values:
+        return _to_text(values[name])
+    # стара поведінка str.replace: param_input_image0 при ключі input_image -> "<value>0"
+    for cut in range(len(name) - 1, 0, -1):
+        head = name[:cut]
+        if head in values:
+            return _to_text(values[head]) + name[cut:]
+    return None
+
+
+# ------------------ компіляція ------------------
+
+class Template:
+    def __init__(self, root, names: Iterable[str], prefix: str, source: str = ""):
+        self._root = root
+        self.names = frozenset(names)
+        self.prefix = prefix
+        self.source = source
+
+    def fill(self, values: Dict[str, Any]) -> Any:
+        """
+        values — ключі БЕЗ префікса (як у payload: {"seed": 1, "prompt": "..."}).
+        Повертає новий обʼєкт; кешований шаблон не змінюється.
+        """
+        return self._root.fill(values)
+
+    def unused(self, values: Dict[str, Any], ignore: Iterable[str] = ()) -> List[str]:
+        """Ключі values, для яких у шаблоні немає жодного плейсхолдера (крім ignore)."""
+        ignore = frozenset(ignore)
+        return sorted(
+            k for k in values
+            if k not in ignore and k not in self.names and not self._used_as_prefix(k)
+        )
+
+    def _used_as_prefix(self, key: str) -> bool:
+        return any(n.startswith(key) for n in self.names)
+
+
+def _string_parts(s: str, name_re) -> Optional[List[Tuple[Optional[str], str]]]:
+    parts = []
+    pos = 0
+    for m in name_re.finditer(s):
+        if m.start() > pos:
+            parts.append((None, s[pos:m.start()]))
+        parts.append((m.group(1), m.group(0)))
+        pos = m.end()
+    if not parts:
+        return None
+    if pos < len(s):
+        parts.append((None, s[pos:]))
+    return parts
+
+
+def _compile_node(v, name_re, names: set, slots: Dict[str, Tuple[str, str]]):
+    """Повертає (node, dynamic)."""
+    if isinstance(v, str):
+        if v.startswith(_SLOT_MARK) and v in slots:
+            kind, name = slots[v]
+            names.add(name)
+            return _Value(name), True
+        parts = _string_parts(v, name_re)
+        if parts is None:
+            return _Static(v), False
+        names.update(name for name, _ in parts if name)
+        return _Str(parts), True
+
+    if isinstance(v, dict):
+        items = []
+        dynamic = False
+        for k, x in v.items():
+            if k.startswith(_SPLICE_MARK) and k in slots:
+                _, name = slots[k]
+                names.add(name)
+                items.append(_Splice(name))
+                dynamic = True
+                continue
+            key = k
+            key_parts = _string_parts(k, name_re)
+            if key_parts is not None:
+                names.update(name for name, _ in key_parts if name)
+                key = _Str(key_parts)
+                dynamic = True
+            node, d = _compile_node(x, name_re, names, slots)
+            dynamic = dynamic or d
+            items.append((key, node))
+        if not dynamic:
+            return _Static(v), False
+        return _Dict(items), True
+
+    if isinstance(v, list):
+        items = []
+        dynamic = False
+        for x in v:
+            node, d = _compile_node(x, name_re, names, slots)
+            dynamic = dynamic or d
+            items.append(node)
+        if not dynamic:
+            return _Static(v), False
+        return _List(items), True
+
+    return _Static(v), False
+
+
+def _mark_bare_placeholders(txt: str, prefix: str) -> Tuple[str, Dict[str, Tuple[str, str]]]:
+    """
+    Замінює голі плейсхолдери (поза лапками) на рядки-маркери, щоб текст став валідним JSON.
+    На місці значення -> "\\0slot:N", на місці полів обʼєкта -> "\\0splice:N": null.
+    """
+    token_re = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]|\b' + re.escape(prefix) + "(" + _NAME_CHARS + ")", re.S)
+    out = []
+    slots: Dict[str, Tuple[str, str]] = {}
+    stack = []
+    pos = 0
+
+    def prev_char(i):
+        j = i - 1
+        while j >= 0 and txt[j].isspace():
+            j -= 1
+        return txt[j] if j >= 0 else ""
+
+    def next_char(i):
+        j = i
+        while j < len(txt) and txt[j].isspace():
+            j += 1
+        return txt[j] if j < len(txt) else ""
+
+    for m in token_re.finditer(txt):
+        tok = m.group(0)
+        if tok in "{[":
+            stack.append(tok)
+            continue
+        if tok in "}]":
+            if stack:
+                stack.pop()
+            continue
+        if tok.startswith('"'):
+            continue
+
+        name = m.group(1)
+        before = prev_char(m.start())
+        after = next_char(m.end())
+        out.append(txt[pos:m.start()])
+        pos = m.end()
+
+        if stack and stack[-1] == "{" and before != ":":
+            mark = f"{_SPLICE_MARK}{len(slots)}"
+            slots[mark] = ("splice", name)
+            lead = "" if before in ("{", ",") else ","
+            tail = "" if after in ("}", ",") else ","
+            out.append(f"{lead}{json.dumps(mark)}: null{tail}")
+        else:
+            mark = f"{_SLOT_MARK}{len(slots)}"
+            slots[mark] = ("value", name)
+            out.append(json.dumps(mark))
+
+    out.append(txt[pos:])
+    return "".join(out), slots
+
+
+def compile_text(txt: str, prefix: str = PARAM_PREFIX, source: str = "") -> Template:
+    marked, slots = _mark_bare_placeholders(txt, prefix)
+    try:
+        tree = json.loads(marked)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Не вдалося розпарсити шаблон workflow {source}: {e}")
+    return compile_object(tree, prefix, source=source, _slots=slots)
+
+
+def compile_object(obj, prefix: str = ITERATION_PREFIX, source: str = "", _slots=None) -> Template:
+    """Компілює вже розпарсений обʼєкт (напр. workflow після payload) з плейсхолдерами в рядках."""
+    name_re = re.compile(re.escape(prefix) + "(" + _NAME_CHARS + ")")
+    names: set = set()
+    root, _ = _compile_node(obj, name_re, names, _slots or {})
+    return Template(root, names, prefix, source=source)
+
+
+# ------------------ кеш шаблонів ------------------
+
+_CACHE: Dict[str, Tuple[int, int, Template]] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def load_template(path: str, prefix: str = PARAM_PREFIX) -> Template:
+    """
+    Повертає скомпільований шаблон з кешу; перечитує файл лише якщо змінився mtime/розмір.
+    """
+    st = os.stat(path)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    with open(path, "r", encoding="utf-8") as f:
+        txt = f.read()
+    tpl = compile_text(txt, prefix, source=path)
+
+    with _CACHE_LOCK:
+        _CACHE[path] = (st.st_mtime_ns, st.st_size, tpl)
+    return tpl
+
+
+def clear_cache():
+    with _CACHE_LOCK:
+        _CACHE.clear()